@@ -1,4 +1,6 @@
 import datetime
+import errno
+import hashlib
 import io
 import os
 import sys
@@ -6,20 +8,32 @@ import time
 import json
 import shutil
 import stat
+import tarfile
+import struct
+import gzip
+import tempfile
 import math
 import socket
+import sqlite3
 import urllib.request
 import argparse
+import contextlib
 import locale
 import platform
+import re
+from array import array
 from pathlib import Path
 from functools import cached_property, partial, reduce
 import operator
+import queue
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from msvcrt import getch
 from msvcrt import kbhit
 
-from typing import Dict, Set, List, Optional, Callable, Union
+from typing import Dict, Set, List, Optional, Callable, Union, Deque, Tuple
 
 HARD_CONFIG_VER = 2
 LATEST_VER_DATA_URL = "https://raw.githubusercontent.com/DimasDSF/BackupScript/master/bkpScr/version.json"
@@ -34,15 +48,81 @@ class Arguments(object):
 launch_args = Arguments()
 
 MAX_MODIFICATION_TIME_ERROR_OFFSET = 5
+# Seconds between redraws of progress screens
+PROGRESS_REDRAW_INTERVAL = 0.1
+# Seconds between commits of the execution checkpoint journal and the timestamp DB changes it depends on
+CHECKPOINT_SYNC_INTERVAL = 5
+# Number of buffered timestamp DB changes committed together when autosave is enabled
+TIMESTAMP_DB_AUTOSAVE_CHANGES = 1000
+# The JSON timestamp DB journal is folded into its snapshot once it holds more than this or a quarter of the entries
+TIMESTAMP_JOURNAL_MIN_ENTRIES = 10000
+PIPELINE_BATCH_SIZE = 1000
+# Seconds between flushes of the buffered log records, a crash loses at most the records of this interval
+LOG_FLUSH_INTERVAL = 1.0
+# Errors kept in memory for the summary screens, all of them are written to the log records
+MAX_KEPT_ERRORS = 1000
+# Header of exported plans, see export_plan
+PLAN_FORMAT_NAME = "backupscript-plan"
+PLAN_FORMAT_VERSION = 1
+# File inside local_backup_root_folder holding the hashes backup files had when they were written or verified
+INTEGRITY_MANIFEST_NAME = ".integrity.json"
+# Archive members of these types are stored without compression
+ARCHIVE_COMPRESSED_EXTENSIONS = {'.7z', '.zip', '.rar', '.gz', '.tgz', '.xz', '.bz2', '.zst', '.lz4', '.cab', '.jar', '.apk',
+                                 '.docx', '.xlsx', '.pptx', '.odt', '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+                                 '.mp3', '.aac', '.ogg', '.opus', '.flac', '.m4a', '.mp4', '.mkv', '.avi', '.mov', '.webm'}
+# Archive members up to this size are compressed in memory, larger ones are spooled to a temporary file
+ARCHIVE_INLINE_SIZE = 2 ** 24
+# Archive volumes are rewritten without their replaced and removed members once those take up this share of the volume
+ARCHIVE_REPACK_DEAD_RATIO = 0.5
+# Versioned mode snapshot folder names, sorting by name sorts by creation time
+SNAPSHOT_NAME_FORMAT = "%Y-%m-%d_%H-%M-%S"
+SNAPSHOT_NAME_RE = re.compile(r"^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}$")
+# Folder inside local_backup_root_folder holding the content of "store": "dedup" backup_dirs entries
+DEDUP_STORE_FOLDER = ".dedup_store"
 
 class ManageModes(object):
     M_MODE_DEFAULT = 'default'
     M_MODE_SNAPSHOT = 'snapshot'
     M_MODE_SYNC = 'sync'
+    M_MODE_VERSIONED = 'versioned'
 
     @staticmethod
     def all_types() -> List[str]:
-        return [y for x, y in ChangeTypes.__dict__.items() if x.startswith('M_MODE')]
+        return [y for x, y in ManageModes.__dict__.items() if x.startswith('M_MODE')]
+
+class CompareTypes(object):
+    C_TYPE_MTIME = 'mtime'
+    C_TYPE_CHECKSUM = 'checksum'
+
+    @staticmethod
+    def all_types() -> List[str]:
+        return [y for x, y in CompareTypes.__dict__.items() if x.startswith('C_TYPE')]
+
+class StoreTypes(object):
+    S_TYPE_PLAIN = 'plain'
+    S_TYPE_DEDUP = 'dedup'
+    S_TYPE_ARCHIVE = 'archive'
+
+    @staticmethod
+    def all_types() -> List[str]:
+        return [y for x, y in StoreTypes.__dict__.items() if x.startswith('S_TYPE')]
+
+class SchedulePolicies(object):
+    P_TYPE_LOCALITY = 'locality'
+    P_TYPE_SMALL_FIRST = 'small'
+    P_TYPE_LARGE_FIRST = 'large'
+
+    @staticmethod
+    def all_types() -> List[str]:
+        return [y for x, y in SchedulePolicies.__dict__.items() if x.startswith('P_TYPE')]
+
+class TimestampBackends(object):
+    B_TYPE_SQLITE = 'sqlite'
+    B_TYPE_JSON = 'json'
+
+    @staticmethod
+    def all_types() -> List[str]:
+        return [y for x, y in TimestampBackends.__dict__.items() if x.startswith('B_TYPE')]
 
 
 try:
@@ -88,6 +168,7 @@ try:
             ],
             "path_reduction": 0,
             "local_backup_root_folder": "bkp",
+            "timestamp_db": TimestampBackends.B_TYPE_SQLITE,
             "tz": {
                 "hours": 0,
                 "minutes": 0
@@ -453,6 +534,18 @@ def splitintochunks(inlist, n):
 class SelectionCancelledException(Exception):
     pass
 
+class PipelineCancelledException(BaseException):
+    """
+    Stops the pipelined scanner, a BaseException so that the per folder error handling in scan_changes does not swallow it
+    """
+    pass
+
+class CopyCancelledException(BaseException):
+    """
+    Stops a running copy between two chunks after Ctrl+C, a BaseException so that run_instruction does not count it as a failed file
+    """
+    pass
+
 def item_selection_menu(text: str = "", items: list = (), *, return_none_on_cancel: bool = True, item_name_function: Callable = None):
     if len(items) <= 0:
         return None
@@ -511,6 +604,58 @@ def get_progress_bar(perc: float):
             status_line = status_line + ' '
     return "{}]".format(status_line)
 
+SIZE_STR_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*([KMGTP]i?)?B?$", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "k": 1000, "m": 1000 ** 2, "g": 1000 ** 3, "t": 1000 ** 4, "p": 1000 ** 5,
+              "ki": 1024, "mi": 1024 ** 2, "gi": 1024 ** 3, "ti": 1024 ** 4, "pi": 1024 ** 5}
+
+
+class ProgressRenderer(object):
+    """
+    Redraws a progress screen on a background thread at a fixed rate so the terminal cost does not grow with the
+    number of files, the scan and copy paths only update the state the draw function reads
+    Nothing is drawn in No Output Mode, the screen is drawn a last time when the renderer stops
+    """
+    def __init__(self, draw: Callable[[], None], *, interval: float = PROGRESS_REDRAW_INTERVAL):
+        self.draw = draw
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if launch_args.args.nooutput or self.thread is not None:
+            return self
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="progress", daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.draw()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        self.draw()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+def parse_size(size_str: str) -> int:
+    """
+    Parses sizes like 512, 64MiB or 1.5GB into bytes, raises ValueError on anything else
+    """
+    _match = SIZE_STR_RE.match(size_str.strip())
+    if _match is None:
+        raise ValueError(f"Incorrect size {size_str}")
+    return int(float(_match.group(1)) * SIZE_UNITS[(_match.group(2) or "").lower()])
+
 def format_bytes(bytesn):
     negative = abs(bytesn) > bytesn
     if bytesn is None:
@@ -613,8 +758,49 @@ def dl_update():
 ############################################
 # shutil replacement with callback support #
 ############################################
+class CopyMethods(object):
+    CP_METHOD_REFLINK = 'reflink'
+    CP_METHOD_SPARSE = 'sparse'
+    CP_METHOD_COPY_FILE_RANGE = 'copy_file_range'
+    CP_METHOD_SENDFILE = 'sendfile'
+    CP_METHOD_FCOPYFILE = 'fcopyfile'
+    CP_METHOD_READINTO = 'readinto'
+    CP_METHOD_BUFFERED = 'buffered'
+    CP_METHOD_SYMLINK = 'symlink'
+    CP_METHOD_DELTA = 'delta'
+    CP_METHOD_HARDLINK = 'hardlink'
+
+    @staticmethod
+    def all_types() -> List[str]:
+        return [y for x, y in CopyMethods.__dict__.items() if x.startswith('CP_METHOD_')]
+
+# Compared and rewritten unit of delta updates
+DELTA_BLOCK_SIZE = 2 ** 20
+# Changed blocks written together after the undo log holding their old contents was synced
+DELTA_UNDO_BATCH_BLOCKS = 16
+# Default amount copied per copy_file_range/sendfile call, the progress callback is called between chunks, see --copy-chunk-size
+COPY_CHUNK_SIZE = 2 ** 26
+# linux/fs.h FICLONE = _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+_HAS_FICLONE = sys.platform.startswith("linux")
+_HAS_COPY_FILE_RANGE = hasattr(os, "copy_file_range")
+_HAS_SEEK_DATA = hasattr(os, "SEEK_DATA") and hasattr(os, "SEEK_HOLE")
+# Errors meaning the kernel fast path is not supported for this pair of files, the next method is tried
+_FASTCOPY_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.ENOSYS, errno.EBADF, errno.EPERM, errno.EOPNOTSUPP,
+                                getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP), getattr(errno, 'ETXTBSY', errno.EINVAL)}
+
+def get_copy_chunk_size() -> int:
+    return max(shutil.COPY_BUFSIZE, launch_args.args.copy_chunk_size or COPY_CHUNK_SIZE)
+
+def check_copy_cancelled():
+    """
+    Called between the chunks of a copy, raises CopyCancelledException once execute_instructions was interrupted
+    """
+    if copy_cancelled.is_set():
+        raise CopyCancelledException()
+
 def copy_with_callback(src, dst, *, follow_symlinks=True, callback: Callable[[int, int], None] = None):
-    """Copy data and metadata. Return the file's destination.
+    """Copy data and metadata. Return the file's destination and the copy method used.
     Metadata is copied with copystat(). Please see the copystat function
     for more information.
     The destination may be a directory.
@@ -623,15 +809,135 @@ def copy_with_callback(src, dst, *, follow_symlinks=True, callback: Callable[[in
     """
     if os.path.isdir(dst):
         dst = os.path.join(dst, os.path.basename(src))
-    copyfile_w_callback(src, dst, follow_symlinks=follow_symlinks, callback=callback)
+    _, method = copyfile_w_callback(src, dst, follow_symlinks=follow_symlinks, callback=callback)
     shutil.copystat(src, dst, follow_symlinks=follow_symlinks)
-    return dst
+    return dst, method
+
+def _fastcopy_reflink(fsrc, fdst):
+    """
+    Shares the extents of fsrc with fdst on filesystems supporting it (btrfs, XFS, bcachefs), no data is copied
+    """
+    import fcntl
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError as _e:
+        if _e.errno in _FASTCOPY_UNSUPPORTED_ERRNOS:
+            raise shutil._GiveupOnFastCopy(_e)  # noqa
+        raise
+
+def _copy_range(infd: int, outfd: int, offset: int, count: int, *, copied: int = 0, callback: Callable[[int, int], None] = None, filesize: int = None):
+    """
+    Copies count bytes at offset with copy_file_range, falls back to pread/pwrite if the kernel refuses the range
+    Returns the amount of bytes copied so far including copied
+    """
+    end = offset + count
+    chunk_size = get_copy_chunk_size()
+    use_copy_file_range = _HAS_COPY_FILE_RANGE
+    while offset < end:
+        check_copy_cancelled()
+        _block = min(end - offset, chunk_size)
+        if use_copy_file_range:
+            try:
+                n = os.copy_file_range(infd, outfd, _block, offset, offset)
+            except OSError as _e:
+                if _e.errno in _FASTCOPY_UNSUPPORTED_ERRNOS:
+                    use_copy_file_range = False
+                    continue
+                raise
+        else:
+            _buf = os.pread(infd, min(_block, shutil.COPY_BUFSIZE * 16), offset)
+            n = os.pwrite(outfd, _buf, offset) if len(_buf) > 0 else 0
+        if n == 0:
+            break
+        offset += n
+        copied += n
+        if callback is not None:
+            callback(copied, filesize)
+    return copied
+
+def _fastcopy_sparse(fsrc, fdst, filesize: int, callback: Callable[[int, int], None] = None):
+    """
+    Copies only the data regions of a sparse file, holes are recreated by truncating the target to its size
+    """
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    offset = 0
+    copied = 0
+    while offset < filesize:
+        try:
+            data_start = os.lseek(infd, offset, os.SEEK_DATA)
+        except OSError as _e:
+            if _e.errno == errno.ENXIO:
+                # No data after offset, the rest is a hole
+                break
+            if offset == 0 and _e.errno in _FASTCOPY_UNSUPPORTED_ERRNOS:
+                raise shutil._GiveupOnFastCopy(_e)  # noqa
+            raise
+        data_end = os.lseek(infd, data_start, os.SEEK_HOLE)
+        copied = _copy_range(infd, outfd, data_start, data_end - data_start, copied=copied, callback=callback, filesize=filesize)
+        offset = data_end
+    os.ftruncate(outfd, filesize)
+
+def _fastcopy_copy_file_range(fsrc, fdst, filesize: int, callback: Callable[[int, int], None] = None):
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    chunk_size = get_copy_chunk_size()
+    offset = 0
+    while True:
+        check_copy_cancelled()
+        try:
+            n = os.copy_file_range(infd, outfd, chunk_size, offset, offset)
+        except OSError as _e:
+            if offset == 0 and _e.errno in _FASTCOPY_UNSUPPORTED_ERRNOS:
+                raise shutil._GiveupOnFastCopy(_e)  # noqa
+            raise
+        if n == 0:
+            break
+        offset += n
+        if callback is not None:
+            callback(offset, max(filesize, offset))
+    if offset == 0 and filesize > 0:
+        # Some filesystems (procfs, sysfs) report a size but copy_file_range reads nothing
+        raise shutil._GiveupOnFastCopy()  # noqa
+
+# noinspection PyUnresolvedReferences,PyProtectedMember
+def _fastcopy_sendfile_w_cb(fsrc, fdst, filesize: int, callback: Callable[[int, int], None] = None):
+    """
+    shutil._fastcopy_sendfile split into chunks of --copy-chunk-size with the progress callback called between them
+    """
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    chunk_size = get_copy_chunk_size()
+    offset = 0
+    while True:
+        check_copy_cancelled()
+        try:
+            n = os.sendfile(outfd, infd, offset, chunk_size)
+        except OSError as _e:
+            _e.filename = fsrc.name
+            _e.filename2 = fdst.name
+            if _e.errno == errno.ENOTSOCK:
+                # sendfile() only accepts regular files as the output on old kernels, do not try it again
+                shutil._USE_CP_SENDFILE = False
+                raise shutil._GiveupOnFastCopy(_e)
+            if _e.errno == errno.ENOSPC:
+                raise _e from None
+            if offset == 0 and os.lseek(outfd, 0, os.SEEK_CUR) == 0:
+                raise shutil._GiveupOnFastCopy(_e)
+            raise _e
+        if n == 0:
+            break
+        offset += n
+        if callback is not None:
+            callback(offset, max(filesize, offset))
+
+def is_sparse(st: os.stat_result) -> bool:
+    return hasattr(st, 'st_blocks') and st.st_blocks * 512 < st.st_size
 
 # noinspection PyUnresolvedReferences,PyProtectedMember
 def copyfile_w_callback(src, dst, *, follow_symlinks=True, callback: Callable[[int, int], None] = None):
     """Copy data from src to dst in the most efficient way possible.
     If follow_symlinks is not set and src is a symbolic link, a new
     symlink will be created instead of copying the file it points to.
+    Tries a reflink first, then copies only the data of sparse files, then copy_file_range,
+    the platform fast copy and finally a buffered loop. Returns the destination and the method used.
     """
     sys.audit("shutil.copyfile", src, dst)
 
@@ -639,6 +945,7 @@ def copyfile_w_callback(src, dst, *, follow_symlinks=True, callback: Callable[[i
         raise shutil.SameFileError("{!r} and {!r} are the same file".format(src, dst))
 
     file_size = 0
+    src_st = None
     for i, fn in enumerate([src, dst]):
         try:
             st = shutil._stat(fn)
@@ -650,36 +957,71 @@ def copyfile_w_callback(src, dst, *, follow_symlinks=True, callback: Callable[[i
             if stat.S_ISFIFO(st.st_mode):
                 fn = fn.path if isinstance(fn, os.DirEntry) else fn
                 raise shutil.SpecialFileError("`%s` is a named pipe" % fn)
-            if shutil._WINDOWS and i == 0:
+            if i == 0:
                 file_size = st.st_size
+                src_st = st
 
     if not follow_symlinks and shutil._islink(src):
         os.symlink(os.readlink(src), dst)
-    else:
-        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
-            # macOS
-            if shutil._HAS_FCOPYFILE:
-                try:
-                    shutil._fastcopy_fcopyfile(fsrc, fdst, shutil.posix._COPYFILE_DATA)
-                    return dst
-                except shutil._GiveupOnFastCopy:
-                    pass
-            # Linux
-            elif shutil._USE_CP_SENDFILE:
-                try:
-                    shutil._fastcopy_sendfile(fsrc, fdst)
-                    return dst
-                except shutil._GiveupOnFastCopy:
-                    pass
-            # Windows, see:
-            # https://github.com/python/cpython/pull/7160#discussion_r195405230
-            elif shutil._WINDOWS and file_size > 0:
-                _copyfileobj_readinto_w_cb(fsrc, fdst, min(file_size, shutil.COPY_BUFSIZE), callback=callback, filesize=file_size)  # noqa
-                return dst
+        return dst, CopyMethods.CP_METHOD_SYMLINK
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            method = _copy_file_data(fsrc, fdst, file_size, src_st, callback=callback)
+        except BaseException:
+            # An interrupted copy would look newer than its source, an mtime of 0 makes the next scan copy it again
+            fdst.close()
+            with contextlib.suppress(OSError):
+                os.utime(dst, ns=(0, 0))
+            raise
+    return dst, method
 
-            copyfileobj_w_callback(fsrc, fdst, callback=callback, filesize=file_size)
+# noinspection PyUnresolvedReferences,PyProtectedMember
+def _copy_file_data(fsrc, fdst, file_size: int, src_st: Optional[os.stat_result], *, callback: Callable[[int, int], None] = None) -> str:
+    """
+    Copies the data of the open files with the first copy method that works for them, returns the method used
+    """
+    if _HAS_FICLONE and file_size > 0:
+        try:
+            _fastcopy_reflink(fsrc, fdst)
+            if callback is not None:
+                callback(file_size, file_size)
+            return CopyMethods.CP_METHOD_REFLINK
+        except shutil._GiveupOnFastCopy:
+            pass
+    if _HAS_SEEK_DATA and src_st is not None and file_size > 0 and is_sparse(src_st):
+        try:
+            _fastcopy_sparse(fsrc, fdst, file_size, callback=callback)
+            return CopyMethods.CP_METHOD_SPARSE
+        except shutil._GiveupOnFastCopy:
+            pass
+    if _HAS_COPY_FILE_RANGE and file_size > 0:
+        try:
+            _fastcopy_copy_file_range(fsrc, fdst, file_size, callback=callback)
+            return CopyMethods.CP_METHOD_COPY_FILE_RANGE
+        except shutil._GiveupOnFastCopy:
+            pass
+    # macOS
+    if shutil._HAS_FCOPYFILE:
+        try:
+            shutil._fastcopy_fcopyfile(fsrc, fdst, shutil.posix._COPYFILE_DATA)
+            return CopyMethods.CP_METHOD_FCOPYFILE
+        except shutil._GiveupOnFastCopy:
+            pass
+    # Linux
+    elif shutil._USE_CP_SENDFILE:
+        try:
+            _fastcopy_sendfile_w_cb(fsrc, fdst, file_size, callback=callback)
+            return CopyMethods.CP_METHOD_SENDFILE
+        except shutil._GiveupOnFastCopy:
+            pass
+    # Windows, see:
+    # https://github.com/python/cpython/pull/7160#discussion_r195405230
+    elif shutil._WINDOWS and file_size > 0:
+        _copyfileobj_readinto_w_cb(fsrc, fdst, min(file_size, shutil.COPY_BUFSIZE), callback=callback, filesize=file_size)  # noqa
+        return CopyMethods.CP_METHOD_READINTO
 
-    return dst
+    copyfileobj_w_callback(fsrc, fdst, callback=callback, filesize=file_size)
+    return CopyMethods.CP_METHOD_BUFFERED
 
 # noinspection PyUnresolvedReferences,PyProtectedMember
 def copyfileobj_w_callback(fsrc, fdst, length=0, *, callback: Callable[[int, int], None] = None, filesize: int = None):
@@ -691,6 +1033,7 @@ def copyfileobj_w_callback(fsrc, fdst, length=0, *, callback: Callable[[int, int
     fdst_write = fdst.write
     copied = 0
     while True:
+        check_copy_cancelled()
         buf = fsrc_read(length)
         if not buf:
             break
@@ -711,6 +1054,7 @@ def _copyfileobj_readinto_w_cb(fsrc, fdst, length=shutil.COPY_BUFSIZE, *, callba
     copied = 0
     with memoryview(bytearray(length)) as mv:
         while True:
+            check_copy_cancelled()
             n = fsrc_readinto(mv)
             if not n:
                 break
@@ -723,44 +1067,446 @@ def _copyfileobj_readinto_w_cb(fsrc, fdst, length=shutil.COPY_BUFSIZE, *, callba
                 copied += n
                 callback(copied, filesize)
 
+def _pread_block(fd: int, length: int, offset: int) -> bytes:
+    _buf = os.pread(fd, length, offset)
+    while 0 < len(_buf) < length:
+        _more = os.pread(fd, length - len(_buf), offset + len(_buf))
+        if not _more:
+            break
+        _buf += _more
+    return _buf
+
+def delta_update_file(src, dst, *, hash_cache: "BlockHashCache", callback: Callable[[int, int], None] = None, on_write: Callable[[int], None] = None) -> int:
+    """
+    Updates dst in place so it matches src, only blocks whose checksum differs are rewritten
+    Checksums of dst come from the hash cache if dst did not change since they were stored, otherwise dst is read
+    dst is journaled while it is being modified, the blocks it overwrites are saved in an undo log first
+    so a failed or interrupted update is rolled back to the previous version of dst
+    Metadata is copied with copystat(). Returns the amount of bytes written
+    """
+    block_size = DELTA_BLOCK_SIZE
+    written = 0
+    with open(src, 'rb') as fsrc, open(dst, 'r+b') as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        src_size = os.fstat(infd).st_size
+        dst_stat = os.fstat(outfd)
+        dst_size = dst_stat.st_size
+        old_hashes = hash_cache.get_hashes(dst, dst_stat, block_size)
+        new_hashes = list()
+        # Changed blocks waiting for the undo log holding their old contents to be synced
+        pending: List[tuple] = list()
+
+        def write_pending():
+            undo.sync()
+            for _offset, _data in pending:
+                _view = memoryview(_data)
+                while len(_view) > 0:
+                    n = os.pwrite(outfd, _view, _offset + len(_data) - len(_view))
+                    _view = _view[n:]
+            pending.clear()
+
+        undo = hash_cache.begin_update(dst, dst_stat)
+        try:
+            offset = 0
+            while offset < src_size:
+                check_copy_cancelled()
+                _block = _pread_block(infd, block_size, offset)
+                if not _block:
+                    break
+                _hash = hashlib.blake2b(_block, digest_size=16).hexdigest()
+                _index = offset // block_size
+                _old_block = None
+                if old_hashes is not None and _index < len(old_hashes):
+                    _changed = old_hashes[_index] != _hash
+                elif offset < dst_size:
+                    _old_block = _pread_block(outfd, block_size, offset)
+                    _changed = hashlib.blake2b(_old_block, digest_size=16).hexdigest() != _hash
+                else:
+                    _changed = True
+                if _changed:
+                    if offset < dst_size:
+                        undo.add(offset, _old_block if _old_block is not None else _pread_block(outfd, min(block_size, dst_size - offset), offset))
+                    pending.append((offset, _block))
+                    written += len(_block)
+                    if on_write is not None:
+                        on_write(written)
+                    if len(pending) >= DELTA_UNDO_BATCH_BLOCKS:
+                        write_pending()
+                new_hashes.append(_hash)
+                offset += len(_block)
+                if callback is not None:
+                    callback(offset, src_size)
+            if pending:
+                write_pending()
+            if dst_size > offset:
+                # The cut tail of dst is saved before truncating
+                for _tail in range(offset, dst_size, block_size):
+                    undo.add(_tail, _pread_block(outfd, min(block_size, dst_size - _tail), _tail))
+                undo.sync()
+            if dst_size != offset:
+                os.ftruncate(outfd, offset)
+            os.fsync(outfd)
+        except BaseException:
+            fdst.close()
+            hash_cache.abort_update(dst, undo)
+            raise
+    shutil.copystat(src, dst)
+    hash_cache.store_hashes(dst, os.stat(dst), block_size, new_hashes)
+    hash_cache.end_update(dst, undo)
+    return written
+
 #####################################################
 
-def get_file_stat_data(f: Union[str, os.stat_result, os.DirEntry]):
-    if isinstance(f, os.stat_result):
+class StatData(object):
+    """
+    The parts of an os.stat_result the script relies on, used for records that are not read from the disk
+    """
+    __slots__ = ('st_size', 'st_mtime', 'st_ctime')
+
+    def __init__(self, st_size: int, st_mtime: float, st_ctime: float):
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+        self.st_ctime = st_ctime
+
+class FileRecord(object):
+    """
+    A file found while walking a tree or read from a manifest
+    relpath is relative to the walked root and always uses forward slashes
+    """
+    __slots__ = ('path', 'relpath', 'entry', '_stat')
+
+    def __init__(self, path: str, relpath: str, *, entry: Optional[os.DirEntry] = None, stat_data: Union[os.stat_result, StatData, None] = None):
+        self.path = path
+        self.relpath = relpath
+        self.entry = entry
+        self._stat = stat_data
+
+    @classmethod
+    def from_entry(cls, entry: os.DirEntry, relpath: str):
+        return cls(entry.path, relpath, entry=entry)
+
+    @property
+    def name(self) -> str:
+        return self.entry.name if self.entry is not None else os.path.basename(self.path)
+
+    def stat(self) -> Union[os.stat_result, StatData]:
+        if self._stat is None:
+            self._stat = self.entry.stat() if self.entry is not None else os.stat(self.path)
+        return self._stat
+
+    def detached(self):
+        """
+        Returns a record holding only the captured stat, used to keep planned changes from holding on to DirEntries
+        """
+        if self.entry is None and self._stat is not None:
+            return self
+        return FileRecord(self.path, self.relpath, stat_data=self.stat())
+
+    def refreshed(self):
+        return FileRecord(self.path, self.relpath, stat_data=os.stat(self.path))
+
+    def __fspath__(self):
+        return self.path
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.path}>"
+
+def get_file_stat_data(f: Union[str, os.stat_result, StatData, os.DirEntry, FileRecord]):
+    if isinstance(f, (os.stat_result, StatData)):
         return dict(ctime=f.st_ctime, mtime=f.st_mtime)
-    if not os.path.exists(f):
-        return dict(ctime=0.0, mtime=0.0)
-    if isinstance(f, os.DirEntry):
+    if isinstance(f, FileRecord):
         _stat = f.stat()
-    else:
-        _stat = os.stat(f)
+        return dict(ctime=_stat.st_ctime, mtime=_stat.st_mtime)
+    try:
+        if isinstance(f, os.DirEntry):
+            _stat = f.stat()
+        else:
+            _stat = os.stat(f)
+    except OSError:
+        return dict(ctime=0.0, mtime=0.0)
     return dict(ctime=_stat.st_ctime, mtime=_stat.st_mtime)
 
+class TimestampTable(object):
+    """
+    Compact in-memory timestamp entries of the JSON backend
+    Paths are split into a folder table holding the basenames of every folder, each basename points to a row
+    of typed arrays holding the times, rows of removed entries are reused by the next added entry
+    """
+    __slots__ = ('folders', 'mtimes', 'ctimes', 'colresmodes', 'free_rows', 'entries')
+
+    def __init__(self):
+        # folder path: {basename: row}
+        self.folders: Dict[str, Dict[str, int]] = dict()
+        self.mtimes = array('d')
+        self.ctimes = array('d')
+        self.colresmodes = array('b')
+        self.free_rows: List[int] = list()
+        self.entries = 0
+
+    def __len__(self):
+        return self.entries
+
+    def get_row(self, row: int) -> Dict[str, float]:
+        return dict(mtime=self.mtimes[row], ctime=self.ctimes[row], colresmode=self.colresmodes[row])
+
+    def get(self, path: str) -> Optional[Dict[str, float]]:
+        folder, _, name = path.rpartition("/")
+        _names = self.folders.get(folder, None)
+        row = _names.get(name, None) if _names is not None else None
+        return self.get_row(row) if row is not None else None
+
+    def set(self, path: str, filedata: Dict[str, float]):
+        folder, _, name = path.rpartition("/")
+        _names = self.folders.get(folder, None)
+        if _names is None:
+            _names = self.folders[folder] = dict()
+        row = _names.get(name, None)
+        if row is None:
+            if len(self.free_rows) > 0:
+                row = self.free_rows.pop()
+            else:
+                row = len(self.mtimes)
+                self.mtimes.append(0.0)
+                self.ctimes.append(0.0)
+                self.colresmodes.append(0)
+            _names[name] = row
+            self.entries += 1
+        self.mtimes[row] = filedata.get('mtime', 0.0)
+        self.ctimes[row] = filedata.get('ctime', 0.0)
+        self.colresmodes[row] = int(filedata.get('colresmode', 0))
+
+    def remove(self, path: str):
+        folder, _, name = path.rpartition("/")
+        _names = self.folders.get(folder, None)
+        if _names is None or name not in _names:
+            return
+        self.free_rows.append(_names.pop(name))
+        self.entries -= 1
+        if len(_names) == 0:
+            del self.folders[folder]
+
+    def items(self):
+        for folder, _names in self.folders.items():
+            for name, row in _names.items():
+                yield f"{folder}/{name}" if folder else name, self.get_row(row)
+
+class JSONTimestampStorage(object):
+    """
+    Keeps the whole timestamp DB in memory in a TimestampTable
+    A commit appends the changes to a journal next to the JSON snapshot with a single fsync, the journal is replayed on load
+    and folded into a new snapshot by close() once it grew large compared to the snapshot, so a save costs O(changes)
+    Snapshots are written to a temporary file and renamed over the old one, a crash leaves the old snapshot and its journal
+    A snapshot holds one entry per line and is parsed line by line, snapshots of older versions are rewritten that way once
+    """
+    SNAPSHOT_HEADER_RE = re.compile(r'^\{"timestamp": (.+), "files": \{$')
+
+    def __init__(self, storage: str):
+        self.storage = storage
+        self.journal = f"{storage}.journal"
+        self.timestamp: float = 0.0
+        self.files = TimestampTable()
+        self.journal_entries = 0
+        self.load()
+
+    def __len__(self):
+        return len(self.files)
+
+    def get(self, path: str) -> Optional[Dict[str, float]]:
+        return self.files.get(path)
+
+    def commit(self, changes: Dict[str, Dict[str, float]], removals: Set[str]):
+        for path in removals:
+            self.files.remove(path)
+        for path, filedata in changes.items():
+            self.files.set(path, filedata)
+        # [path] removes an entry, [path, filedata] sets it, {"timestamp": ts} sets the snapshot time
+        with open(self.journal, "a", encoding='utf-8') as f:
+            f.write(f"{json.dumps(dict(timestamp=self.timestamp))}\n")
+            f.writelines(f"{json.dumps([x])}\n" for x in removals)
+            f.writelines(f"{json.dumps([x, y])}\n" for x, y in changes.items())
+            f.flush()
+            os.fsync(f.fileno())
+        self.journal_entries += len(removals) + len(changes)
+
+    def compact(self):
+        """
+        Writes the table into a new snapshot and drops the journal
+        """
+        if not os.path.exists(os.path.dirname(self.storage)):
+            os.makedirs(os.path.dirname(self.storage), exist_ok=True)
+        # Written entry by entry instead of building the whole document in memory
+        with open(f"{self.storage}.tmp", "w+", encoding='utf-8') as f:
+            f.write(f'{{"timestamp": {json.dumps(self.timestamp)}, "files": {{')
+            f.writelines(f'{"," if n > 0 else ""}\n    {json.dumps(path)}: {json.dumps(filedata)}' for n, (path, filedata) in enumerate(self.files.items()))
+            f.write("\n}}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{self.storage}.tmp", self.storage)
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+        self.journal_entries = 0
+
+    def close(self):
+        if self.journal_entries > max(TIMESTAMP_JOURNAL_MIN_ENTRIES, len(self.files) // 4):
+            self.compact()
+
+    def replay_journal(self):
+        with open(self.journal, "r", encoding='utf-8') as f:
+            for line in f:
+                try:
+                    _entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Line cut short by a crash during its commit
+                    break
+                if isinstance(_entry, dict):
+                    self.timestamp = _entry.get('timestamp', self.timestamp)
+                    continue
+                if len(_entry) == 1:
+                    self.files.remove(_entry[0])
+                else:
+                    self.files.set(_entry[0], _entry[1])
+                self.journal_entries += 1
+
+    def load_snapshot_lines(self) -> bool:
+        """
+        Fills the table from a snapshot written by compact() without parsing it as a whole, returns False for other layouts
+        """
+        with open(self.storage, "r", encoding='utf-8') as f:
+            _header = self.SNAPSHOT_HEADER_RE.match(f.readline().rstrip("\n"))
+            if _header is None:
+                return False
+            self.timestamp = json.loads(_header.group(1))
+            for line in f:
+                line = line.strip().rstrip(",")
+                if line == "}}":
+                    break
+                if len(line) == 0:
+                    continue
+                ((path, filedata),) = json.loads(f"{{{line}}}").items()
+                if isinstance(filedata, dict):
+                    self.files.set(path, filedata)
+        return True
+
+    def load_snapshot_document(self):
+        with open(self.storage, "r", encoding='utf-8') as f:
+            _data = json.load(f)
+        self.timestamp = _data.get('timestamp', 0)
+        _files = _data.pop('files', dict())
+        # Entries are moved one by one so the parsed dicts are freed while the table fills
+        while len(_files) > 0:
+            path, filedata = _files.popitem()
+            if isinstance(filedata, dict):
+                self.files.set(path, filedata)
+
+    def load(self):
+        if not os.path.exists(self.storage):
+            self.compact()
+        _legacy = not self.load_snapshot_lines()
+        if _legacy:
+            self.load_snapshot_document()
+        if os.path.exists(self.journal):
+            self.replay_journal()
+        if _legacy:
+            self.compact()
+
+class SQLiteTimestampStorage(object):
+    """
+    Keeps the timestamp DB in an SQLite database in WAL mode, entries are looked up by path when they are needed
+    and a commit only writes the changed entries in a single transaction
+    A JSON timestamp DB found when the database is created is imported into it
+    """
+    def __init__(self, storage: str, *, import_from: str = None):
+        self.storage = storage
+        _created = not os.path.exists(storage)
+        if not os.path.exists(os.path.dirname(self.storage)):
+            os.makedirs(os.path.dirname(self.storage), exist_ok=True)
+        # Copy worker threads record timestamps too, every access is serialized by the ModTimestampDB lock
+        self.connection = sqlite3.connect(storage, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS timestamps (path TEXT PRIMARY KEY, mtime REAL, ctime REAL, colresmode REAL) WITHOUT ROWID")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        _row = self.connection.execute("SELECT value FROM meta WHERE key = 'timestamp'").fetchone()
+        self.timestamp: float = _row[0] if _row is not None else 0.0
+        if _created and import_from is not None and os.path.exists(import_from):
+            self.import_json(import_from)
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM timestamps").fetchone()[0]
+
+    def get(self, path: str) -> Optional[Dict[str, float]]:
+        _row = self.connection.execute("SELECT mtime, ctime, colresmode FROM timestamps WHERE path = ?", (path,)).fetchone()
+        if _row is None:
+            return None
+        return dict(mtime=_row[0], ctime=_row[1], colresmode=_row[2])
+
+    def commit(self, changes: Dict[str, Dict[str, float]], removals: Set[str]):
+        self.commit_items(changes.items(), removals)
+
+    def commit_items(self, items, removals: Set[str]):
+        """
+        Removes and upserts (path, filedata) items in a single transaction, items can be a generator
+        """
+        with self.connection:
+            self.connection.executemany("DELETE FROM timestamps WHERE path = ?", ((x,) for x in removals))
+            self.connection.executemany("INSERT OR REPLACE INTO timestamps (path, mtime, ctime, colresmode) VALUES (?, ?, ?, ?)",
+                                        ((x, y.get('mtime', 0.0), y.get('ctime', 0.0), y.get('colresmode', ModTimestampDB.COLRES_MODE_MANUAL)) for x, y in items))
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('timestamp', ?)", (self.timestamp,))
+
+    def close(self):
+        self.connection.close()
+
+    def import_json(self, json_storage: str):
+        """
+        Imports a JSON timestamp DB, it is renamed afterwards so switching back to "timestamp_db": "json" does not load it stale
+        """
+        _json = JSONTimestampStorage(json_storage)
+        self.timestamp = _json.timestamp
+        self.commit_items(_json.files.items(), set())
+        for path in (json_storage, _json.journal):
+            if os.path.exists(path):
+                os.replace(path, f"{path}.imported")
+        print(f"Imported {len(_json)} timestamps from {json_storage}, it was renamed to {os.path.basename(json_storage)}.imported")
+
 class ModTimestampDB(object):
+    """
+    Last known modification and change times of files and their collision resolve modes
+    Changes are buffered until save(), which hands them to the storage backend selected by the "timestamp_db" config key
+    """
     COLRES_MODE_MANUAL = 0
     COLRES_MODE_AUTOLATEST = 1
 
     DEFAULT_FILEDATA = dict(mtime=0.0, ctime=0.0, colresmode=0.0)
 
-    def __init__(self, storage_path: str = "db/timestamps.json", *, autosave: bool = False):
+    def __init__(self, storage_path: str = "db/timestamps.json", *, autosave: bool = False, backend: str = None):
         self.storage_rel_path = storage_path
-        self.__data = dict(timestamp=0.0, files=dict())
-        self.changes = dict()
+        self.backend = backend if backend is not None else config.get('timestamp_db', TimestampBackends.B_TYPE_SQLITE)
+        if self.backend not in TimestampBackends.all_types():
+            raise ValueError(f"Unknown timestamp_db {self.backend}, expected one of {', '.join(TimestampBackends.all_types())}")
+        self.changes: Dict[str, Dict[str, float]] = dict()
+        self.removals: Set[str] = set()
         self.unsaved_changes = 0
-        self.load()
+        self.lock = threading.RLock()
+        self.storage_backend: Union[JSONTimestampStorage, SQLiteTimestampStorage] = self.load()
         self.autosave = autosave
 
     @property
-    def data(self):
-        return self.__data.get('files', dict())
+    def num_entries(self) -> int:
+        with self.lock:
+            return len(self.storage_backend)
 
     @property
     def storage(self):
         return os.path.join(os.path.dirname(os.path.realpath(__file__)), self.storage_rel_path)
 
+    @property
+    def sqlite_storage(self):
+        return f"{os.path.splitext(self.storage)[0]}.sqlite3"
+
     def check_autosave(self):
-        if self.unsaved_changes > 10 and self.autosave:
-            self.save()
+        if self.unsaved_changes > TIMESTAMP_DB_AUTOSAVE_CHANGES and self.autosave:
+            self.flush()
 
     @staticmethod
     def get_empty_filedata_with_changes(**kwargs):
@@ -769,94 +1515,400 @@ class ModTimestampDB(object):
             _empty.update(kwargs)
         return _empty
 
+    def get_stored(self, path: str) -> Optional[Dict[str, float]]:
+        """
+        Returns the saved entry of a normalized path, buffered changes are not visible until they are saved
+        """
+        with self.lock:
+            if path in self.removals:
+                return None
+            return self.storage_backend.get(path)
+
     def get_timestamp(self, filepath: Union[str, os.DirEntry], *, get_from_file: bool = True):
-        fp = filepath if isinstance(filepath, str) else filepath.path
-        _ts = self.data.get(fp.replace("\\", "/"), None)
-        if not isinstance(_ts, dict):
-            _ts = None
-        if _ts is None:
-            f_ts = ModTimestampDB.get_empty_filedata_with_changes(**get_file_stat_data(filepath))
-            self.save_timestamp(fp, f_ts, force=True)
-            if get_from_file:
-                _ts = f_ts
-            else:
-                return ModTimestampDB.get_empty_filedata_with_changes()
-        return _ts
+        with self.lock:
+            fp = filepath if isinstance(filepath, str) else filepath.path
+            _ts = self.get_stored(fp.replace("\\", "/"))
+            if _ts is None:
+                f_ts = ModTimestampDB.get_empty_filedata_with_changes(**get_file_stat_data(filepath))
+                self.save_timestamp(fp, f_ts, force=True)
+                if get_from_file:
+                    _ts = f_ts
+                else:
+                    return ModTimestampDB.get_empty_filedata_with_changes()
+            return _ts
 
     def save_timestamp(self, filepath: str, timestamp: Dict[str, float] = None, *, bypass_changes_buffer: bool = False, force: bool = False):
-        if timestamp is None:
-            timestamp = ModTimestampDB.get_empty_filedata_with_changes(**get_file_stat_data(filepath))
-        if timestamp['mtime'] > 0.0:
-            _ts = self.data.get(filepath.replace("\\", "/"), None)
-            if _ts is None or not isinstance(_ts, dict):
-                _ts = ModTimestampDB.get_empty_filedata_with_changes()
-            if abs(_ts['mtime'] - timestamp['mtime']) > MAX_MODIFICATION_TIME_ERROR_OFFSET or force:
-                if bypass_changes_buffer:
-                    self.data.setdefault(filepath.replace("\\", "/"), ModTimestampDB.get_empty_filedata_with_changes()).update(timestamp)
-                else:
-                    self.changes.setdefault(filepath.replace("\\", "/"), ModTimestampDB.get_empty_filedata_with_changes()).update(timestamp)
-                self.unsaved_changes += 1
-                self.check_autosave()
+        with self.lock:
+            if timestamp is None:
+                timestamp = ModTimestampDB.get_empty_filedata_with_changes(**get_file_stat_data(filepath))
+            if timestamp['mtime'] > 0.0:
+                fp = filepath.replace("\\", "/")
+                _ts = self.get_stored(fp)
+                if _ts is None:
+                    _ts = ModTimestampDB.get_empty_filedata_with_changes()
+                if abs(_ts['mtime'] - timestamp['mtime']) > MAX_MODIFICATION_TIME_ERROR_OFFSET or force:
+                    self.removals.discard(fp)
+                    if bypass_changes_buffer:
+                        _ts.update(timestamp)
+                        self.storage_backend.commit({fp: _ts}, set())
+                    else:
+                        self.changes.setdefault(fp, ModTimestampDB.get_empty_filedata_with_changes()).update(timestamp)
+                    self.unsaved_changes += 1
+                    self.check_autosave()
 
     def get_resolve_mode(self, filepath: Union[str, os.DirEntry]):
-        fp = filepath if isinstance(filepath, str) else filepath.path
-        if self.changes.get(fp.replace("\\", "/"), None) is not None:
-            return self.changes[fp.replace("\\", "/")].get("colresmode", ModTimestampDB.COLRES_MODE_MANUAL)
-        return self.data.get(fp.replace("\\", "/"), dict()).get("colresmode", ModTimestampDB.COLRES_MODE_MANUAL)
+        with self.lock:
+            fp = (filepath if isinstance(filepath, str) else filepath.path).replace("\\", "/")
+            if self.changes.get(fp, None) is not None:
+                return self.changes[fp].get("colresmode", ModTimestampDB.COLRES_MODE_MANUAL)
+            return (self.get_stored(fp) or dict()).get("colresmode", ModTimestampDB.COLRES_MODE_MANUAL)
 
     def set_resolve_mode(self, filepath: str, mode: int):
-        filedata = self.data.get(filepath.replace("\\", "/"), ModTimestampDB.get_empty_filedata_with_changes())
-        if filedata["colresmode"] != mode:
-            self.changes.setdefault(filepath.replace("\\", "/"))["colresmode"] = mode
-            self.unsaved_changes += 1
-            self.check_autosave()
+        with self.lock:
+            fp = filepath.replace("\\", "/")
+            filedata = self.get_stored(fp) or ModTimestampDB.get_empty_filedata_with_changes()
+            if filedata["colresmode"] != mode:
+                self.removals.discard(fp)
+                self.changes.setdefault(fp, dict(filedata))["colresmode"] = mode
+                self.unsaved_changes += 1
+                self.check_autosave()
 
     def remove_timestamp(self, filepath: str):
-        _removed_ts = self.data.pop(filepath.replace("\\", "/"), None)
-        if _removed_ts is not None:
-            self.unsaved_changes += 1
-            self.check_autosave()
+        with self.lock:
+            fp = filepath.replace("\\", "/")
+            # A buffered change would otherwise bring the entry back on save
+            _pending = self.changes.pop(fp, None)
+            if self.get_stored(fp) is not None:
+                self.removals.add(fp)
+                self.unsaved_changes += 1
+                self.check_autosave()
+            elif _pending is not None:
+                self.unsaved_changes += 1
 
     @property
     def snapshot_ts(self):
-        return self.__data.get('timestamp', 0)
+        return self.storage_backend.timestamp
 
     @snapshot_ts.setter
     def snapshot_ts(self, value: float):
-        self.__data['timestamp'] = value
+        self.storage_backend.timestamp = value
 
     def load(self):
-        if not os.path.exists(self.storage):
-            self.save(init=True)
-        with open(self.storage, "r", encoding='utf-8') as f:
-            self.__data = json.load(f)
+        if self.backend == TimestampBackends.B_TYPE_SQLITE:
+            return SQLiteTimestampStorage(self.sqlite_storage, import_from=self.storage)
+        return JSONTimestampStorage(self.storage)
+
+    def flush(self):
+        """
+        Commits the buffered changes as a single group without moving the snapshot timestamp
+        """
+        with self.lock:
+            self.storage_backend.commit(self.changes, self.removals)
+            self.changes.clear()
+            self.removals.clear()
+            self.unsaved_changes = 0
 
     def save(self, init: bool = False):
-        if not init:
-            self.snapshot_ts = time.time()
-        self.data.update(self.changes)
-        self.changes.clear()
-        if not os.path.exists(os.path.dirname(self.storage)):
-            os.makedirs(os.path.dirname(self.storage), exist_ok=True)
-        with open(self.storage, "w+", encoding='utf-8') as f:
-            json.dump(self.__data, f, indent=4)
+        with self.lock:
+            if not init:
+                self.snapshot_ts = time.time()
+            self.flush()
+
+    def close(self):
+        with self.lock:
+            self.storage_backend.close()
+
+class BackupManifest(object):
+    """
+    On disk record of every file under the backup roots with its size, mtime and ctime
+    Backup roots of default, snapshot and versioned entries are only written by this script so after the first full scan
+    the manifest is kept up to date by process() instead of rescanning them on every run, sync mode backups are also
+    edited outside of the script and are walked again on every run, see scan_backup_dirs
+    Files are kept in a folder tree, every top level folder of a root and the files directly in a root are saved
+    to their own part file so a save only rewrites the parts that changed
+    It is marked dirty while a run is modifying the backup and rebuilt if a run did not finish cleanly
+    """
+    def __init__(self, storage_path: str = "db/backup_manifest.json"):
+        self.storage_rel_path = storage_path
+        self.parts_rel_path = f"{os.path.splitext(storage_path)[0]}_parts"
+        self.dirty_marker_rel_path = f"{storage_path}.dirty"
+        self.lock = threading.RLock()
+        self.__data = dict(timestamp=0.0, root=bkp_root, clean=False, roots=list(), parts=list())
+        # Nested dicts of path components, files are [size, mtime, ctime] lists
+        self.tree: Dict[str, Union[dict, list]] = dict()
+        # Keys of the parts changed since the last save, see get_part_keys
+        self.changed_parts: Set[str] = set()
         self.unsaved_changes = 0
+        self.load()
 
-class FileChange(object):
-    def __init__(self, change_type: str, change_text: str):
-        self.change_type = change_type
-        self.change_text = change_text
+    @property
+    def storage(self):
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), self.storage_rel_path)
 
-    def __str__(self):
-        return self.change_text
+    @property
+    def parts_folder(self):
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), self.parts_rel_path)
 
-    def __hash__(self):
-        return hash((self.change_type, self.change_text))
+    @property
+    def dirty_marker(self):
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), self.dirty_marker_rel_path)
 
-    def __eq__(self, other):
-        if not isinstance(other, type(self)):
-            raise TypeError(f"Cannot compare a {type(self).__name__} with {type(other).__name__}")
-        return other.__hash__() == self.__hash__()
+    @property
+    def is_dirty(self) -> bool:
+        return os.path.exists(self.dirty_marker)
+
+    @property
+    def is_clean(self) -> bool:
+        return self.__data.get('clean', False) and self.__data.get('root') == bkp_root and not self.is_dirty
+
+    @staticmethod
+    def normalize(path: str) -> str:
+        return path.replace("\\", "/")
+
+    def has_root(self, root: str) -> bool:
+        return self.normalize(root) in self.__data['roots']
+
+    def get_parent(self, path: str, *, create: bool = False) -> Tuple[Optional[dict], str]:
+        """
+        Returns the folder dict holding path and the name of path in it, create adds the missing folders
+        """
+        *folders, name = self.normalize(path).split("/")
+        node = self.tree
+        for folder in folders:
+            _child = node.get(folder, None)
+            if not isinstance(_child, dict):
+                if not create:
+                    return None, name
+                _child = node[folder] = dict()
+            node = _child
+        return node, name
+
+    def get_node(self, path: str) -> Union[dict, list, None]:
+        _parent, name = self.get_parent(path)
+        return _parent.get(name, None) if _parent is not None else None
+
+    def get_part_keys(self, path: str) -> List[str]:
+        """
+        Keys of the parts holding path, one per root containing it
+        root for a file root, root/ for files directly in a root and root/folder for everything under its top level folders
+        """
+        path = self.normalize(path)
+        keys = list()
+        for root in self.__data['roots']:
+            if path == root:
+                keys.append(root)
+            elif path.startswith(root + "/"):
+                _top, _, _rest = path[len(root) + 1:].partition("/")
+                keys.append(f"{root}/{_top}" if len(_rest) > 0 else f"{root}/")
+        return keys
+
+    def get_part(self, key: str) -> Union[dict, list, None]:
+        if key.endswith("/"):
+            _node = self.get_node(key[:-1])
+            if not isinstance(_node, dict):
+                return None
+            return {x: y for x, y in _node.items() if isinstance(y, list)} or None
+        _node = self.get_node(key)
+        if isinstance(_node, list):
+            # A root that is a single file
+            return _node if key in self.__data['roots'] else None
+        if isinstance(_node, dict) and len(_node) > 0 and any(key.startswith(x + "/") and "/" not in key[len(x) + 1:] for x in self.__data['roots']):
+            return _node
+        return None
+
+    def get_part_path(self, key: str) -> str:
+        return os.path.join(self.parts_folder, "{0}.json".format(hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()))
+
+    def get_root_parts(self, root: str) -> Dict[str, Union[dict, list]]:
+        """
+        Current contents of every part of root
+        """
+        root = self.normalize(root)
+        _node = self.get_node(root)
+        if isinstance(_node, list):
+            return {root: _node}
+        if not isinstance(_node, dict):
+            return dict()
+        parts = {f"{root}/{x}": y for x, y in _node.items() if isinstance(y, dict)}
+        if any(isinstance(x, list) for x in _node.values()):
+            parts[f"{root}/"] = self.get_part(f"{root}/")
+        return parts
+
+    def get(self, path: str) -> Optional[FileRecord]:
+        path = self.normalize(path)
+        _data = self.get_node(path)
+        if not isinstance(_data, list):
+            return None
+        return FileRecord(path, os.path.basename(path), stat_data=StatData(*_data))
+
+    def iter_under(self, root: str, matcher: Optional["IgnoreMatcher"] = None):
+        """
+        Yields a FileRecord for every file under root, relpaths are relative to root
+        Only the subtree of root is visited, folders are copied when they are entered so records can be changed meanwhile
+        """
+        root = self.normalize(root)
+        _node = self.get_node(root)
+        if isinstance(_node, list):
+            _rec = FileRecord(root, os.path.basename(root), stat_data=StatData(*_node))
+            if matcher is None or not matcher.is_ignored_relpath(_rec.relpath, _rec):
+                yield _rec
+            return
+        if not isinstance(_node, dict):
+            return
+        stack = [("", _node)]
+        while len(stack) > 0:
+            _rel, _folder = stack.pop()
+            for name, _child in tuple(_folder.items()):
+                if isinstance(_child, dict):
+                    stack.append((f"{_rel}{name}/", _child))
+                    continue
+                _rec = FileRecord(f"{root}/{_rel}{name}", f"{_rel}{name}", stat_data=StatData(*_child))
+                if matcher is None or not matcher.is_ignored_relpath(_rec.relpath, _rec):
+                    yield _rec
+
+    def update(self, path: str, stat_data: Union[os.stat_result, StatData, None] = None):
+        with self.lock:
+            if stat_data is None:
+                try:
+                    stat_data = os.stat(path)
+                except OSError:
+                    self.remove(path)
+                    return
+            path = self.normalize(path)
+            _parent, name = self.get_parent(path, create=True)
+            _parent[name] = [stat_data.st_size, stat_data.st_mtime, stat_data.st_ctime]
+            self.changed_parts.update(self.get_part_keys(path))
+            self.unsaved_changes += 1
+
+    def remove(self, path: str):
+        with self.lock:
+            path = self.normalize(path)
+            _parent, name = self.get_parent(path)
+            if _parent is not None and isinstance(_parent.get(name, None), list):
+                del _parent[name]
+                # Folders left empty are dropped so their parts are deleted
+                _folders = path.split("/")[:-1]
+                while len(_folders) > 0 and len(self.get_node("/".join(_folders))) == 0:
+                    _parent, name = self.get_parent("/".join(_folders))
+                    del _parent[name]
+                    _folders.pop()
+                self.changed_parts.update(self.get_part_keys(path))
+                self.unsaved_changes += 1
+
+    def remove_under(self, root: str):
+        with self.lock:
+            root = self.normalize(root)
+            _parent, name = self.get_parent(root)
+            if _parent is not None and _parent.pop(name, None) is not None:
+                # Parts of roots nested under root are dropped as well
+                self.changed_parts.update(x for x in self.__data['parts'] if x == root or x.startswith(root + "/"))
+                self.changed_parts.update(self.get_part_keys(root))
+                self.unsaved_changes += 1
+
+    def scan_root(self, root: str, *, workers: int = 1, filenum: List[int] = None, print_progress: bool = False):
+        """
+        Replaces everything recorded under root with the result of walking it
+        Only the parts whose contents differ from the previous records are saved again
+        """
+        root = self.normalize(root)
+        with self.lock:
+            _previous = self.get_root_parts(root)
+            _parent, name = self.get_parent(root)
+            if _parent is not None:
+                _parent.pop(name, None)
+            _new_root = root not in self.__data['roots']
+            if _new_root:
+                self.__data['roots'].append(root)
+        if os.path.exists(root):
+            if filenum is None:
+                filenum = [0]
+            if print_progress:
+                ANSIEscape.set_cursor_pos(1, 1)
+                print(f"Scanning {root}:{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
+            _is_file = os.path.isfile(root)
+            with ProgressRenderer(partial(print_files_found, filenum)) if print_progress else contextlib.nullcontext():
+                for f in iter_tree_files(root, workers=workers):
+                    _stat = f.stat()
+                    with self.lock:
+                        _parent, name = self.get_parent(root if _is_file else f"{root}/{f.relpath}", create=True)
+                        _parent[name] = [_stat.st_size, _stat.st_mtime, _stat.st_ctime]
+                    filenum[0] += 1
+        with self.lock:
+            _current = self.get_root_parts(root)
+            _changed = [x for x in set(_previous.keys()) | set(_current.keys()) if _previous.get(x, None) != _current.get(x, None)]
+            if len(_changed) > 0 or _new_root:
+                self.changed_parts.update(_changed)
+                self.unsaved_changes += 1
+
+    def reset(self):
+        self.__data = dict(timestamp=0.0, root=bkp_root, clean=False, roots=list(), parts=self.__data.get('parts', list()))
+        self.tree = dict()
+        # Every saved part is rewritten or deleted by the next save
+        self.changed_parts = set(self.__data['parts'])
+        self.unsaved_changes += 1
+
+    def mark_dirty(self):
+        """
+        Has to be called before the backup is modified, a crash after this point makes the next run rebuild the manifest
+        """
+        if not self.is_dirty:
+            if not os.path.exists(os.path.dirname(self.dirty_marker)):
+                os.makedirs(os.path.dirname(self.dirty_marker), exist_ok=True)
+            with open(self.dirty_marker, "w+", encoding='utf-8') as f:
+                f.write(str(time.time()))
+
+    def load(self):
+        if not os.path.exists(self.storage):
+            return
+        try:
+            with open(self.storage, "r", encoding='utf-8') as f:
+                self.__data = json.load(f)
+            if 'parts' not in self.__data:
+                # Single file manifest of an older version, rebuilt by the next scan
+                self.__data = dict(timestamp=0.0, root=bkp_root, clean=False, roots=list(), parts=list())
+                return
+            for key in self.__data['parts']:
+                with open(self.get_part_path(key), "r", encoding='utf-8') as f:
+                    _part = json.load(f)
+                _parent, name = self.get_parent(key[:-1] if key.endswith("/") else key, create=True)
+                if key.endswith("/"):
+                    if not isinstance(_parent.get(name, None), dict):
+                        _parent[name] = dict()
+                    _parent[name].update(_part)
+                else:
+                    _parent[name] = _part
+        except (json.JSONDecodeError, OSError):
+            self.reset()
+
+    def save(self, clean: bool = True):
+        with self.lock:
+            if not os.path.exists(self.parts_folder):
+                os.makedirs(self.parts_folder, exist_ok=True)
+            _parts = set(self.__data['parts'])
+            for key in self.changed_parts:
+                _part = self.get_part(key) if any(key == x or key.startswith(x + "/") for x in self.__data['roots']) else None
+                if _part is None:
+                    _parts.discard(key)
+                    if os.path.exists(self.get_part_path(key)):
+                        os.remove(self.get_part_path(key))
+                    continue
+                with open(f"{self.get_part_path(key)}.tmp", "w+", encoding='utf-8') as f:
+                    json.dump(_part, f, separators=(',', ':'))
+                os.replace(f"{self.get_part_path(key)}.tmp", self.get_part_path(key))
+                _parts.add(key)
+            self.changed_parts.clear()
+            self.__data['parts'] = sorted(_parts)
+            self.__data['timestamp'] = time.time()
+            self.__data['root'] = bkp_root
+            self.__data['clean'] = clean
+            if not os.path.exists(os.path.dirname(self.storage)):
+                os.makedirs(os.path.dirname(self.storage), exist_ok=True)
+            with open(f"{self.storage}.tmp", "w+", encoding='utf-8') as f:
+                json.dump(self.__data, f, separators=(',', ':'))
+            os.replace(f"{self.storage}.tmp", self.storage)
+            if clean and self.is_dirty:
+                os.remove(self.dirty_marker)
+            self.unsaved_changes = 0
 
 class ChangeTypes(object):
     CH_TYPE_UPDATE = 'update'
@@ -867,6 +1919,7 @@ class ChangeTypes(object):
     CH_TYPE_CREATE_NOTS = 'create_nots'
     CH_TYPE_FOLDER = 'folder'
     CH_TYPE_REMOVEFOLDER = 'removef'
+    CH_TYPE_LINK = 'link'
 
     TYPE_TO_NAME_MAP = {
         CH_TYPE_UPDATE: "Update S => B",
@@ -876,7 +1929,8 @@ class ChangeTypes(object):
         CH_TYPE_CREATE: "Create S => B",
         CH_TYPE_CREATE_NOTS: "Create S <= B",
         CH_TYPE_FOLDER: "CreateFolder",
-        CH_TYPE_REMOVEFOLDER: "RemoveFolder"
+        CH_TYPE_REMOVEFOLDER: "RemoveFolder",
+        CH_TYPE_LINK: "Link B => B"
     }
 
     @staticmethod
@@ -887,98 +1941,272 @@ class ChangeTypes(object):
     def all_types() -> List[str]:
         return [y for x, y in ChangeTypes.__dict__.items() if x.startswith('CH_TYPE_')]
 
-class ChangeTypeTracker(object):
-    def __init__(self):
-        self.changes = set()
-
-    @property
-    def num_changes(self):
-        return len(self.changes)
-
-    @property
-    def has_changes(self):
-        return self.num_changes > 0
-
-    def add(self, item):
-        self.changes.add(item)
-
-    def remove(self, item):
-        self.changes.remove(item)
-
-    def __contains__(self, item):
-        return item in self.changes
+# Text log written from the records of every change type, types without one are only kept in the records
+CHANGE_LOG_FILE_NAMES = {
+    ChangeTypes.CH_TYPE_UPDATE: "updates.log",
+    ChangeTypes.CH_TYPE_RENAME: "renames.log",
+    ChangeTypes.CH_TYPE_CREATE: "additions.log",
+    ChangeTypes.CH_TYPE_REMOVE: "removals.log",
+    ChangeTypes.CH_TYPE_REMOVEFOLDER: "folderremovals.log",
+    ChangeTypes.CH_TYPE_FOLDER: "folders.log"
+}
+
+class LogSink(object):
+    """
+    Appends the log records of a run as JSON lines to records.jsonl in the log folder of the day while the run goes on
+    Records are buffered and flushed by a background thread every LOG_FLUSH_INTERVAL seconds, errors are flushed right away
+    """
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.path = os.path.join(folder, "records.jsonl")
+        self.file = None
+        # The file is shared by the runs of a day, records of this run start at this offset
+        self.start_offset: Optional[int] = None
+        # Records were written since the last flush
+        self.unflushed = False
+        self.closed = threading.Event()
+        self.lock = threading.Lock()
+
+    def open(self):
+        os.makedirs(self.folder, exist_ok=True)
+        self.file = open(self.path, "a", encoding="utf-8", buffering=2 ** 20)
+        self.closed.clear()
+        threading.Thread(target=self.run_flusher, name="log-flush", daemon=True).start()
+        if self.start_offset is None:
+            self.start_offset = self.file.tell()
+            if self.start_offset > 0:
+                with open(self.path, "rb") as f:
+                    f.seek(-1, os.SEEK_END)
+                    _cut = f.read(1) != b"\n"
+                if _cut:
+                    # The last record of a crashed run was cut, it must not swallow the first one of this run
+                    self.file.write("\n")
+                    self.start_offset += 1
+
+    def run_flusher(self):
+        while not self.closed.wait(LOG_FLUSH_INTERVAL):
+            with self.lock:
+                if self.file is not None and self.unflushed:
+                    self.file.flush()
+                    self.unflushed = False
+
+    def write(self, record: dict, *, flush: bool = False):
+        with self.lock:
+            if self.file is None:
+                self.open()
+            self.file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+            self.unflushed = not flush
+            if flush:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.closed.set()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def iter_records(self):
+        """
+        Yields the records written by this run, the file is streamed
+        """
+        if self.start_offset is None:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.start_offset)
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
 
 class ChangeTracker(object):
-    def __init__(self):
-        self.typetrackers: Dict[str, ChangeTypeTracker] = dict()
-        for t in ChangeTypes.all_types():
-            self.typetrackers[t] = ChangeTypeTracker()
-        self.log = list()
-        self.errors = list()
+    """
+    Counts the changes and errors of a run, the records themselves are written to the log sink instead of being kept
+    Only the last MAX_KEPT_ERRORS errors stay in memory for the summary screens
+    """
+    def __init__(self, sink: Optional[LogSink] = None):
+        self.sink = sink
+        self.changes_count: Dict[str, int] = dict((t, 0) for t in ChangeTypes.all_types())
+        self.num_errors = 0
+        self.recent_errors: Deque[str] = collections.deque(maxlen=MAX_KEPT_ERRORS)
+        # copy method -> [files, bytes]
+        self.copy_methods: Dict[str, List[int]] = dict()
+        # Changes are recorded from copy worker threads
+        self.lock = threading.Lock()
 
     @property
-    def sorted_changes(self):
-        return dict((x, y.changes) for x, y in self.typetrackers.items())
+    def sorted_changes_count(self):
+        return dict(self.changes_count)
 
     @property
-    def sorted_changes_count(self):
-        return dict((x, y.num_changes) for x, y in self.typetrackers.items())
+    def total_changes(self) -> int:
+        return sum(self.changes_count.values())
 
     def num_changes(self, c_type: str):
         if c_type not in ChangeTypes.all_types():
             raise TypeError(f"Incorrect type {c_type} passed.")
-        return self.typetrackers[c_type].num_changes
+        return self.changes_count[c_type]
 
     def has_changes(self, c_type: str):
-        if c_type not in ChangeTypes.all_types():
-            raise TypeError(f"Incorrect type {c_type} passed.")
-        return self.typetrackers[c_type].has_changes
+        return self.num_changes(c_type) > 0
 
-    @property
-    def num_errors(self):
-        return len(self.errors)
+    def _write_record(self, record: dict, *, flush: bool = False):
+        # Called with the lock held
+        if self.sink is not None:
+            self.sink.write(record, flush=flush)
 
     def add_log(self, log_text: str, end: str = "\n", should_print=True, wait_time: float = 0):
-        if should_print:
-            print(log_text, end=end)
-            if "\r" in end:
-                sys.stdout.flush()
-        self.log.append("\n{0}:\n{1}".format(notzformat.format(get_cur_dt()), log_text))
+        with self.lock:
+            if should_print:
+                print(log_text, end=end)
+                if "\r" in end:
+                    sys.stdout.flush()
+            self._write_record(dict(t=time.time(), kind="log", text=log_text))
         if wait_time != 0:
             time.sleep(wait_time)
 
     def add_error(self, error_text: str, wait_time: float = 0):
-        self.errors.append("\n{}".format(error_text))
-        if not launch_args.args.nooutput:
-            print(error_text)
-            if wait_time != 0:
-                time.sleep(wait_time)
+        with self.lock:
+            self.num_errors += 1
+            self.recent_errors.append(error_text)
+            self._write_record(dict(t=time.time(), kind="error", text=error_text), flush=True)
+            if not launch_args.args.nooutput:
+                print(error_text)
+        if not launch_args.args.nooutput and wait_time != 0:
+            time.sleep(wait_time)
 
-    def add_file_change(self, change_type: str, change_text: str, should_print=True, wait_time: float = 0):
-        try:
-            if change_type not in ChangeTypes.all_types():
-                raise TypeError(f"Change Type {change_type} is not a correct change type.")
-            _change = FileChange(change_type, change_text)
-        except TypeError:
+    def add_copy_method(self, method: str, size: int):
+        with self.lock:
+            _stats = self.copy_methods.setdefault(method, [0, 0])
+            _stats[0] += 1
+            _stats[1] += size
+
+    @property
+    def copy_methods_summary(self) -> str:
+        with self.lock:
+            return ", ".join("{0}: {1} file{2}({3})".format(x, y[0], "s" if y[0] != 1 else "", format_bytes(y[1]))
+                             for x, y in sorted(self.copy_methods.items(), key=lambda x: x[1][1], reverse=True))
+
+    def add_file_change(self, change_type: str, change_text: str, should_print=True, wait_time: float = 0, *, path: str = None, size: int = None, duration: float = None):
+        if change_type not in ChangeTypes.all_types():
             self.add_error("Incorrect file change type passed {}.".format(change_type), 2.0)
-        else:
+            return
+        _record = dict(t=time.time(), kind="change", type=change_type, text=change_text)
+        if path is not None:
+            _record['path'] = path
+        if size is not None:
+            _record['size'] = size
+        if duration is not None:
+            _record['duration'] = round(duration, 6)
+        with self.lock:
             if should_print:
                 print(change_text)
-            self.typetrackers[change_type].add(_change)
-            if wait_time != 0:
-                time.sleep(wait_time)
+            self.changes_count[change_type] += 1
+            self._write_record(_record)
+        if wait_time != 0:
+            time.sleep(wait_time)
+
+    def get_errors_text(self) -> str:
+        _skipped = self.num_errors - len(self.recent_errors)
+        return "\n".join(([f"{_skipped} earlier errors are only in the logs"] if _skipped > 0 else []) + list(self.recent_errors))
+
+    def write_text_logs(self):
+        """
+        Derives full.log, errors.log and the logs of every change type from the records of this run
+        """
+        with self.lock:
+            self.sink.close()
+            files = dict()
+            try:
+                for record in self.sink.iter_records():
+                    if record.get('kind') == "log":
+                        _name, _line = "full.log", "\n{0}:\n{1}".format(notzformat.format(datetime.datetime.fromtimestamp(record['t'], tz=shift_tz)), record['text'])
+                    elif record.get('kind') == "error":
+                        _name, _line = "errors.log", "\n{0}".format(record['text'])
+                    elif record.get('type') in CHANGE_LOG_FILE_NAMES:
+                        _name, _line = CHANGE_LOG_FILE_NAMES[record['type']], "{0}\n".format(record['text'])
+                    else:
+                        continue
+                    if _name not in files:
+                        files[_name] = open(os.path.join(self.sink.folder, _name), "a", encoding="utf-8")
+                    files[_name].write(_line)
+            finally:
+                for f in files.values():
+                    f.close()
+
+    def close(self):
+        with self.lock:
+            if self.sink is not None:
+                self.sink.close()
 
 class FileChangeInstruction(object):
-    def __init__(self, change_type: str, sourcefiledir: str, targetfilepath: str = None, *, is_forced: bool = False):
+    def __init__(self, change_type: str, sourcefiledir: str, targetfilepath: str = None, *, is_forced: bool = False, source_record: Optional[FileRecord] = None, target_record: Optional[FileRecord] = None, store: str = StoreTypes.S_TYPE_PLAIN):
         if change_type not in ChangeTypes.all_types():
             raise TypeError(f"Change Type {change_type} is not a correct change type.")
         self.change_type = change_type
+        # Store of the backup_dirs entry, dedup targets are linked to the dedup store, archive targets are members of an archive
+        self.store = store
         self.source = sourcefiledir
         self.target = targetfilepath
         self.is_forced = is_forced
+        self.source_record = source_record.detached() if source_record is not None else None
+        self.target_record = target_record.detached() if target_record is not None else None
+        # Set while a delta update runs, the amount of bytes rewritten in the target
+        self.bytes_written: Optional[int] = None
+
+    @staticmethod
+    def _get_stat(path: Optional[str], record: Optional[FileRecord]):
+        if record is not None:
+            return record.stat()
+        if path is None:
+            return None
+        try:
+            return os.stat(path)
+        except OSError:
+            return None
+
+    @cached_property
+    def source_stat(self) -> Union[os.stat_result, StatData, None]:
+        return self._get_stat(self.source, self.source_record)
+
+    @cached_property
+    def target_stat(self) -> Union[os.stat_result, StatData, None]:
+        return self._get_stat(self.target, self.target_record)
+
+    def refresh_source(self):
+        """
+        Restats the source right before it is copied, everything else uses the stat captured while scanning
+        """
+        try:
+            self.source_record = FileRecord(self.source, os.path.basename(self.source)).refreshed()
+        except OSError:
+            self.source_record = None
+        for _cached in ('source_stat', 'sourcesize', 'sourcemtime'):
+            self.__dict__.pop(_cached, None)
+
+    @property
+    def dedup(self) -> bool:
+        return self.store == StoreTypes.S_TYPE_DEDUP
+
+    @property
+    def archived(self) -> bool:
+        return self.store == StoreTypes.S_TYPE_ARCHIVE
+
+    @property
+    def use_delta(self) -> bool:
+        """
+        Updates of files larger than --delta-size only rewrite the changed blocks of the existing target
+        Only backup files are updated in place, sync mode updates of source files are always copied
+        """
+        delta_size = launch_args.args.delta_size
+        return (delta_size is not None and self.store == StoreTypes.S_TYPE_PLAIN and self.change_type == ChangeTypes.CH_TYPE_UPDATE
+                and self.sourcesize >= delta_size and self.targetsize > 0)
 
     @property
     def diffspace(self):
+        if self.change_type == ChangeTypes.CH_TYPE_LINK:
+            return 0
         return self.sourcesize - self.targetsize
 
     @property
@@ -987,35 +2215,19 @@ class FileChangeInstruction(object):
 
     @cached_property
     def sourcesize(self):
-        if self.source is None:
-            return 0
-        elif not os.path.exists(self.source):
-            return 0
-        return os.stat(self.source).st_size
+        return self.source_stat.st_size if self.source_stat is not None else 0
 
     @cached_property
     def targetsize(self):
-        if self.target is None:
-            return 0
-        elif not os.path.exists(self.target):
-            return 0
-        return os.stat(self.target).st_size
+        return self.target_stat.st_size if self.target_stat is not None else 0
 
     @cached_property
     def sourcemtime(self):
-        if self.source is None:
-            return 0
-        elif not os.path.exists(self.source):
-            return 0
-        return get_file_stat_data(self.source)['mtime']
+        return self.source_stat.st_mtime if self.source_stat is not None else 0
 
     @cached_property
     def targetmtime(self):
-        if self.target is None:
-            return 0
-        elif not os.path.exists(self.target):
-            return 0
-        return get_file_stat_data(self.target)['mtime']
+        return self.target_stat.st_mtime if self.target_stat is not None else 0
 
     def __hash__(self):
         return hash((self.change_type, self.source, self.target))
@@ -1029,54 +2241,62 @@ class FileChangeInstruction(object):
         return f"[{self.change_type}{'<F>' if self.is_forced else ''}]:{self.source} -> {self.target}"
 
 class InstructionStorage(object):
+    """
+    Planned changes indexed by change type, the number of changes and their byte totals are kept up to date
+    on every add and pop so summaries and scan status updates never walk the plan
+    """
     def __init__(self):
-        self.filechanges: Set[FileChangeInstruction] = set()
-        self.cache = {
-            "space_req": [0, False],
-            "bytes_to_mod": [0, False]
-        }
+        # change type: {instruction: (diffspace, diffsize) when it was added}
+        self.changes: Dict[str, Dict[FileChangeInstruction, tuple]] = dict((x, dict()) for x in ChangeTypes.all_types())
+        self.changes_num = 0
+        self.space_requirement = 0
+        self.bytes_to_modify = 0
 
-    @property
-    def space_requirement(self):
-        _cache = self.cache['space_req']
-        if _cache[1]:
-            return _cache[0]
-        _sum = sum(x.diffspace for x in self.filechanges)
-        _cache = [_sum, True]
-        return _sum
+    def count(self, *change_types: str) -> int:
+        return sum(len(self.changes[x]) for x in change_types)
 
-    @property
-    def bytes_to_modify(self):
-        _cache = self.cache['bytes_to_mod']
-        if _cache[1]:
-            return _cache[0]
-        _sum = sum(x.diffsize for x in self.filechanges)
-        _cache = [_sum, True]
-        return _sum
-
-    @property
-    def changes_num(self):
-        return len(self.filechanges)
+    def __iter__(self):
+        """
+        Iterates the changes grouped by change type without copying them, the storage must not change meanwhile
+        """
+        for change_type in sorted(self.changes.keys()):
+            yield from self.changes[change_type].keys()
 
-    def add_file_change(self, change_type: str, sourcefiledir: str, targetfiledir: Optional[str] = None, *, is_forced: bool = False):
+    def add_file_change(self, change_type: str, sourcefiledir: str, targetfiledir: Optional[str] = None, *, is_forced: bool = False, source_record: Optional[FileRecord] = None, target_record: Optional[FileRecord] = None, store: str = StoreTypes.S_TYPE_PLAIN):
         if change_type not in ChangeTypes.all_types():
             raise TypeError(f"Change Type {change_type} is not a correct change type.")
         if targetfiledir is None and change_type not in (ChangeTypes.CH_TYPE_REMOVE, ChangeTypes.CH_TYPE_REMOVEFOLDER):
             raise ValueError("Target File Directory can only be empty if change type is removal.")
-        self.filechanges.add(FileChangeInstruction(change_type=change_type, sourcefiledir=sourcefiledir, targetfilepath=targetfiledir, is_forced=is_forced))
-        self.invalidate_cache()
-
-    def invalidate_cache(self, key: str = None):
-        if key is not None and key in self.cache:
-            self.cache[key][1] = False
-        else:
-            for k in self.cache.keys():
-                self.cache[k][1] = False
+        self.add_instruction(FileChangeInstruction(change_type=change_type, sourcefiledir=sourcefiledir, targetfilepath=targetfiledir, is_forced=is_forced, source_record=source_record, target_record=target_record, store=store))
+
+    def add_instruction(self, instruction: FileChangeInstruction):
+        _changes = self.changes[instruction.change_type]
+        if instruction in _changes:
+            return
+        _changes[instruction] = (instruction.diffspace, instruction.diffsize)
+        self.changes_num += 1
+        self.space_requirement += instruction.diffspace
+        self.bytes_to_modify += instruction.diffsize
+
+    def take_batch(self):
+        """
+        Moves every stored instruction into a new InstructionStorage
+        """
+        batch = InstructionStorage()
+        batch.changes, self.changes = self.changes, batch.changes
+        batch.changes_num, batch.space_requirement, batch.bytes_to_modify = self.changes_num, self.space_requirement, self.bytes_to_modify
+        self.changes_num, self.space_requirement, self.bytes_to_modify = 0, 0, 0
+        return batch
 
     def get_file_change(self):
-        if self.changes_num <= 0:
-            return None
-        return self.filechanges.pop()
+        for _changes in self.changes.values():
+            if len(_changes) > 0:
+                instruction, (diffspace, diffsize) = _changes.popitem()
+                self.changes_num -= 1
+                self.space_requirement -= diffspace
+                self.bytes_to_modify -= diffsize
+                return instruction
+        return None
 
     def print_scan_status(self, header: str = "", cur_dir: str = "", cur_num: int = -1, total_num: int = -1, *, cur_file: str = None):
         ANSIEscape.set_cursor_pos(1, 1)
@@ -1097,10 +2317,129 @@ class InstructionStorage(object):
         ANSIEscape.set_cursor_pos(1, 6)
         print(f"Changes required: {self.changes_num}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
         for fct in ChangeTypes.all_types():
-            _specific_change_group_len = len(tuple(x for x in self.filechanges if x.change_type == fct))
+            _specific_change_group_len = self.count(fct)
             if _specific_change_group_len > 0:
                 print(f"{fct.title()}: {_specific_change_group_len}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
-        print(f"{cur_num}/{total_num} done. {get_progress_bar(round(cur_num/total_num , 2) * 100)}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
+        print(f"{cur_num}/{total_num} done. {get_progress_bar(round(cur_num / total_num if total_num > 0 else 1, 2) * 100)}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
+
+
+class ExecutionCheckpoint(object):
+    """
+    The plan of the running execution and the instructions finished so far, kept until the execution completes
+    so --resume can continue an interrupted run without scanning the sources again
+    Finished instructions are journaled in groups, each group only after the timestamp DB changes they made were committed
+    """
+    def __init__(self, storage_path: str = "db/checkpoint.json"):
+        self.storage_rel_path = storage_path
+        self.journal_rel_path = f"{storage_path}.journal"
+        # id(instruction): index in the plan
+        self.indexes: Dict[int, int] = dict()
+        self.finished: List[int] = list()
+        self.last_sync = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def storage(self):
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), self.storage_rel_path)
+
+    @property
+    def journal(self):
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), self.journal_rel_path)
+
+    @property
+    def exists(self) -> bool:
+        return os.path.exists(self.storage)
+
+    @staticmethod
+    def get_stat_list(stat_data: Union[os.stat_result, StatData, None]) -> Optional[list]:
+        return [stat_data.st_size, stat_data.st_mtime, stat_data.st_ctime] if stat_data is not None else None
+
+    @staticmethod
+    def get_record(path: Optional[str], stat_list: Optional[list]) -> Optional[FileRecord]:
+        if path is None or stat_list is None:
+            return None
+        return FileRecord(path, os.path.basename(path), stat_data=StatData(*stat_list))
+
+    @classmethod
+    def get_plan_entry(cls, instruction: FileChangeInstruction) -> list:
+        """
+        The instruction as stored in checkpoints and exported plans, stats are the ones captured while scanning
+        """
+        return [instruction.change_type, instruction.source, instruction.target, instruction.is_forced, instruction.store,
+                cls.get_stat_list(instruction.source_stat), cls.get_stat_list(instruction.target_stat)]
+
+    @classmethod
+    def get_instruction(cls, entry: list) -> FileChangeInstruction:
+        change_type, source, target, is_forced, store, source_stat, target_stat = entry
+        return FileChangeInstruction(change_type, source, target, is_forced=is_forced, store=store,
+                                     source_record=cls.get_record(source, source_stat), target_record=cls.get_record(target, target_stat))
+
+    def begin(self, instructions: List[FileChangeInstruction]):
+        with self.lock:
+            self.indexes = dict((id(x), n) for n, x in enumerate(instructions))
+            self.finished = list()
+            self.last_sync = time.time()
+        if not os.path.exists(os.path.dirname(self.storage)):
+            os.makedirs(os.path.dirname(self.storage), exist_ok=True)
+        with open(f"{self.storage}.tmp", "w+", encoding='utf-8') as f:
+            json.dump(dict(timestamp=time.time(),
+                           instructions=[self.get_plan_entry(x) for x in instructions]),
+                      f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{self.storage}.tmp", self.storage)
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+
+    def finish(self, instruction: FileChangeInstruction):
+        with self.lock:
+            _index = self.indexes.get(id(instruction), None)
+            if _index is None:
+                return
+            self.finished.append(_index)
+            _due = time.time() - self.last_sync >= CHECKPOINT_SYNC_INTERVAL
+        if _due:
+            self.sync()
+
+    def sync(self):
+        """
+        Commits the timestamp DB changes of the finished instructions, then journals them
+        """
+        with self.lock:
+            self.last_sync = time.time()
+            _finished, self.finished = self.finished, list()
+        if len(_finished) == 0:
+            return
+        modification_timestamp_db.flush()
+        with open(self.journal, "a", encoding='utf-8') as f:
+            f.writelines(f"{x}\n" for x in _finished)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def clear(self):
+        with self.lock:
+            self.indexes.clear()
+            self.finished = list()
+        for path in (self.storage, self.journal):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def load(self) -> List[FileChangeInstruction]:
+        """
+        Returns the instructions of the plan that were not journaled as finished
+        """
+        with open(self.storage, "r", encoding='utf-8') as f:
+            plan = json.load(f).get('instructions', list())
+        finished = set()
+        if os.path.exists(self.journal):
+            with open(self.journal, "r", encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        finished.add(int(line))
+                    except ValueError:
+                        # Line cut short by a crash
+                        break
+        return [self.get_instruction(x) for n, x in enumerate(plan) if n not in finished]
 
 
 def del_file_or_dir(path):
@@ -1141,73 +2480,1198 @@ def get_path_reduction(source_data: Dict[str, Union[str, int]]):
     path_red = path_reduction if override_path_reduction is None else override_path_reduction
     return None if (path_red is None or (path_red is not None and path_red == 0)) else path_red
 
-def get_bkp_path(path, source_data: Dict[str, str]):
-    subpath: Optional[str] = source_data.get("subpath", "")
-    _nodrive_path = os.path.splitdrive(path)[1].replace("\\", "/")
-    _path_parts = [x for x in _nodrive_path.split("/") if len(x) > 0]
-    return os.path.join(bkp_root, subpath, *_path_parts[get_path_reduction(source_data):]).replace("\\", "/")
+def get_store(source_data: Dict[str, Union[str, int]]):
+    """
+    Returns the store used for a backup_dirs entry, stores that do not work with the entry mode fall back to plain copies
+    """
+    store = source_data.get("store", StoreTypes.S_TYPE_PLAIN)
+    mode = source_data.get("mode", ManageModes.M_MODE_DEFAULT)
+    if store not in StoreTypes.all_types() or (store != StoreTypes.S_TYPE_PLAIN and mode == ManageModes.M_MODE_SYNC) or (store == StoreTypes.S_TYPE_ARCHIVE and mode == ManageModes.M_MODE_VERSIONED):
+        return StoreTypes.S_TYPE_PLAIN
+    return store
+
+def get_compare(source_data: Dict[str, Union[str, int]]):
+    """
+    Returns how changed files of a backup_dirs entry are detected, checksums are compared in default and snapshot mode
+    of plain and dedup entries, everything else compares modification times
+    """
+    compare = source_data.get("compare", CompareTypes.C_TYPE_MTIME)
+    if compare not in CompareTypes.all_types() or (compare == CompareTypes.C_TYPE_CHECKSUM and (
+            source_data.get("mode", ManageModes.M_MODE_DEFAULT) not in (ManageModes.M_MODE_DEFAULT, ManageModes.M_MODE_SNAPSHOT) or get_store(source_data) == StoreTypes.S_TYPE_ARCHIVE)):
+        return CompareTypes.C_TYPE_MTIME
+    return compare
+
+def is_content_changed(source: FileRecord, backup: FileRecord) -> bool:
+    """
+    Compares the content hashes of a source file and its backup, runs on hash worker threads
+    """
+    if source.stat().st_size != backup.stat().st_size:
+        return True
+    source_stat = source.stat()
+    return hash_cache.get_hash(source.path, source_stat if isinstance(source_stat, os.stat_result) else None) != hash_cache.get_hash(backup.path, backup.stat())
+
+def get_bkp_path(path, source_data: Dict[str, str]):
+    subpath: Optional[str] = source_data.get("subpath", "")
+    _nodrive_path = os.path.splitdrive(path)[1].replace("\\", "/")
+    _path_parts = [x for x in _nodrive_path.split("/") if len(x) > 0]
+    return os.path.join(bkp_root, subpath, *_path_parts[get_path_reduction(source_data):]).replace("\\", "/")
+
+def list_snapshots(snapshots_root: str) -> List[str]:
+    """
+    Returns the names of the versioned mode snapshots in snapshots_root, oldest first
+    """
+    if not os.path.isdir(snapshots_root):
+        return []
+    with os.scandir(snapshots_root) as it:
+        return sorted(x.name for x in it if x.is_dir(follow_symlinks=False) and SNAPSHOT_NAME_RE.match(x.name) is not None)
+
+def get_retained_snapshots(snapshots: List[str], retention: Dict[str, int]) -> Set[str]:
+    """
+    Applies a keep last/daily/weekly/monthly retention policy, the newest snapshot of every period is kept
+    until the number of periods of that kind is reached. The latest snapshot is always kept
+    """
+    periods = {
+        "last": lambda x: x,
+        "daily": lambda x: x.date(),
+        "weekly": lambda x: x.isocalendar()[:2],
+        "monthly": lambda x: (x.year, x.month)
+    }
+    keep = set(snapshots[-1:])
+    dated = [(x, datetime.datetime.strptime(x, SNAPSHOT_NAME_FORMAT)) for x in reversed(snapshots)]
+    for period, get_key in periods.items():
+        _count = retention.get(period, 0) or 0
+        _seen = set()
+        for name, dt in dated:
+            if len(_seen) >= _count:
+                break
+            _key = get_key(dt)
+            if _key not in _seen:
+                _seen.add(_key)
+                keep.add(name)
+    return keep
+
+def prune_snapshots(source_data: Dict[str, Union[str, int]]) -> int:
+    """
+    Removes the snapshots of a versioned backup_dirs entry its retention policy does not keep, returns their number
+    Files in snapshots are hardlinks, removing a snapshot only frees the data no other snapshot links to
+    """
+    retention: Optional[Dict[str, int]] = source_data.get("retention", None)
+    if not retention:
+        return 0
+    snapshots_root = get_bkp_path(source_data.get('path'), source_data)
+    snapshots = list_snapshots(snapshots_root)
+    keep = get_retained_snapshots(snapshots, retention)
+    pruned = 0
+    for name in snapshots:
+        if name in keep:
+            continue
+        _snapshot = os.path.join(snapshots_root, name).replace("\\", "/")
+        backup_manifest.mark_dirty()
+        for rec in backup_manifest.iter_under(_snapshot):
+            modification_timestamp_db.remove_timestamp(rec.path)
+        shutil.rmtree(_snapshot, ignore_errors=True)
+        backup_manifest.remove_under(_snapshot)
+        integrity_manifest.remove_under(_snapshot)
+        change_tracker.add_file_change(ChangeTypes.CH_TYPE_REMOVEFOLDER, "Pruned snapshot {0}".format(_snapshot), should_print=False, path=_snapshot)
+        pruned += 1
+    return pruned
+
+def get_src_path(bkpp: str, source_data: Dict[str, str]):
+    path: str = source_data.get("path")
+    _subp = bkpp.replace("\\", "/")[len(source_data.get("subpath", "")) + len(bkp_root) + 1:]
+    if get_path_reduction(source_data) is not None:
+        _path_red = get_path_reduction(source_data) + 1 if get_path_reduction(source_data) is not None else None
+        _bkpdir = os.path.join(*path.split("/")[_path_red:]).replace("\\", "/")
+        bkpdir_ind = path.find(_bkpdir)
+        if len(_bkpdir) > 0 and bkpdir_ind != -1:
+            _fixed_sourcedir = path[:bkpdir_ind] + path[bkpdir_ind + len(_bkpdir):]
+        else:
+            _fixed_sourcedir = path
+    else:
+        _drive = os.path.splitdrive(path)[0]
+        _fixed_sourcedir = f"{_drive}/" if len(_drive) > 0 else "/"
+    _p = os.path.join(_fixed_sourcedir, _subp[1 if _subp.startswith("/") else None:]).replace("\\", "/")
+    return _p
+
+class _IgnoreTrieNode(object):
+    __slots__ = ('children', 'prefixes', 'terminal')
+
+    def __init__(self):
+        self.children: Dict[str, _IgnoreTrieNode] = dict()
+        self.prefixes: tuple = ()
+        self.terminal = False
+
+class IgnoreMatcher(object):
+    """
+    Compiled form of the ignored_paths of a backup_dirs entry, matches paths relative to the root it was compiled for
+    Plain rules keep the old string prefix behaviour and are stored in a trie of path components,
+    rules containing *, ? or [ are globs (** crosses folders, rules without a slash match names at any depth),
+    *.ext rules are checked against a set of extensions and >4GiB / <1KiB rules filter files by size
+    """
+    SIZE_RULE_RE = re.compile(r"^([<>])\s*(\d+(?:\.\d+)?\s*(?:[KMGTP]i?)?B?)$", re.IGNORECASE)
+    EXTENSION_RULE_RE = re.compile(r"^\*(\.[^*?\[\]/.]+)$")
+
+    def __init__(self, rules: List[str], root: str):
+        self.root = root.replace('\\', '/').rstrip('/')
+        self.trie = _IgnoreTrieNode()
+        self.extensions = set()
+        self.min_size: Optional[int] = None
+        self.max_size: Optional[int] = None
+        _path_globs = list()
+        _name_globs = list()
+        for rule in rules:
+            rule = rule.replace('\\', '/')
+            if os.path.isabs(rule) or len(os.path.splitdrive(rule)[0]) > 0:
+                # Absolute rules only apply if they point inside of this root
+                if not (rule + "/").startswith(self.root + "/") and rule != self.root:
+                    continue
+                rule = rule[len(self.root):]
+            rule = rule[2:] if rule.startswith("./") else rule
+            rule = rule.lstrip('/') if len(rule) > 1 else rule
+            _size_rule = self.SIZE_RULE_RE.match(rule)
+            _ext_rule = self.EXTENSION_RULE_RE.match(rule)
+            if _size_rule is not None:
+                _size = parse_size(_size_rule.group(2))
+                if _size_rule.group(1) == ">":
+                    self.max_size = _size if self.max_size is None else min(self.max_size, _size)
+                else:
+                    self.min_size = _size if self.min_size is None else max(self.min_size, _size)
+            elif _ext_rule is not None:
+                self.extensions.add(os.path.normcase(_ext_rule.group(1)))
+            elif any(c in rule for c in "*?["):
+                if "/" in rule.rstrip("/"):
+                    _path_globs.append(self.glob_to_regex(os.path.normcase(rule.rstrip("/"))))
+                else:
+                    _name_globs.append(self.glob_to_regex(os.path.normcase(rule.rstrip("/"))))
+            else:
+                self.add_prefix_rule(rule)
+        self.path_glob = re.compile("|".join(f"(?:{x})" for x in _path_globs)) if len(_path_globs) > 0 else None
+        self.name_glob = re.compile("|".join(f"(?:{x})" for x in _name_globs)) if len(_name_globs) > 0 else None
+
+    @staticmethod
+    def glob_to_regex(pattern: str) -> str:
+        i, n = 0, len(pattern)
+        res = list()
+        while i < n:
+            c = pattern[i]
+            if pattern.startswith("**/", i):
+                res.append("(?:.*/)?")
+                i += 3
+                continue
+            elif pattern.startswith("**", i):
+                res.append(".*")
+                i += 2
+                continue
+            elif c == '*':
+                res.append("[^/]*")
+            elif c == '?':
+                res.append("[^/]")
+            elif c == '[':
+                j = pattern.find(']', i + 2 if pattern.startswith("[!", i) else i + 1)
+                if j == -1:
+                    res.append(re.escape(c))
+                else:
+                    _class = pattern[i + 1:j].replace('\\', '\\\\')
+                    res.append(f"[{'^' + _class[1:] if _class.startswith('!') else _class}]")
+                    i = j
+            else:
+                res.append(re.escape(c))
+            i += 1
+        return "".join(res) + r"(?:/.*)?\Z"
+
+    def add_prefix_rule(self, rule: str):
+        *folders, last = rule.split("/")
+        node = self.trie
+        for folder in folders:
+            node = node.children.setdefault(folder, _IgnoreTrieNode())
+        if len(last) == 0:
+            node.terminal = True
+        elif last not in node.prefixes:
+            node.prefixes = node.prefixes + (last,)
+
+    def _match_prefix(self, relpath: str) -> bool:
+        node = self.trie
+        for comp in relpath.split("/"):
+            if node.terminal or (len(node.prefixes) > 0 and comp.startswith(node.prefixes)):
+                return True
+            node = node.children.get(comp, None)
+            if node is None:
+                return False
+        return node.terminal
+
+    def _match_path(self, relpath: str, name: str) -> bool:
+        if self._match_prefix(relpath):
+            return True
+        if self.name_glob is not None and self.name_glob.match(os.path.normcase(name)) is not None:
+            return True
+        if self.path_glob is not None and self.path_glob.match(os.path.normcase(relpath)) is not None:
+            return True
+        return False
+
+    def is_ignored_dir(self, relpath: str, name: str) -> bool:
+        return self._match_path(relpath, name)
+
+    def is_ignored_file(self, relpath: str, name: str, entry: Optional[os.DirEntry] = None) -> bool:
+        if self._match_path(relpath, name):
+            return True
+        if len(self.extensions) > 0 and os.path.normcase(os.path.splitext(name)[1]) in self.extensions:
+            return True
+        if entry is not None and (self.max_size is not None or self.min_size is not None):
+            _size = entry.stat().st_size
+            if (self.max_size is not None and _size > self.max_size) or (self.min_size is not None and _size < self.min_size):
+                return True
+        return False
+
+    def is_ignored_relpath(self, relpath: str, entry: Union[os.DirEntry, FileRecord, None] = None) -> bool:
+        """
+        Checks a file path without walking to it, every parent folder is checked the way the walker would prune it
+        """
+        *folders, name = relpath.split("/")
+        for n, folder in enumerate(folders):
+            if self.is_ignored_dir("/".join(folders[:n + 1]), folder):
+                return True
+        return self.is_ignored_file(relpath, name, entry)
+
+def get_ignore_matcher(source_data: Dict[str, Union[str, int]], root: str) -> Optional[IgnoreMatcher]:
+    ignored_paths_var = source_data.get("ignored_paths", ())
+    if ignored_paths_var is None or len(ignored_paths_var) == 0:
+        return None
+    return IgnoreMatcher(ignored_paths_var, root)
+
+class ScanCache(object):
+    """
+    Persistent cache of source directory listings keyed on the directory mtime/ctime
+    A directory whose metadata did not change since the last scan is not read again, its files are only restated,
+    in trust_dir_mtime mode the cached file stats are reused as well which misses files modified in place
+    Only directories visited during the last completed scan are kept
+    """
+    def __init__(self, storage_path: str = "db/scan_cache.json", *, trust_dir_mtime: bool = False):
+        self.storage_rel_path = storage_path
+        self.trust_dir_mtime = trust_dir_mtime
+        # path: [mtime_ns, ctime_ns, {filename: [size, mtime, ctime]}, [subfolder names]]
+        self.dirs: Dict[str, list] = dict()
+        self.visited: Dict[str, list] = dict()
+        # Directories read from the cache and read from the disk, counted by the scan worker threads
+        self.hits = 0
+        self.misses = 0
+        self.stats_lock = threading.Lock()
+        self.load()
+
+    def count(self, hit: bool):
+        with self.stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    @property
+    def storage(self):
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), self.storage_rel_path)
+
+    def get_listing(self, cur_dir: str):
+        """
+        Returns ([(filename, stat), ...], [subfolder names]) or None on a cache miss and the stat of the directory
+        """
+        key = cur_dir.replace("\\", "/")
+        try:
+            dir_stat = os.stat(cur_dir)
+        except OSError:
+            return None, None
+        _cached = self.visited.get(key, None) or self.dirs.get(key, None)
+        if _cached is None or _cached[0] != dir_stat.st_mtime_ns or _cached[1] != dir_stat.st_ctime_ns:
+            self.count(False)
+            return None, dir_stat
+        _files = list()
+        for name, fdata in _cached[2].items():
+            if self.trust_dir_mtime:
+                _files.append((name, StatData(*fdata)))
+            else:
+                try:
+                    _stat = os.stat(os.path.join(cur_dir, name))
+                except OSError:
+                    # Listing is stale even though the folder metadata is not
+                    self.count(False)
+                    return None, dir_stat
+                _cached[2][name] = [_stat.st_size, _stat.st_mtime, _stat.st_ctime]
+                _files.append((name, _stat))
+        self.visited[key] = _cached
+        self.count(True)
+        return (_files, _cached[3]), dir_stat
+
+    def store_listing(self, cur_dir: str, dir_stat: os.stat_result, files: Dict[str, os.stat_result], subdirs: List[str]):
+        self.visited[cur_dir.replace("\\", "/")] = [dir_stat.st_mtime_ns, dir_stat.st_ctime_ns,
+                                                     dict((name, [st.st_size, st.st_mtime, st.st_ctime]) for name, st in files.items()),
+                                                     subdirs]
+
+    def load(self):
+        if not os.path.exists(self.storage):
+            return
+        try:
+            with open(self.storage, "r", encoding='utf-8') as f:
+                self.dirs = json.load(f).get('dirs', dict())
+        except (json.JSONDecodeError, OSError):
+            self.dirs = dict()
+
+    def save(self):
+        self.dirs = self.visited
+        self.visited = dict()
+        if not os.path.exists(os.path.dirname(self.storage)):
+            os.makedirs(os.path.dirname(self.storage), exist_ok=True)
+        with open(self.storage, "w+", encoding='utf-8') as f:
+            json.dump(dict(timestamp=time.time(), dirs=self.dirs), f, separators=(',', ':'))
+
+class DeltaUndoLog(object):
+    """
+    The previous contents of the blocks a delta update overwrites, written and synced before the blocks are overwritten
+    A JSON header line with the path, size and times of the file is followed by records of offset, length and the old data
+    """
+    RECORD_HEADER = struct.Struct("<QI")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def create(self, target: str, file_stat: os.stat_result):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, "wb")
+        self.file.write(json.dumps(dict(path=target, size=file_stat.st_size, atime_ns=file_stat.st_atime_ns, mtime_ns=file_stat.st_mtime_ns)).encode('utf-8') + b"\n")
+        self.sync()
+
+    def add(self, offset: int, data: bytes):
+        self.file.write(self.RECORD_HEADER.pack(offset, len(data)))
+        self.file.write(data)
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def replay(self):
+        """
+        Writes the old blocks back, restores the size and times of the file and removes the log
+        Raises OSError or ValueError if the log is missing or unusable
+        """
+        with open(self.path, "rb") as f:
+            header = json.loads(f.readline())
+            with open(header['path'], "r+b") as fdst:
+                outfd = fdst.fileno()
+                while True:
+                    _head = f.read(self.RECORD_HEADER.size)
+                    if len(_head) < self.RECORD_HEADER.size:
+                        break
+                    offset, length = self.RECORD_HEADER.unpack(_head)
+                    data = f.read(length)
+                    if len(data) < length:
+                        # Record cut by the crash, its block was not overwritten before the log was synced
+                        break
+                    _view = memoryview(data)
+                    while len(_view) > 0:
+                        n = os.pwrite(outfd, _view, offset + length - len(_view))
+                        _view = _view[n:]
+                os.ftruncate(outfd, header['size'])
+                os.fsync(outfd)
+            os.utime(header['path'], ns=(header['atime_ns'], header['mtime_ns']))
+        os.remove(self.path)
+
+class BlockHashCache(object):
+    """
+    Persistent per-file block checksums used by delta updates, an entry is only used while the file size and mtime match
+    Files being modified in place are listed in a journal next to the cache until their update finished, the blocks
+    they overwrite are kept in an undo log per file. recover() restores files left in the journal by an interrupted run
+    to their previous version, files without a usable undo log are marked outdated so they are rewritten
+    The checksums are only loaded once a delta update needs them
+    """
+    def __init__(self, storage_path: str = "db/block_hashes.json"):
+        self.storage_rel_path = storage_path
+        self.journal_rel_path = f"{storage_path}.journal"
+        # path: [size, mtime_ns, block_size, [block hashes]]
+        self.files: Dict[str, list] = dict()
+        self.loaded = False
+        self.in_progress: Set[str] = set()
+        self.unsaved_changes = 0
+        self.lock = threading.RLock()
+
+    @property
+    def storage(self):
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), self.storage_rel_path)
+
+    @property
+    def journal(self):
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), self.journal_rel_path)
+
+    @staticmethod
+    def normalize(path: str) -> str:
+        return path.replace("\\", "/")
+
+    def get_hashes(self, path: str, file_stat: os.stat_result, block_size: int) -> Optional[List[str]]:
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            _cached = self.files.get(self.normalize(path), None)
+        if _cached is None or _cached[0] != file_stat.st_size or _cached[1] != file_stat.st_mtime_ns or _cached[2] != block_size:
+            return None
+        return _cached[3]
+
+    def store_hashes(self, path: str, file_stat: os.stat_result, block_size: int, hashes: List[str]):
+        with self.lock:
+            self.files[self.normalize(path)] = [file_stat.st_size, file_stat.st_mtime_ns, block_size, hashes]
+            self.unsaved_changes += 1
+
+    def remove(self, path: str):
+        with self.lock:
+            if self.files.pop(self.normalize(path), None) is not None:
+                self.unsaved_changes += 1
+
+    def get_undo_path(self, path: str) -> str:
+        return os.path.join(f"{self.journal}.undo", "{0}.undo".format(hashlib.blake2b(self.normalize(path).encode('utf-8'), digest_size=16).hexdigest()))
+
+    def begin_update(self, path: str, file_stat: os.stat_result) -> "DeltaUndoLog":
+        undo = DeltaUndoLog(self.get_undo_path(path))
+        undo.create(path, file_stat)
+        with self.lock:
+            self.in_progress.add(self.normalize(path))
+            self.write_journal()
+        return undo
+
+    def end_update(self, path: str, undo: "DeltaUndoLog"):
+        undo.close()
+        with self.lock:
+            self.in_progress.discard(self.normalize(path))
+            self.write_journal()
+        undo.remove()
+
+    def abort_update(self, path: str, undo: "DeltaUndoLog"):
+        """
+        Restores a file whose delta update failed, it stays journaled for recover() if that fails as well
+        """
+        undo.close()
+        try:
+            undo.replay()
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            self.in_progress.discard(self.normalize(path))
+            self.write_journal()
+
+    def write_journal(self):
+        if len(self.in_progress) == 0:
+            if os.path.exists(self.journal):
+                os.remove(self.journal)
+            return
+        if not os.path.exists(os.path.dirname(self.journal)):
+            os.makedirs(os.path.dirname(self.journal), exist_ok=True)
+        with open(self.journal, "w+", encoding='utf-8') as f:
+            json.dump(sorted(self.in_progress), f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def recover(self):
+        """
+        Restores files whose delta update was interrupted from their undo logs, files that cannot be restored are marked outdated
+        Returns the paths of the restored files and of the outdated ones
+        """
+        if not os.path.exists(self.journal):
+            return [], []
+        try:
+            with open(self.journal, "r", encoding='utf-8') as f:
+                interrupted = json.load(f)
+        except (json.JSONDecodeError, OSError):
+            interrupted = list()
+        restored, outdated = list(), list()
+        for path in interrupted:
+            self.remove(path)
+            if not os.path.exists(path):
+                continue
+            try:
+                DeltaUndoLog(self.get_undo_path(path)).replay()
+                restored.append(path)
+            except (OSError, ValueError):
+                mark_outdated(path)
+                outdated.append(path)
+        os.remove(self.journal)
+        shutil.rmtree(f"{self.journal}.undo", ignore_errors=True)
+        return restored, outdated
+
+    def load(self):
+        self.loaded = True
+        if not os.path.exists(self.storage):
+            return
+        try:
+            with open(self.storage, "r", encoding='utf-8') as f:
+                self.files = json.load(f).get('files', dict())
+        except (json.JSONDecodeError, OSError):
+            self.files = dict()
+
+    def save(self):
+        with self.lock:
+            if not self.loaded:
+                return
+            self.files = dict((x, y) for x, y in self.files.items() if os.path.exists(x))
+            if not os.path.exists(os.path.dirname(self.storage)):
+                os.makedirs(os.path.dirname(self.storage), exist_ok=True)
+            with open(self.storage, "w+", encoding='utf-8') as f:
+                json.dump(dict(timestamp=time.time(), files=self.files), f, separators=(',', ':'))
+            self.unsaved_changes = 0
+
+def get_file_hash(path: str) -> str:
+    _hash = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        for _block in iter(partial(f.read, DELTA_BLOCK_SIZE), b''):
+            _hash.update(_block)
+    return _hash.hexdigest()
+
+class HashCache(object):
+    """
+    Persistent cache of file content hashes, a hash is reused while the file identity it was taken with still matches
+    Files are identified by their size, mtime and ctime, for backup files the ones recorded in the backup manifest since
+    the backup is only written by this script. Inode and device are left out, DirEntry.stat() reports them as 0 on Windows
+    Entries of files that were not looked up during a run are kept only while the file exists
+    """
+    def __init__(self, storage_path: str = "db/hash_cache.json"):
+        self.storage_rel_path = storage_path
+        # path: [identity, hash]
+        self.files: Dict[str, list] = dict()
+        self.visited: Set[str] = set()
+        self.loaded = False
+        self.unsaved_changes = 0
+        # Hashes reused and files read, counted by the hash worker threads
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    @property
+    def storage(self):
+        return os.path.join(os.path.dirname(os.path.realpath(__file__)), self.storage_rel_path)
+
+    @staticmethod
+    def get_identity(stat_data: Union[os.stat_result, StatData]) -> list:
+        # The same fields for scan, os.stat() and cached stats, a file keeps its identity whichever of them it was looked up with
+        return [stat_data.st_size, stat_data.st_mtime, stat_data.st_ctime]
+
+    def get_cached_hash(self, path: str, stat_data: Union[os.stat_result, StatData]) -> Optional[str]:
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            path = path.replace("\\", "/")
+            self.visited.add(path)
+            _cached = self.files.get(path, None)
+        if _cached is None or _cached[0] != self.get_identity(stat_data):
+            return None
+        return _cached[1]
+
+    def store_hash(self, path: str, stat_data: Union[os.stat_result, StatData], digest: str):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            path = path.replace("\\", "/")
+            self.visited.add(path)
+            self.files[path] = [self.get_identity(stat_data), digest]
+            self.unsaved_changes += 1
+
+    def get_hash(self, path: str, stat_data: Union[os.stat_result, StatData, None] = None) -> str:
+        """
+        Returns the content hash of path, the file is only read if its identity changed since it was last hashed
+        Without stat_data the file is stated, StatData identifies backup files by their manifest record
+        """
+        if stat_data is None:
+            stat_data = os.stat(path)
+        digest = self.get_cached_hash(path, stat_data)
+        with self.lock:
+            if digest is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if digest is not None:
+            return digest
+        digest = get_file_hash(path)
+        self.store_hash(path, stat_data, digest)
+        return digest
+
+    def copy_hash(self, source: str, source_stat: Union[os.stat_result, StatData, None], target: str, target_stat: Union[os.stat_result, StatData]):
+        """
+        Records the hash of a copied source for its copy if the source did not change since it was hashed
+        """
+        if not self.loaded or source_stat is None:
+            return
+        digest = self.get_cached_hash(source, source_stat)
+        if digest is not None:
+            self.store_hash(target, target_stat, digest)
+
+    def load(self):
+        self.loaded = True
+        if not os.path.exists(self.storage):
+            return
+        try:
+            with open(self.storage, "r", encoding='utf-8') as f:
+                self.files = json.load(f).get('files', dict())
+        except (json.JSONDecodeError, OSError):
+            self.files = dict()
+
+    def save(self):
+        with self.lock:
+            if not self.loaded:
+                return
+            self.files = dict((x, y) for x, y in self.files.items() if x in self.visited or os.path.exists(x))
+            if not os.path.exists(os.path.dirname(self.storage)):
+                os.makedirs(os.path.dirname(self.storage), exist_ok=True)
+            with open(self.storage, "w+", encoding='utf-8') as f:
+                json.dump(dict(timestamp=time.time(), files=self.files), f, separators=(',', ':'))
+            self.unsaved_changes = 0
+
+class IntegrityManifest(object):
+    """
+    Content hashes of backup files recorded when --verify confirmed a copy or a scrub read the file
+    It is kept with the backup so a scrub only has to read the backup drive
+    Records are dropped whenever their file is rewritten or removed without being verified
+    """
+    def __init__(self, storage_path: str):
+        self.storage = storage_path
+        # path: [size, mtime, hash, verification timestamp]
+        self.files: Dict[str, list] = dict()
+        self.loaded = False
+        self.unsaved_changes = 0
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def normalize(path: str) -> str:
+        return path.replace("\\", "/")
+
+    def get(self, path: str) -> Optional[list]:
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            return self.files.get(self.normalize(path), None)
+
+    def record(self, path: str, stat_data: Union[os.stat_result, StatData], digest: str):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            self.files[self.normalize(path)] = [stat_data.st_size, stat_data.st_mtime, digest, time.time()]
+            self.unsaved_changes += 1
+
+    def remove(self, path: str):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            if self.files.pop(self.normalize(path), None) is not None:
+                self.unsaved_changes += 1
+
+    def remove_under(self, root: str):
+        with self.lock:
+            for path in self.iter_under(root):
+                self.remove(path)
+
+    def iter_under(self, root: str) -> List[str]:
+        root = self.normalize(root)
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            return [x for x in self.files.keys() if x == root or x.startswith(root + "/")]
+
+    def load(self):
+        self.loaded = True
+        if not os.path.exists(self.storage):
+            return
+        try:
+            with open(self.storage, "r", encoding='utf-8') as f:
+                self.files = json.load(f).get('files', dict())
+        except (json.JSONDecodeError, OSError):
+            change_tracker.add_error(f"Integrity manifest {self.storage} is unreadable, it will be recreated.", wait_time=2)
+            self.files = dict()
+
+    def save(self):
+        with self.lock:
+            if not self.loaded:
+                return
+            os.makedirs(os.path.dirname(os.path.abspath(self.storage)), exist_ok=True)
+            with open(self.storage + ".tmp", "w+", encoding='utf-8') as f:
+                json.dump(dict(timestamp=time.time(), files=self.files), f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.storage + ".tmp", self.storage)
+            self.unsaved_changes = 0
+
+class DedupStore(object):
+    """
+    Content addressed store of "store": "dedup" backup_dirs entries
+    Every distinct file content is written once into objects/ named by its blake2b hash,
+    the backup tree of such entries is a farm of hardlinks to these objects
+    Objects no backup file links to anymore are removed by collect_garbage()
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        self.lock = threading.Lock()
+
+    def object_path(self, digest: str) -> str:
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def store(self, src: str, dst: str, *, callback: Callable[[int, int], None] = None):
+        """
+        Links dst to the object holding the content of src, the object is only written if it is not stored yet
+        Returns dst and the copy method used
+        """
+        src_stat = os.stat(src)
+        digest = hash_cache.get_hash(src, src_stat)
+        obj = self.object_path(digest)
+        method = CopyMethods.CP_METHOD_HARDLINK
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            _tmp = f"{obj}.{threading.get_ident()}.tmp"
+            _, method = copy_with_callback(src, _tmp, callback=callback)
+            _tmp_stat = os.stat(_tmp)
+            if _tmp_stat.st_size != src_stat.st_size or _tmp_stat.st_mtime_ns != src_stat.st_mtime_ns:
+                # Source changed while it was hashed, name the object after what was copied
+                obj = self.object_path(get_file_hash(_tmp))
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+            os.replace(_tmp, obj)
+        elif callback is not None:
+            callback(src_stat.st_size, src_stat.st_size)
+        _link = f"{dst}.{threading.get_ident()}.dedup"
+        try:
+            os.link(obj, _link)
+        except OSError as _e:
+            if _e.errno != errno.EMLINK:
+                raise
+            # Object reached the hardlink limit of the filesystem, this file gets its own copy
+            _, method = copy_with_callback(obj, _link)
+        os.replace(_link, dst)
+        return dst, method
+
+    def discard(self, digest: str, path: str):
+        """
+        Removes the object of digest if path links to it, used for objects found corrupt so they are not linked again
+        """
+        obj = self.object_path(digest)
+        try:
+            if os.path.samefile(obj, path):
+                os.remove(obj)
+        except OSError:
+            pass
+
+    def collect_garbage(self):
+        """
+        Removes objects without links from the backup tree, returns the number of removed objects and their size
+        """
+        removed, freed = 0, 0
+        if not os.path.exists(self.objects):
+            return removed, freed
+        with self.lock:
+            for prefix in os.scandir(self.objects):
+                if not prefix.is_dir(follow_symlinks=False):
+                    continue
+                for obj in os.scandir(prefix.path):
+                    try:
+                        # DirEntry.stat() reports st_nlink as 0 on Windows, the link count needs a real stat
+                        _stat = os.stat(obj.path, follow_symlinks=False)
+                        if _stat.st_nlink <= 1 and not obj.name.endswith(".tmp"):
+                            os.remove(obj.path)
+                            removed += 1
+                            freed += _stat.st_size
+                    except OSError:
+                        pass
+        return removed, freed
+
+class ArchiveCompressions(object):
+    A_COMP_NONE = 'none'
+    A_COMP_ZLIB = 'zlib'
+    A_COMP_LZMA = 'lzma'
+    A_COMP_BZ2 = 'bz2'
+
+    # Members are standalone gzip/xz/bz2 streams, an archive extracted with tar yields files that can be decompressed normally
+    SUFFIXES = {
+        A_COMP_NONE: "",
+        A_COMP_ZLIB: ".gz",
+        A_COMP_LZMA: ".xz",
+        A_COMP_BZ2: ".bz2"
+    }
+
+    @staticmethod
+    def all_types() -> List[str]:
+        return [y for x, y in ArchiveCompressions.__dict__.items() if x.startswith('A_COMP_')]
+
+    @staticmethod
+    def get_compressor(compression: str):
+        if compression == ArchiveCompressions.A_COMP_ZLIB:
+            import zlib
+            return zlib.compressobj(6, zlib.DEFLATED, 31)
+        elif compression == ArchiveCompressions.A_COMP_LZMA:
+            import lzma
+            return lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+        elif compression == ArchiveCompressions.A_COMP_BZ2:
+            import bz2
+            return bz2.BZ2Compressor(9)
+        return None
+
+    @staticmethod
+    def get_decompressor(compression: str):
+        if compression == ArchiveCompressions.A_COMP_ZLIB:
+            import zlib
+            return zlib.decompressobj(31)
+        elif compression == ArchiveCompressions.A_COMP_LZMA:
+            import lzma
+            return lzma.LZMADecompressor()
+        elif compression == ArchiveCompressions.A_COMP_BZ2:
+            import bz2
+            return bz2.BZ2Decompressor()
+        return None
+
+def compress_member(path: str, compression: str):
+    """
+    Compresses a file for an archive member, returns its stat and a file object positioned at the end of the compressed data
+    Runs on archive worker threads, zlib, lzma and bz2 release the GIL while compressing
+    """
+    file_stat = os.stat(path)
+    compressor = ArchiveCompressions.get_compressor(compression)
+    out = io.BytesIO() if file_stat.st_size <= ARCHIVE_INLINE_SIZE else tempfile.TemporaryFile(prefix="bkp_member_")
+    try:
+        with open(path, 'rb') as f:
+            for _block in iter(partial(f.read, DELTA_BLOCK_SIZE), b''):
+                out.write(compressor.compress(_block) if compressor is not None else _block)
+        if compressor is not None:
+            out.write(compressor.flush())
+    except BaseException:
+        out.close()
+        raise
+    return file_stat, out
+
+class ArchiveStore(object):
+    """
+    Tar archive target of "store": "archive" backup_dirs entries
+    Changed files are appended as members of archive-NNNN.tar volumes in the entry backup folder, a new volume is started
+    once the current one reaches the volume size. archive_index.json maps every file to the offset of its latest member
+    so files can be extracted without reading the archive and scans compare against it instead of a backup tree
+    """
+    INDEX_NAME = "archive_index.json"
+    VOLUME_NAME = "archive-{0:04d}.tar"
+
+    def __init__(self, root: str, *, compression: str = ArchiveCompressions.A_COMP_ZLIB, volume_size: int = 2 ** 31, workers: int = 1,
+                 repack_ratio: float = ARCHIVE_REPACK_DEAD_RATIO):
+        self.root = root.replace("\\", "/").rstrip("/")
+        self.compression = compression if compression in ArchiveCompressions.all_types() else ArchiveCompressions.A_COMP_ZLIB
+        self.volume_size = volume_size
+        self.workers = max(1, workers)
+        self.repack_ratio = repack_ratio
+        # relpath: [volume, data offset, stored size, size, mtime, ctime, compression, header offset]
+        self.members: Dict[str, list] = dict()
+        # volume: offset of the end of its last member
+        self.volumes: Dict[str, int] = dict()
+        self.unsaved_changes = 0
+        self.lock = threading.RLock()
+        self.load()
+
+    @property
+    def index(self):
+        return os.path.join(self.root, self.INDEX_NAME)
+
+    def relpath(self, path: str) -> str:
+        path = path.replace("\\", "/")
+        return path[len(self.root) + 1:] if path.startswith(self.root + "/") else ""
+
+    def get(self, path: str) -> Optional[FileRecord]:
+        _rel = self.relpath(path)
+        _member = self.members.get(_rel, None)
+        if _member is None:
+            return None
+        return FileRecord(f"{self.root}/{_rel}", os.path.basename(_rel), stat_data=StatData(*_member[3:6]))
+
+    def iter_records(self, matcher: Optional["IgnoreMatcher"] = None):
+        for _rel, _member in tuple(self.members.items()):
+            _rec = FileRecord(f"{self.root}/{_rel}", _rel, stat_data=StatData(*_member[3:6]))
+            if matcher is None or not matcher.is_ignored_relpath(_rel, _rec):
+                yield _rec
+
+    def remove(self, path: str):
+        """
+        Drops the file or every file under the folder from the index, the members stay in the archive
+        """
+        with self.lock:
+            _rel = self.relpath(path)
+            for _member in [x for x in self.members.keys() if len(_rel) == 0 or x == _rel or x.startswith(_rel + "/")]:
+                del self.members[_member]
+                self.unsaved_changes += 1
+
+    def get_member_compression(self, path: str) -> str:
+        if os.path.splitext(path)[1].lower() in ARCHIVE_COMPRESSED_EXTENSIONS:
+            return ArchiveCompressions.A_COMP_NONE
+        return self.compression
+
+    def _new_volume_name(self) -> str:
+        # Repacked volumes leave gaps in the numbering, volumes left behind by an interrupted repack are skipped
+        _num = len(self.volumes) + 1
+        while self.VOLUME_NAME.format(_num) in self.volumes or os.path.exists(os.path.join(self.root, self.VOLUME_NAME.format(_num))):
+            _num += 1
+        return self.VOLUME_NAME.format(_num)
+
+    def _open_volume(self):
+        """
+        Opens the volume new members are appended to, positioned at the end of its last member
+        """
+        _name = max(self.volumes.keys(), default=None)
+        if _name is None or self.volumes[_name] >= self.volume_size:
+            _name = self._new_volume_name()
+            self.volumes[_name] = 0
+        _path = os.path.join(self.root, _name)
+        f = open(_path, 'r+b' if os.path.exists(_path) else 'w+b')
+        f.seek(self.volumes[_name])
+        return _name, f, tarfile.open(fileobj=f, mode='w', format=tarfile.PAX_FORMAT)
+
+    def _close_volume(self, name: str, f, tar: tarfile.TarFile):
+        self.volumes[name] = tar.offset
+        tar.close()
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    def append(self, instructions: List["FileChangeInstruction"], *, on_done: Callable[["FileChangeInstruction", Optional[BaseException]], None] = None):
+        """
+        Appends the sources of the instructions as members, members are compressed on worker threads and written in order
+        on_done is called for every instruction with the exception that stopped it or None
+        """
+        os.makedirs(self.root, exist_ok=True)
+        workers = self.workers
+        with self.lock, ThreadPoolExecutor(max_workers=workers, thread_name_prefix="archive") as executor:
+            volume = list(self._open_volume())
+            pending = list()
+
+            def write_next():
+                _instruction, _future = pending.pop(0)
+                try:
+                    file_stat, out = _future.result()
+                except Exception as _e:
+                    if on_done is not None:
+                        on_done(_instruction, _e)
+                    return
+                if volume[2].offset >= self.volume_size:
+                    self._close_volume(*volume)
+                    volume[:] = self._open_volume()
+                name, f, tar = volume
+                _rel = self.relpath(_instruction.target)
+                _compression = self.get_member_compression(_instruction.source)
+                with out:
+                    _stored_size = out.tell()
+                    out.seek(0)
+                    info = tarfile.TarInfo(_rel + ArchiveCompressions.SUFFIXES[_compression])
+                    info.size = _stored_size
+                    info.mtime = file_stat.st_mtime
+                    info.mode = stat.S_IMODE(file_stat.st_mode)
+                    # Members can take several header blocks, e.g. pax headers for float mtimes and long names
+                    _header_offset = tar.offset
+                    tar.addfile(info, out)
+                _data_offset = tar.offset - math.ceil(_stored_size / tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                self.members[_rel] = [name, _data_offset, _stored_size, file_stat.st_size, file_stat.st_mtime, file_stat.st_ctime, _compression, _header_offset]
+                self.volumes[name] = tar.offset
+                self.unsaved_changes += 1
+                if on_done is not None:
+                    on_done(_instruction, None)
+
+            try:
+                for instruction in instructions:
+                    pending.append((instruction, executor.submit(compress_member, instruction.source, self.get_member_compression(instruction.source))))
+                    while len(pending) >= workers * 2:
+                        write_next()
+                while len(pending) > 0:
+                    write_next()
+            finally:
+                for _instruction, _future in pending:
+                    _future.cancel()
+                self._close_volume(*volume)
+                self.save()
 
-def get_src_path(bkpp: str, source_data: Dict[str, str]):
-    path: str = source_data.get("path")
-    _subp = bkpp.replace("\\", "/")[len(source_data.get("subpath", "")) + len(bkp_root) + 1:]
-    if get_path_reduction(source_data) is not None:
-        _path_red = get_path_reduction(source_data) + 1 if get_path_reduction(source_data) is not None else None
-        _bkpdir = os.path.join(*path.split("/")[_path_red:]).replace("\\", "/")
-        bkpdir_ind = path.find(_bkpdir)
-        if len(_bkpdir) > 0 and bkpdir_ind != -1:
-            _fixed_sourcedir = path[:bkpdir_ind] + path[bkpdir_ind + len(_bkpdir):]
-        else:
-            _fixed_sourcedir = path
-    else:
-        _drive = os.path.splitdrive(path)[0]
-        _fixed_sourcedir = f"{_drive}/" if len(_drive) > 0 else "/"
-    _p = os.path.join(_fixed_sourcedir, _subp[1 if _subp.startswith("/") else None:]).replace("\\", "/")
-    return _p
+    def get_dead_bytes(self) -> Dict[str, int]:
+        """
+        Bytes of every volume that are not taken by the members the index points to
+        """
+        live = {x: 0 for x in self.volumes.keys()}
+        for _member in self.members.values():
+            volume, data_offset, stored_size = _member[:3]
+            if volume in live:
+                # From the first header block of the member to the end of its data blocks
+                live[volume] += data_offset + math.ceil(stored_size / tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE - _member[7]
+        return {x: max(0, self.volumes[x] - live[x]) for x in self.volumes.keys()}
+
+    def repack(self) -> Tuple[int, int]:
+        """
+        Rewrites the volumes whose dead bytes reach repack_ratio of the volume with only their live members
+        The live members are copied as stored into a new volume, the old volume is deleted once the index pointing
+        to the new one was saved, so an interrupted repack leaves at most an unused volume behind
+        Returns the number of repacked volumes and the bytes freed
+        """
+        repacked, freed = 0, 0
+        with self.lock:
+            for name, dead in sorted(self.get_dead_bytes().items()):
+                if self.volumes[name] == 0 or dead < self.volumes[name] * self.repack_ratio:
+                    continue
+                # Live members by their data offset, replaced members of the same path are skipped
+                _live = {_member[1]: _rel for _rel, _member in self.members.items() if _member[0] == name}
+                if len(_live) == 0:
+                    freed += self.volumes.pop(name)
+                    self.save()
+                    os.remove(os.path.join(self.root, name))
+                    repacked += 1
+                    continue
+                _new_name = self._new_volume_name()
+                _moved = dict()
+                _tmp_path = os.path.join(self.root, _new_name + ".tmp")
+                with tarfile.open(os.path.join(self.root, name), mode='r:') as src, open(_tmp_path, 'w+b') as f:
+                    with tarfile.open(fileobj=f, mode='w', format=tarfile.PAX_FORMAT) as dst:
+                        for info in src:
+                            _rel = _live.get(info.offset_data, None)
+                            if _rel is None:
+                                continue
+                            _header_offset = dst.offset
+                            dst.addfile(info, src.extractfile(info))
+                            _moved[_rel] = (dst.offset - math.ceil(info.size / tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE, _header_offset)
+                        _end = dst.offset
+                    f.truncate()
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(_tmp_path, os.path.join(self.root, _new_name))
+                for _rel, (_offset, _header_offset) in _moved.items():
+                    self.members[_rel][0] = _new_name
+                    self.members[_rel][1] = _offset
+                    self.members[_rel][7] = _header_offset
+                freed += self.volumes.pop(name) - _end
+                self.volumes[_new_name] = _end
+                self.save()
+                os.remove(os.path.join(self.root, name))
+                repacked += 1
+        return repacked, freed
+
+    def extract(self, path: str, dst: str):
+        """
+        Writes the latest archived version of path to dst
+        """
+        _member = self.members.get(self.relpath(path), None)
+        if _member is None:
+            raise FileNotFoundError(f"{path} is not archived")
+        volume, data_offset, stored_size, _, mtime, _, compression = _member[:7]
+        decompressor = ArchiveCompressions.get_decompressor(compression)
+        with open(os.path.join(self.root, volume), 'rb') as f, open(dst, 'wb') as out:
+            f.seek(data_offset)
+            remaining = stored_size
+            while remaining > 0:
+                _block = f.read(min(remaining, DELTA_BLOCK_SIZE))
+                if not _block:
+                    raise EOFError(f"{volume} ends before the member of {path}")
+                remaining -= len(_block)
+                out.write(decompressor.decompress(_block) if decompressor is not None else _block)
+        os.utime(dst, (mtime, mtime))
 
-def is_in_ignored(path: str, ignored_paths: Set[Optional[str]]):
-    path = path.replace('\\', '/')
-    for ip in ignored_paths:
-        ip = ip.replace('\\', '/')
-        if path.startswith(ip):
-            return True
-    return False
+    def load(self):
+        if not os.path.exists(self.index):
+            return
+        try:
+            with open(self.index, "r", encoding='utf-8') as f:
+                _data = json.load(f)
+            self.members = _data.get('members', dict())
+            self.volumes = _data.get('volumes', dict())
+            self.add_header_offsets()
+        except (json.JSONDecodeError, OSError):
+            change_tracker.add_error(f"Archive index {self.index} is unreadable, the archive will be written again.", wait_time=2)
+            self.members = dict()
+            self.volumes = dict()
+
+    def add_header_offsets(self):
+        """
+        Reads the member headers of volumes indexed before header offsets were recorded
+        """
+        _missing = {x[0] for x in self.members.values() if len(x) < 8}
+        for volume in _missing:
+            _live = {x[1]: x for x in self.members.values() if x[0] == volume and len(x) < 8}
+            try:
+                with tarfile.open(os.path.join(self.root, volume), mode='r:') as tar:
+                    for info in tar:
+                        if info.offset_data in _live:
+                            _live.pop(info.offset_data).append(info.offset)
+            except (OSError, tarfile.TarError):
+                pass
+            for _member in _live.values():
+                # Not found in the volume, its header is assumed to be a single block
+                _member.append(_member[1] - tarfile.BLOCKSIZE)
+            self.unsaved_changes += 1
 
-def scan_directory(sdir: str, ignored_paths: Set[Optional[str]] = (), *, filenum: List[int] = None,  print_progress: bool = False) -> Union[Dict[str, os.DirEntry], os.DirEntry]:
+    def save(self):
+        with self.lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(self.index + ".tmp", "w+", encoding='utf-8') as f:
+                json.dump(dict(timestamp=time.time(), volumes=self.volumes, members=self.members), f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.index + ".tmp", self.index)
+            self.unsaved_changes = 0
+
+def get_archive_store(source_data: Dict[str, Union[str, int]]) -> ArchiveStore:
+    root = get_bkp_path(source_data.get('path'), source_data)
+    if root not in archive_stores:
+        archive_stores[root] = ArchiveStore(root,
+                                            compression=source_data.get("archive_compression", ArchiveCompressions.A_COMP_ZLIB),
+                                            volume_size=parse_size(str(source_data.get("archive_volume_size", "2GiB"))),
+                                            workers=source_data.get("archive_workers", None) or os.cpu_count() or 1,
+                                            repack_ratio=float(source_data.get("archive_repack_ratio", ARCHIVE_REPACK_DEAD_RATIO)))
+    return archive_stores[root]
+
+def find_archive_store(path: str) -> Optional[ArchiveStore]:
+    path = path.replace("\\", "/")
+    for root, archive in archive_stores.items():
+        if path == root or path.startswith(root + "/"):
+            return archive
+    return None
+
+def get_scan_workers(source_data: Dict[str, Union[str, int]] = None):
+    override_scan_workers = source_data.get("scan_workers", None) if source_data is not None else None
+    workers = launch_args.args.scan_workers if override_scan_workers is None else override_scan_workers
+    return max(1, workers if workers is not None else 1)
+
+def print_files_found(filenum: List[int]):
+    ANSIEscape.set_cursor_pos(1, 3)
+    print(f"{filenum[0]} Files found.{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
+
+def scan_directory(sdir: str, matcher: Optional[IgnoreMatcher] = None, *, filenum: List[int] = None,  print_progress: bool = False, workers: int = 1, scan_cache: Optional[ScanCache] = None) -> Union[Dict[str, FileRecord], FileRecord]:
     ret = dict()
     if os.path.exists(sdir):
-        try:
-            if print_progress:
-                ANSIEscape.set_cursor_pos(1, 1)
-                print(f"Scanning {sdir}:{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
-                if filenum is None:
-                    filenum = [0]
-            for f in os.scandir(sdir):
-                f: os.DirEntry
-                if not is_in_ignored(f.path, ignored_paths):
-                    if f.is_file():
-                        ret[f.name] = f
-                        if print_progress:
-                            filenum[0] = filenum[0] + 1
-                    elif f.is_dir():
-                        ret[f.name] = scan_directory(f.path, ignored_paths=ignored_paths, filenum=filenum, print_progress=print_progress)
-                    if print_progress:
-                        ANSIEscape.set_cursor_pos(1, 3)
-                        print(f"{filenum[0]} Files found.{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
-        except NotADirectoryError:
-            ret = get_file_direntry(sdir)
+        if filenum is None:
+            filenum = [0]
+        if print_progress:
+            ANSIEscape.set_cursor_pos(1, 1)
+            print(f"Scanning {sdir}:{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
+        if os.path.isfile(sdir):
+            return next(iter_tree_files(sdir), None)
+        with ProgressRenderer(partial(print_files_found, filenum)) if print_progress else contextlib.nullcontext():
+            for f in iter_tree_files(sdir, matcher, workers=workers, scan_cache=scan_cache):
+                *folders, name = f.relpath.split("/")
+                _dir = ret
+                for folder in folders:
+                    _dir = _dir.setdefault(folder, dict())
+                _dir[name] = f
+                filenum[0] += 1
     return ret
 
-def scan_backup_dirs(allbkps: list):
-    _scanresult: Dict[str, os.DirEntry] = dict()
+def scan_backup_dirs(allbkps: list, *, print_progress: bool = True):
+    """
+    Makes sure the backup manifest covers every backup root, only walks the backup disk
+    when the manifest is missing, did not finish cleanly, does not know a root yet or --rescan-backup is used
+    Sync mode backups are walked on every run, their files can be edited or added on the backup side to be synced back
+    """
     filen = [0]
+    if launch_args.args.rescan_backup or not backup_manifest.is_clean:
+        backup_manifest.reset()
     for b in allbkps:
+        if get_store(b) == StoreTypes.S_TYPE_ARCHIVE:
+            # Archive entries are compared against their archive index
+            continue
         sd = get_bkp_path(b.get('path'), b)
-        ignored_paths_var = b.get("ignored_paths", ())
-        ignored_paths = {f"{os.path.join(sd, x)}" for x in ignored_paths_var}
-        _res = scan_directory(sd, ignored_paths, filenum=filen, print_progress=True)
-        if isinstance(_res, dict) and len(_res) > 0 or isinstance(_res, os.DirEntry):
-            _scanresult[os.path.basename(sd)] = _res
-    return _scanresult
+        if b.get("mode", ManageModes.M_MODE_DEFAULT) == ManageModes.M_MODE_SYNC or not backup_manifest.has_root(sd):
+            backup_manifest.scan_root(sd, workers=get_scan_workers(b), filenum=filen, print_progress=print_progress)
 
 
 def get_file_direntry(path: str):
@@ -1218,50 +3682,105 @@ def get_file_direntry(path: str):
     except:
         return None
 
-def recursive_fileiter(sdir, ignored_paths: Set[Optional[str]] = ()):
-    ret = list()
-    folders = list()
-    if os.path.exists(sdir):
-        if os.path.isfile(sdir):
-            for x in os.scandir(os.path.dirname(sdir)):
-                x: os.DirEntry
-                if x.name == os.path.basename(sdir):
-                    return [x]
-        for f in os.scandir(sdir):
-            f: os.DirEntry
-            try:
-                if f.is_dir():
-                    folders.append(f.path)
-            except FileNotFoundError as _e:
-                if os.path.islink(_e.filename) or Path(_e.filename).is_symlink():
-                    change_tracker.add_error(f"Folder {_e.filename} was found but it apparently is a {'sym' if Path(_e.filename).is_symlink() else ''}link that cannot be reached. {_e.__class__.__name__}: {_e.args}")
-        for folder in folders:
-            ret.extend(recursive_fileiter(folder, ignored_paths))
-        if os.path.isfile(sdir) and not is_in_ignored(sdir, ignored_paths):
-            ret.append(sdir)
-        for item in os.scandir(sdir):
-            item: os.DirEntry
-            try:
-                if item.is_file() and not is_in_ignored(item.path, ignored_paths):
-                    ret.append(item)
-            except FileNotFoundError as _e:
-                if os.path.islink(_e.filename) or Path(_e.filename).is_symlink():
-                    change_tracker.add_error(f"File {_e.filename} | {item.name} was found but it is apparently is a {'sym' if Path(_e.filename).is_symlink() else ''}link that cannot be reached. {_e.__class__.__name__}: {_e.args}")
-            except Exception as _e:
-                change_tracker.add_error(f"Scanning File {item.name} raised an exception: {_e.__class__.__name__}: {_e.args}")
-    else:
-        change_tracker.add_error(f"Recursive FileIter could not find {sdir}", 2)
-    return ret
+def _list_directory(cur_dir: str, cur_rel: str, matcher: Optional[IgnoreMatcher], scan_cache: Optional[ScanCache] = None):
+    """
+    Reads a single directory with one scandir call, or from the scan cache if the directory did not change
+    Returns the files, the subfolders to descend into and the error messages, errors are returned instead of reported
+    so that this can run on a scan worker thread
+    """
+    files = list()
+    subdirs = list()
+    errors = list()
+    dir_stat = None
+    if scan_cache is not None:
+        _cached, dir_stat = scan_cache.get_listing(cur_dir)
+        if _cached is not None:
+            _cached_files, _cached_subdirs = _cached
+            for name in _cached_subdirs:
+                if matcher is None or not matcher.is_ignored_dir(f"{cur_rel}{name}", name):
+                    subdirs.append((os.path.join(cur_dir, name), f"{cur_rel}{name}/"))
+            for name, stat_data in _cached_files:
+                _rec = FileRecord(os.path.join(cur_dir, name), f"{cur_rel}{name}", stat_data=stat_data)
+                if matcher is None or not matcher.is_ignored_file(_rec.relpath, name, _rec):
+                    files.append(_rec)
+            return files, subdirs, errors
+    try:
+        with os.scandir(cur_dir) as it:
+            entries = list(it)
+    except OSError as _e:
+        errors.append(f"Scanning Folder {cur_dir} raised an exception: {_e.__class__.__name__}: {_e.args}")
+        return files, subdirs, errors
+    _listing_files = dict()
+    _listing_subdirs = list()
+    for item in entries:
+        item: os.DirEntry
+        try:
+            if item.is_dir():
+                _listing_subdirs.append(item.name)
+                if matcher is None or not matcher.is_ignored_dir(f"{cur_rel}{item.name}", item.name):
+                    subdirs.append((item.path, f"{cur_rel}{item.name}/"))
+            elif item.is_file():
+                if scan_cache is not None:
+                    _listing_files[item.name] = item.stat()
+                if matcher is None or not matcher.is_ignored_file(f"{cur_rel}{item.name}", item.name, item):
+                    _rec = FileRecord.from_entry(item, f"{cur_rel}{item.name}")
+                    # Stated here so the stat latency is spread over the scan workers instead of the consuming thread
+                    _rec.stat()
+                    files.append(_rec)
+        except FileNotFoundError as _e:
+            if os.path.islink(item.path) or Path(item.path).is_symlink():
+                errors.append(f"File {item.path} | {item.name} was found but it is apparently is a {'sym' if Path(item.path).is_symlink() else ''}link that cannot be reached. {_e.__class__.__name__}: {_e.args}")
+        except Exception as _e:
+            errors.append(f"Scanning File {item.name} raised an exception: {_e.__class__.__name__}: {_e.args}")
+    if scan_cache is not None and dir_stat is not None and len(errors) == 0:
+        scan_cache.store_listing(cur_dir, dir_stat, _listing_files, _listing_subdirs)
+    return files, subdirs, errors
 
-def recursive_folderiter(sdir, ignored_paths: Set[Optional[str]] = ()):
-    ret = list()
-    f: os.DirEntry
-    subfolders = [f for f in os.scandir(sdir) if f.is_dir()]
-    ret.extend(subfolders)
-    for folder in subfolders:
-        if is_in_ignored(folder.path, ignored_paths):
-            ret.extend(recursive_folderiter(folder.path))
-    return ret
+def iter_tree_files(sdir: str, matcher: Optional[IgnoreMatcher] = None, *, workers: int = 1, scan_cache: Optional[ScanCache] = None):
+    """
+    Iterative single pass tree walker, yields a FileRecord per file as soon as its directory is read
+    Every directory is read with exactly one scandir call, the ignore matcher is checked once per entry
+    and ignored directories are not descended into
+    With more than one worker the directories at the top of the stack are read ahead on a thread pool,
+    the results are still consumed in stack order so the output matches the serial walk
+    """
+    if os.path.isfile(sdir):
+        for x in os.scandir(os.path.dirname(sdir)):
+            x: os.DirEntry
+            if x.name == os.path.basename(sdir):
+                yield FileRecord.from_entry(x, x.name)
+                return
+        return
+    if not os.path.isdir(sdir):
+        change_tracker.add_error(f"Tree walker could not find {sdir}", 2)
+        return
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scan") if workers > 1 else None
+    # Bounds the amount of directory listings held in memory ahead of the consumer
+    readahead = workers * 4
+    # Stack items are [path, relpath, future of the listing or None]
+    stack = [[sdir, "", None]]
+    try:
+        while len(stack) > 0:
+            if executor is not None:
+                for item in stack[-readahead:]:
+                    if item[2] is None:
+                        item[2] = executor.submit(_list_directory, item[0], item[1], matcher, scan_cache)
+            cur_dir, cur_rel, listing = stack.pop()
+            if listing is not None:
+                files, subdirs, errors = listing.result()
+            else:
+                files, subdirs, errors = _list_directory(cur_dir, cur_rel, matcher, scan_cache)
+            for error in errors:
+                change_tracker.add_error(error)
+            yield from files
+            # Reversed so that the stack pops subfolders in scandir order
+            stack.extend([path, rel, None] for path, rel in reversed(subdirs))
+    finally:
+        if executor is not None:
+            for item in stack:
+                if item[2] is not None:
+                    item[2].cancel()
+            executor.shutdown(wait=True)
 
 def get_actual_filepath(p: str):
     try:
@@ -1283,6 +3802,20 @@ class FileState(object):
         self.sourcectime = sourcectime
         self.backupmtime = backupmtime
         self.backupctime = backupctime
+        self.source_record: Optional[FileRecord] = None
+        self.backup_record: Optional[FileRecord] = None
+
+    def set_source(self, record: FileRecord):
+        _stat = record.stat()
+        self.source_record = record
+        self.sourceexists = True
+        self.sourcemtime, self.sourcectime = _stat.st_mtime, _stat.st_ctime
+
+    def set_backup(self, record: FileRecord):
+        _stat = record.stat()
+        self.backup_record = record
+        self.backupexists = True
+        self.backupmtime, self.backupctime = _stat.st_mtime, _stat.st_ctime
 
     def __hash__(self):
         return hash((self.spath, self.bpath))
@@ -1292,116 +3825,207 @@ class FileState(object):
             raise TypeError(f"Cannot compare a {type(self).__name__} with {type(other).__name__}")
         return other.__hash__() == self.__hash__()
 
-def scan_changes(allbkps: list):
+def scan_versioned(source_data: Dict[str, Union[str, int]], matcher: Optional[IgnoreMatcher], snapshot_name: str, *, store: str = StoreTypes.S_TYPE_PLAIN, status: Optional[dict] = None):
+    """
+    Plans a new snapshot of a versioned backup_dirs entry, files unchanged since the previous snapshot are linked from it
+    Nothing is planned if no file was added, changed or removed since the previous snapshot
+    """
+    sd = source_data.get('path')
+    snapshots_root = get_bkp_path(sd, source_data)
+    snapshots = list_snapshots(snapshots_root)
+    if snapshot_name in snapshots:
+        change_tracker.add_error(f"{sd}: snapshot {snapshot_name} already exists.", wait_time=1)
+        return
+    new_snapshot = os.path.join(snapshots_root, snapshot_name).replace("\\", "/")
+    prev_snapshot = os.path.join(snapshots_root, snapshots[-1]).replace("\\", "/") if len(snapshots) > 0 else None
+    is_forced = source_data.get('force_backup', False)
+    planned = list()
+    changed = False
+    matched = 0
+    for f in iter_tree_files(sd, matcher, workers=get_scan_workers(source_data), scan_cache=scan_cache):
+        if status is not None:
+            status['cur_file'] = f.path
+        target = f"{new_snapshot}/{f.relpath}"
+        prev: Optional[FileRecord] = backup_manifest.get(f"{prev_snapshot}/{f.relpath}") if prev_snapshot is not None else None
+        if prev is not None:
+            matched += 1
+            if not is_forced and f.stat().st_size == prev.stat().st_size and f.stat().st_mtime <= prev.stat().st_mtime + MAX_MODIFICATION_TIME_ERROR_OFFSET:
+                planned.append((ChangeTypes.CH_TYPE_LINK, prev.path, target, dict(source_record=prev)))
+                continue
+        changed = True
+        planned.append((ChangeTypes.CH_TYPE_CREATE, f.path, target, dict(source_record=f, is_forced=is_forced, store=store)))
+    if not changed and prev_snapshot is not None:
+        # Files removed from the source
+        changed = matched < sum(1 for _ in backup_manifest.iter_under(prev_snapshot))
+    if not changed:
+        return
+    for change_type, source, target, kwargs in planned:
+        file_instruction_list.add_file_change(change_type, source, target, **kwargs)
+
+def resolve_checksum_checks(checks: list, store: str):
+    """
+    Waits for the hash comparisons of a checksum entry and plans an update for every file whose content differs from its backup
+    """
+    for f, filep, file, future in checks:
+        try:
+            changed = future.result()
+        except OSError as _e:
+            change_tracker.add_error(f"Hashing {f.path} failed: {type(_e).__name__}: {_e.args}")
+            continue
+        if changed:
+            file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE, f.path, filep, source_record=f, target_record=file, store=store)
+    checks.clear()
+
+def scan_changes(allbkps: list, *, on_batch: Callable[[], None] = None, quiet: bool = False):
+    """
+    Fills file_instruction_list with the changes required for every backup_dirs entry
+    on_batch is called whenever a batch of instructions can be applied while the scan continues,
+    collisions are only resolved here if no on_batch callback is given, otherwise they are returned
+    """
+    show_status = not launch_args.args.nooutput and not quiet
     if launch_args.args.nooutput:
         print("Checking Files for changes | No Output Mode.")
     num_bkps = len(allbkps)
-    if not launch_args.args.nooutput:
+    if show_status:
         clear_terminal()
-    ANSIEscape.set_cursor_display(False)
-    print("Compiling pathlists...")
-    bkpscan = scan_backup_dirs(allbkps)
-    print("Done.")
-    time.sleep(2)
+    if not quiet:
+        ANSIEscape.set_cursor_display(False)
+        print("Compiling pathlists...")
+    scan_backup_dirs(allbkps, print_progress=not quiet)
+    if not quiet:
+        print("Done.")
+        time.sleep(2)
     latest_change_ts = [0.0, 0.0]
     collisions: Set[FileState] = set()
-    for n, b in enumerate(allbkps):
-        sd = b.get('path')
-        mode = b.get("mode", ManageModes.M_MODE_DEFAULT)
-        ignored_paths_var = b.get("ignored_paths", ())
-        ignored_paths = {f"{os.path.join(sd, x)}" for x in ignored_paths_var}
-        try:
-            if not launch_args.args.nooutput:
-                file_instruction_list.print_scan_status("Checking Files for changes:", sd, n, num_bkps)
-            fp = get_bkp_path(sd, b)
-            _file_states: Dict[str, FileState] = dict()
-            if os.path.exists(sd):
-                sourcescan = recursive_fileiter(sd, ignored_paths)
-                for f in sourcescan:
-                    filep: str = get_bkp_path(f.path.replace("\\", "/"), b)
-                    fp_dir = os.path.dirname(fp).replace("\\", "/")
-                    scan_filep = filep[len(fp_dir) if filep.startswith(fp_dir) else None:]
-                    file: Optional[os.DirEntry] = deep_get(bkpscan, scan_filep.split("/")[1:], return_none=True)
-                    if not launch_args.args.nooutput:
-                        file_instruction_list.print_scan_status("Checking Files for changes:", sd, n, num_bkps, cur_file=f.path)
-                    if mode == ManageModes.M_MODE_SYNC:
-                        _fs = _file_states.setdefault(filep, FileState(filep, f.path, sourceexists=True, sourcemtime=get_file_stat_data(f.stat())['mtime'], sourcectime=get_file_stat_data(f.stat())['ctime']))
-                        if latest_change_ts[0] < max(_fs.sourcemtime, _fs.sourcectime):
-                            latest_change_ts[0] = max(_fs.sourcemtime, _fs.sourcectime)
-                        if file is not None:
-                            _fs.backupexists = True
-                            _fs.backupmtime, _fs.backupctime = get_file_stat_data(file.stat())['mtime'], get_file_stat_data(file.stat())['ctime']
-                            if latest_change_ts[1] < max(_fs.backupmtime, _fs.backupctime):
-                                latest_change_ts[1] = max(_fs.backupmtime, _fs.backupctime)
+    snapshot_name = get_cur_dt().strftime(SNAPSHOT_NAME_FORMAT)
+    hash_executor = ThreadPoolExecutor(max_workers=max(1, launch_args.args.hash_workers), thread_name_prefix="hash") if any(get_compare(b) == CompareTypes.C_TYPE_CHECKSUM for b in allbkps) else None
+    # Read by the progress renderer, the scan only updates it
+    scan_status = dict(header="Checking Files for changes:", cur_dir="", cur_num=0, total_num=num_bkps, cur_file=None)
+    renderer = ProgressRenderer(lambda: file_instruction_list.print_scan_status(**scan_status))
+    if show_status:
+        renderer.start()
+    try:
+        for n, b in enumerate(allbkps):
+            sd = b.get('path')
+            mode = b.get("mode", ManageModes.M_MODE_DEFAULT)
+            store = get_store(b)
+            if store != b.get("store", StoreTypes.S_TYPE_PLAIN):
+                change_tracker.add_error(f"{sd}: store {b.get('store')} can not be used in {mode} mode, backing up with plain copies.", wait_time=2)
+            archive: Optional[ArchiveStore] = get_archive_store(b) if store == StoreTypes.S_TYPE_ARCHIVE else None
+            try:
+                scan_status.update(header="Checking Files for changes:", cur_dir=sd, cur_num=n, cur_file=None)
+                fp = get_bkp_path(sd, b)
+                matcher = get_ignore_matcher(b, sd)
+                _file_states: Dict[str, FileState] = dict()
+                if mode == ManageModes.M_MODE_VERSIONED:
+                    if os.path.exists(sd):
+                        scan_versioned(b, matcher, snapshot_name, store=store, status=scan_status)
                     else:
-                        if file is not None:
-                            if get_file_stat_data(f.stat())['mtime'] > modification_timestamp_db.get_timestamp(file)['mtime'] + MAX_MODIFICATION_TIME_ERROR_OFFSET or b.get('force_backup', False):
-                                file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE, f.path, filep, is_forced=b.get('force_backup', False))
-                        else:
-                            file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_CREATE, f.path, filep)
-            else:
-                if mode == ManageModes.M_MODE_SNAPSHOT:
-                    if os.path.exists(fp):
-                        file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_REMOVE if os.path.isfile(fp) else ChangeTypes.CH_TYPE_REMOVEFOLDER, fp)
-                elif mode != ManageModes.M_MODE_SYNC:
-                    change_tracker.add_error("{} Backup Source is Unavailable.".format(sd), wait_time=1)
-            if os.path.exists(fp) and mode in (ManageModes.M_MODE_SNAPSHOT, ManageModes.M_MODE_SYNC):
-                _back_ignored_paths = {os.path.join(fp, x).replace('\\', '/') for x in ignored_paths_var}
-                bkp_rec_scan: List[os.DirEntry] = recursive_fileiter(fp, _back_ignored_paths)
-                if os.path.exists(sd):
-                    reverse_source_scan: Union[Dict[str, os.DirEntry], os.DirEntry] = scan_directory(sd, ignored_paths)
-                else:
-                    reverse_source_scan: Union[Dict[str, os.DirEntry], os.DirEntry] = dict()
-                for bkpf in bkp_rec_scan:
-                    sf = get_src_path(bkpf.path, b)
-                    sfile: Optional[os.DirEntry] = deep_get(reverse_source_scan, sf[len(sd) + 1 if sf.startswith(sd) else None:].split("/"), return_none=True)
-                    if not launch_args.args.nooutput:
-                        file_instruction_list.print_scan_status("Checking Files for changes:", sd, n, num_bkps, cur_file=bkpf.path)
-                    if mode == ManageModes.M_MODE_SNAPSHOT:
-                        if sfile is None:
-                            file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_REMOVE if os.path.isfile(bkpf.path) else ChangeTypes.CH_TYPE_REMOVEFOLDER, bkpf.path)
-                    elif mode == ManageModes.M_MODE_SYNC:
-                        _fs = _file_states.setdefault(bkpf.path.replace("\\", "/"), FileState(bkpf.path.replace("\\", "/"), sf, backupexists=True, backupmtime=get_file_stat_data(bkpf.stat())['mtime'], backupctime=get_file_stat_data(bkpf.stat())['ctime']))
-                        if latest_change_ts[1] < max(_fs.backupmtime, _fs.backupctime):
-                            latest_change_ts[1] = max(_fs.backupmtime, _fs.backupctime)
-                        if sfile is not None:
-                            _fs.sourceexists = True
-                            _fs.sourcemtime, _fssourcectime = get_file_stat_data(sfile.stat())['mtime'], get_file_stat_data(sfile.stat())['ctime']
+                        change_tracker.add_error("{} Backup Source is Unavailable.".format(sd), wait_time=1)
+                elif os.path.exists(sd):
+                    compare = get_compare(b)
+                    if compare != b.get("compare", CompareTypes.C_TYPE_MTIME):
+                        change_tracker.add_error(f"{sd}: compare {b.get('compare')} can not be used with this mode or store, comparing modification times.", wait_time=2)
+                    checksum_checks = list()
+                    for f in iter_tree_files(sd, matcher, workers=get_scan_workers(b), scan_cache=scan_cache):
+                        filep: str = get_bkp_path(f.path.replace("\\", "/"), b)
+                        file: Optional[FileRecord] = backup_manifest.get(filep) if archive is None else archive.get(filep)
+                        scan_status['cur_file'] = f.path
+                        if mode == ManageModes.M_MODE_SYNC:
+                            _fs = _file_states.setdefault(filep, FileState(filep, f.path))
+                            _fs.set_source(f)
                             if latest_change_ts[0] < max(_fs.sourcemtime, _fs.sourcectime):
                                 latest_change_ts[0] = max(_fs.sourcemtime, _fs.sourcectime)
-            if mode == ManageModes.M_MODE_SYNC:
-                for filestate in _file_states.values():
-                    if not launch_args.args.nooutput:
-                        file_instruction_list.print_scan_status("Running file sync logic:", sd, n, num_bkps, cur_file=filestate.bpath)
-                    file_snapshot_ts = modification_timestamp_db.get_timestamp(filestate.bpath, get_from_file=False)
-                    if filestate.sourceexists != filestate.backupexists:
-                        # Only one file exists, time to figure out if it was deleted or added
-                        snap_change_time = max(file_snapshot_ts.get('ctime', 0), file_snapshot_ts.get('mtime', 0))
-                        _max_bkp_mod_time = max(filestate.backupctime, filestate.backupmtime)
-                        _max_src_mod_time = max(filestate.sourcectime, filestate.sourcemtime)
-                        _max_mod_time = max(_max_bkp_mod_time, _max_src_mod_time)
-                        if (snap_change_time == 0) or (snap_change_time != 0 and (snap_change_time < _max_mod_time)):
-                            if filestate.sourceexists:
-                                file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_CREATE, filestate.spath, filestate.bpath)
-                            else:
-                                file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_CREATE_NOTS, filestate.bpath, filestate.spath)
+                            if file is not None:
+                                _fs.set_backup(file)
+                                if latest_change_ts[1] < max(_fs.backupmtime, _fs.backupctime):
+                                    latest_change_ts[1] = max(_fs.backupmtime, _fs.backupctime)
                         else:
-                            file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_REMOVE, filestate.spath if filestate.sourceexists else filestate.bpath)
+                            if file is not None and compare == CompareTypes.C_TYPE_CHECKSUM and not b.get('force_backup', False):
+                                checksum_checks.append((f, filep, file, hash_executor.submit(is_content_changed, f, file)))
+                                if len(checksum_checks) >= PIPELINE_BATCH_SIZE:
+                                    resolve_checksum_checks(checksum_checks, store)
+                            elif file is not None:
+                                backup_mtime = modification_timestamp_db.get_timestamp(file)['mtime'] if archive is None else file.stat().st_mtime
+                                if f.stat().st_mtime > backup_mtime + MAX_MODIFICATION_TIME_ERROR_OFFSET or b.get('force_backup', False):
+                                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE, f.path, filep, is_forced=b.get('force_backup', False), source_record=f, target_record=file, store=store)
+                            else:
+                                file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_CREATE, f.path, filep, source_record=f, store=store)
+                            if on_batch is not None and file_instruction_list.changes_num >= PIPELINE_BATCH_SIZE:
+                                on_batch()
+                    resolve_checksum_checks(checksum_checks, store)
+                else:
+                    if mode == ManageModes.M_MODE_SNAPSHOT:
+                        if os.path.exists(fp):
+                            file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_REMOVE if os.path.isfile(fp) else ChangeTypes.CH_TYPE_REMOVEFOLDER, fp, store=store)
+                    elif mode != ManageModes.M_MODE_SYNC:
+                        change_tracker.add_error("{} Backup Source is Unavailable.".format(sd), wait_time=1)
+                if os.path.exists(fp) and mode in (ManageModes.M_MODE_SNAPSHOT, ManageModes.M_MODE_SYNC):
+                    bkp_rec_scan = backup_manifest.iter_under(fp, get_ignore_matcher(b, fp)) if archive is None else archive.iter_records(get_ignore_matcher(b, fp))
+                    if os.path.exists(sd):
+                        reverse_source_scan: Union[Dict[str, FileRecord], FileRecord] = scan_directory(sd, matcher, workers=get_scan_workers(b), scan_cache=scan_cache)
                     else:
-                        mtime_diff = abs(filestate.sourcemtime - filestate.backupmtime)
-                        if mtime_diff > MAX_MODIFICATION_TIME_ERROR_OFFSET:
-                            if filestate.sourcemtime > modification_timestamp_db.snapshot_ts and filestate.backupmtime > modification_timestamp_db.snapshot_ts:
-                                collisions.add(filestate)
+                        reverse_source_scan: Union[Dict[str, FileRecord], FileRecord] = dict()
+                    for bkpf in bkp_rec_scan:
+                        sf = get_src_path(bkpf.path, b)
+                        sfile: Optional[FileRecord] = deep_get(reverse_source_scan, sf[len(sd) + 1 if sf.startswith(sd) else None:].split("/"), return_none=True)
+                        scan_status['cur_file'] = bkpf.path
+                        if mode == ManageModes.M_MODE_SNAPSHOT:
+                            if sfile is None:
+                                file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_REMOVE, bkpf.path, source_record=bkpf, store=store)
+                        elif mode == ManageModes.M_MODE_SYNC:
+                            _fs = _file_states.setdefault(bkpf.path.replace("\\", "/"), FileState(bkpf.path.replace("\\", "/"), sf))
+                            _fs.set_backup(bkpf)
+                            if latest_change_ts[1] < max(_fs.backupmtime, _fs.backupctime):
+                                latest_change_ts[1] = max(_fs.backupmtime, _fs.backupctime)
+                            if sfile is not None:
+                                _fs.set_source(sfile)
+                                if latest_change_ts[0] < max(_fs.sourcemtime, _fs.sourcectime):
+                                    latest_change_ts[0] = max(_fs.sourcemtime, _fs.sourcectime)
+                if mode == ManageModes.M_MODE_SYNC:
+                    for filestate in _file_states.values():
+                        scan_status.update(header="Running file sync logic:", cur_file=filestate.bpath)
+                        file_snapshot_ts = modification_timestamp_db.get_timestamp(filestate.bpath, get_from_file=False)
+                        if filestate.sourceexists != filestate.backupexists:
+                            # Only one file exists, time to figure out if it was deleted or added
+                            snap_change_time = max(file_snapshot_ts.get('ctime', 0), file_snapshot_ts.get('mtime', 0))
+                            _max_bkp_mod_time = max(filestate.backupctime, filestate.backupmtime)
+                            _max_src_mod_time = max(filestate.sourcectime, filestate.sourcemtime)
+                            _max_mod_time = max(_max_bkp_mod_time, _max_src_mod_time)
+                            if (snap_change_time == 0) or (snap_change_time != 0 and (snap_change_time < _max_mod_time)):
+                                if filestate.sourceexists:
+                                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_CREATE, filestate.spath, filestate.bpath, source_record=filestate.source_record)
+                                else:
+                                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_CREATE_NOTS, filestate.bpath, filestate.spath, source_record=filestate.backup_record)
                             else:
-                                if filestate.sourcemtime > filestate.backupmtime:
-                                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE, filestate.spath, filestate.bpath)
-                                elif filestate.sourcemtime < filestate.backupmtime:
-                                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE_NOTS, filestate.bpath, filestate.spath)
-        except Exception as _e:
-            change_tracker.add_error(f"Scanning File {sd} raised an exception: {_e.__traceback__.tb_lineno} | {_e.__class__.__name__}: {_e.args}")
-    else:
-        if not launch_args.args.nooutput:
-            file_instruction_list.print_scan_status("Checking Files for changes:", "", num_bkps, num_bkps)
+                                file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_REMOVE, filestate.spath if filestate.sourceexists else filestate.bpath, source_record=filestate.source_record if filestate.sourceexists else filestate.backup_record)
+                        else:
+                            mtime_diff = abs(filestate.sourcemtime - filestate.backupmtime)
+                            if mtime_diff > MAX_MODIFICATION_TIME_ERROR_OFFSET:
+                                if filestate.sourcemtime > modification_timestamp_db.snapshot_ts and filestate.backupmtime > modification_timestamp_db.snapshot_ts:
+                                    collisions.add(filestate)
+                                else:
+                                    if filestate.sourcemtime > filestate.backupmtime:
+                                        file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE, filestate.spath, filestate.bpath, source_record=filestate.source_record, target_record=filestate.backup_record)
+                                    elif filestate.sourcemtime < filestate.backupmtime:
+                                        file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE_NOTS, filestate.bpath, filestate.spath, source_record=filestate.backup_record, target_record=filestate.source_record)
+            except Exception as _e:
+                change_tracker.add_error(f"Scanning File {sd} raised an exception: {_e.__traceback__.tb_lineno} | {_e.__class__.__name__}: {_e.args}")
+            if on_batch is not None:
+                on_batch()
+        else:
+            scan_status.update(header="Checking Files for changes:", cur_dir="", cur_num=num_bkps, cur_file=None)
+    finally:
+        renderer.stop()
+    if hash_executor is not None:
+        hash_executor.shutdown()
+    if scan_cache is not None:
+        scan_cache.save()
+    if on_batch is not None:
+        return collisions
+    resolve_collisions(collisions)
+
+def resolve_collisions(collisions: Set[FileState]):
     if len(collisions) > 0:
         clear_terminal()
         print(f"Sync mode found {len(collisions)} collisions")
@@ -1412,159 +4036,812 @@ def scan_changes(allbkps: list):
             print(f"Processing collision {start_collisions-len(collisions)}/{start_collisions}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
             if launch_args.args.autoupdatecollisions or modification_timestamp_db.get_resolve_mode(_cur_col.bpath) is ModTimestampDB.COLRES_MODE_AUTOLATEST:
                 if _cur_col.sourcemtime > _cur_col.backupmtime:
-                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE, _cur_col.spath, _cur_col.bpath)
+                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE, _cur_col.spath, _cur_col.bpath, source_record=_cur_col.source_record, target_record=_cur_col.backup_record)
                 elif _cur_col.sourcemtime < _cur_col.backupmtime:
-                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE_NOTS, _cur_col.bpath, _cur_col.spath)
+                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE_NOTS, _cur_col.bpath, _cur_col.spath, source_record=_cur_col.backup_record, target_record=_cur_col.source_record)
             else:
                 _sel = selection_menu(True, (1, 2, 3, 4), f"{ANSIEscape.get_colored_text('Manual Intervention Required!', ANSIEscape.ForegroundTextColor.bright_green)}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}\n1. Keep Source {_cur_col.spath}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}\n   {notzformat.format(datetime.datetime.fromtimestamp(_cur_col.sourcemtime))}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}\n\n< Last Sync: {ANSIEscape.get_colored_text(notzformat.format(datetime.datetime.fromtimestamp(modification_timestamp_db.snapshot_ts)), ANSIEscape.ForegroundTextColor.bright_cyan)} >{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}\n\n2. Keep Backup {_cur_col.bpath}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}\n   {notzformat.format(datetime.datetime.fromtimestamp(_cur_col.backupmtime))}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}\n3. Skip{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}\n4. Always Autoupdate this file{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
                 if _sel == 1:
-                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE, _cur_col.spath, _cur_col.bpath)
+                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE, _cur_col.spath, _cur_col.bpath, source_record=_cur_col.source_record, target_record=_cur_col.backup_record)
                 elif _sel == 2:
-                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE_NOTS, _cur_col.bpath, _cur_col.spath)
+                    file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE_NOTS, _cur_col.bpath, _cur_col.spath, source_record=_cur_col.backup_record, target_record=_cur_col.source_record)
                 elif _sel == 4:
                     modification_timestamp_db.set_resolve_mode(_cur_col.bpath, ModTimestampDB.COLRES_MODE_AUTOLATEST)
                     if _cur_col.sourcemtime > _cur_col.backupmtime:
                         file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE, _cur_col.spath,
-                                                              _cur_col.bpath)
+                                                              _cur_col.bpath, source_record=_cur_col.source_record, target_record=_cur_col.backup_record)
                     elif _cur_col.sourcemtime < _cur_col.backupmtime:
                         file_instruction_list.add_file_change(ChangeTypes.CH_TYPE_UPDATE_NOTS, _cur_col.bpath,
-                                                              _cur_col.spath)
+                                                              _cur_col.spath, source_record=_cur_col.backup_record, target_record=_cur_col.source_record)
     ANSIEscape.set_cursor_display(True)
 
-def process():
+def confirm_changes(storage: InstructionStorage):
+    """
+    Prints the summary of the planned changes and the change list, pauses for confirmation unless disabled
+    """
+    _links = storage.count(ChangeTypes.CH_TYPE_LINK)
+    _changetext = "{0} Changes Required. {1} Updates, {2} Creations, {3} Removals.{5} {4} I/OAction Size".format(storage.changes_num,
+                                                                                   storage.count(ChangeTypes.CH_TYPE_UPDATE, ChangeTypes.CH_TYPE_UPDATE_NOTS),
+                                                                                   storage.count(ChangeTypes.CH_TYPE_CREATE, ChangeTypes.CH_TYPE_CREATE_NOTS),
+                                                                                   storage.count(ChangeTypes.CH_TYPE_REMOVE, ChangeTypes.CH_TYPE_REMOVEFOLDER),
+                                                                                   format_bytes(storage.bytes_to_modify),
+                                                                                   f" {_links} Unchanged files linked." if _links > 0 else "")
     clear_terminal()
-    print("Initializing.")
-    time.sleep(1)
-    if not os.path.exists(bkp_root):
-        os.mkdir(bkp_root)
-    allbkps: list = config['backup_dirs']
-    scan_changes(allbkps)
-    if file_instruction_list.changes_num > 0:
-        _changetext = "{0} Changes Required. {1} Updates, {2} Creations, {3} Removals. {4} I/OAction Size".format(file_instruction_list.changes_num,
-                                                                                       len(list(filter(lambda x: x.change_type in (ChangeTypes.CH_TYPE_UPDATE, ChangeTypes.CH_TYPE_UPDATE_NOTS), file_instruction_list.filechanges))),
-                                                                                       len(list(filter(lambda x: x.change_type in (ChangeTypes.CH_TYPE_CREATE, ChangeTypes.CH_TYPE_CREATE_NOTS), file_instruction_list.filechanges))),
-                                                                                       len(list(filter(lambda x: x.change_type == ChangeTypes.CH_TYPE_REMOVE, file_instruction_list.filechanges))) + len(list(filter(lambda x: x.change_type == ChangeTypes.CH_TYPE_REMOVEFOLDER, file_instruction_list.filechanges))),
-                                                                                       format_bytes(file_instruction_list.bytes_to_modify))
-        clear_terminal()
-        print(_changetext)
-        dinfo = shutil.disk_usage(os.path.realpath('/' if os.name == 'nt' else __file__))
-        print("This will {3} approximately {0} of space. {1} Available from {2}".format(format_bytes(abs(file_instruction_list.space_requirement)), format_bytes(dinfo.free), format_bytes(dinfo.total), "require" if file_instruction_list.space_requirement >= 0 else "free up"))
-        if not launch_args.args.nochangelist:
-            print(f"Printing a list of changes: {len(file_instruction_list.filechanges)}")
+    print(_changetext)
+    dinfo = shutil.disk_usage(os.path.realpath('/' if os.name == 'nt' else __file__))
+    print("This will {3} approximately {0} of space. {1} Available from {2}".format(format_bytes(abs(storage.space_requirement)), format_bytes(dinfo.free), format_bytes(dinfo.total), "require" if storage.space_requirement >= 0 else "free up"))
+    if not launch_args.args.nochangelist:
+        print(f"Printing a list of changes: {storage.changes_num}")
+    if not launch_args.args.nopause:
+        os.system("pause")
+    ANSIEscape.set_cursor_display(False)
+    if not launch_args.args.nochangelist:
+        ANSIEscape.set_cursor_display(True)
+        for change in storage:
+            _text = f"[{ANSIEscape.get_colored_text(ChangeTypes.get_name(change.change_type).upper(), text_color=ANSIEscape.ForegroundTextColor.red if change.change_type == ChangeTypes.CH_TYPE_REMOVE else ANSIEscape.ForegroundTextColor.green if change.change_type in (ChangeTypes.CH_TYPE_CREATE, ChangeTypes.CH_TYPE_CREATE_NOTS) else ANSIEscape.ForegroundTextColor.bright_green if change.change_type in (ChangeTypes.CH_TYPE_UPDATE, ChangeTypes.CH_TYPE_UPDATE_NOTS) else None)}{ANSIEscape.get_colored_text(' <Forced>', text_color=ANSIEscape.ForegroundTextColor.bright_cyan) if change.is_forced else ''}]\n{change.source}"
+            _text += f"\n  <{format_bytes(change.sourcesize)}>mod@{notzformat.format(datetime.datetime.fromtimestamp(change.sourcemtime))}({change.sourcemtime})"
+            if change.target is not None:
+                _text += f"\n  ~{format_bytes(change.diffspace)}~\n{change.target}"
+            if change.change_type in (ChangeTypes.CH_TYPE_UPDATE, ChangeTypes.CH_TYPE_UPDATE_NOTS):
+                _text += f"\n  <{format_bytes(change.targetsize)}>mod@{notzformat.format(datetime.datetime.fromtimestamp(change.targetmtime))}({change.targetmtime})"
+            print(_text, flush=True)
         if not launch_args.args.nopause:
             os.system("pause")
         ANSIEscape.set_cursor_display(False)
-        if not launch_args.args.nochangelist:
-            ANSIEscape.set_cursor_display(True)
-            _changesnum = len(file_instruction_list.filechanges)
-            for change in sorted(file_instruction_list.filechanges, key=lambda x: x.change_type):
-                _text = f"[{ANSIEscape.get_colored_text(ChangeTypes.get_name(change.change_type).upper(), text_color=ANSIEscape.ForegroundTextColor.red if change.change_type == ChangeTypes.CH_TYPE_REMOVE else ANSIEscape.ForegroundTextColor.green if change.change_type in (ChangeTypes.CH_TYPE_CREATE, ChangeTypes.CH_TYPE_CREATE_NOTS) else ANSIEscape.ForegroundTextColor.bright_green if change.change_type in (ChangeTypes.CH_TYPE_UPDATE, ChangeTypes.CH_TYPE_UPDATE_NOTS) else None)}{ANSIEscape.get_colored_text(' <Forced>', text_color=ANSIEscape.ForegroundTextColor.bright_cyan) if change.is_forced else ''}]\n{change.source}"
-                _text += f"\n  <{format_bytes(change.sourcesize)}>mod@{notzformat.format(datetime.datetime.fromtimestamp(change.sourcemtime))}({change.sourcemtime})"
-                if change.target is not None:
-                    _text += f"\n  ~{format_bytes(change.diffspace)}~\n{change.target}"
-                if change.change_type in (ChangeTypes.CH_TYPE_UPDATE, ChangeTypes.CH_TYPE_UPDATE_NOTS):
-                    _text += f"\n  <{format_bytes(change.targetsize)}>mod@{notzformat.format(datetime.datetime.fromtimestamp(change.targetmtime))}({change.targetmtime})"
-                print(_text, flush=True)
-            if not launch_args.args.nopause:
-                os.system("pause")
-            ANSIEscape.set_cursor_display(False)
-            clear_terminal()
-        if file_instruction_list.space_requirement > dinfo.free:
-            print(ANSIEscape.get_colored_text("Not Enough Space to finish the backup process. Exiting.", text_color=ANSIEscape.ForegroundTextColor.red, background_color=ANSIEscape.BackgroundTextColor.yellow))
-            raise IOError("Not Enough Space")
-        file_change_errors = 0
-        bytes_done = 0
-        bytes_to_modify = file_instruction_list.bytes_to_modify
-
-        def print_status():
+        clear_terminal()
+
+def check_free_space(storage: InstructionStorage):
+    dinfo = shutil.disk_usage(os.path.realpath('/' if os.name == 'nt' else __file__))
+    if storage.space_requirement > dinfo.free:
+        print(ANSIEscape.get_colored_text("Not Enough Space to finish the backup process. Exiting.", text_color=ANSIEscape.ForegroundTextColor.red, background_color=ANSIEscape.BackgroundTextColor.yellow))
+        raise IOError("Not Enough Space")
+
+def is_in_backup_root(path: str) -> bool:
+    try:
+        _root = os.path.abspath(bkp_root)
+        return os.path.commonpath([os.path.abspath(path), _root]) == _root
+    except ValueError:
+        # Paths on different drives
+        return False
+
+def unshare_file(path: str) -> bool:
+    """
+    Removes path if it is one of several hardlinks to the same data so writing it does not modify the other links
+    Returns True if the file was removed
+    """
+    try:
+        if os.stat(path).st_nlink > 1:
+            os.remove(path)
+            return True
+    except OSError:
+        pass
+    return False
+
+def mark_outdated(path: str):
+    """
+    Makes the next scan rewrite a backup file, an mtime older than any source counts as changed
+    """
+    os.utime(path, ns=(0, 0))
+    modification_timestamp_db.remove_timestamp(path)
+    if backup_manifest.get(path) is not None:
+        backup_manifest.update(path)
+
+def mark_corrupt(path: str, expected_digest: str):
+    """
+    Marks a backup file whose content does not match the hash it should have as outdated
+    A dedup object it links to is dropped from the store so the next run writes it again instead of linking it
+    """
+    dedup_store.discard(expected_digest, path)
+    integrity_manifest.remove(path)
+    mark_outdated(path)
+
+def is_verifiable(instruction: FileChangeInstruction) -> bool:
+    return (not instruction.archived and
+            instruction.change_type in (ChangeTypes.CH_TYPE_CREATE, ChangeTypes.CH_TYPE_UPDATE, ChangeTypes.CH_TYPE_LINK))
+
+def verify_copy(instruction: FileChangeInstruction) -> bool:
+    """
+    Rereads a file written by apply_instruction and compares its hash with the hash of its source,
+    matching files are recorded in the integrity manifest, returns False on a mismatch
+    Linked files reuse the record of the file they link to, copies whose source changed since they were made are skipped
+    """
+    target_stat = os.stat(instruction.target)
+    if instruction.change_type == ChangeTypes.CH_TYPE_LINK:
+        _record = integrity_manifest.get(instruction.source)
+        if _record is not None and _record[0] == target_stat.st_size and _record[1] == target_stat.st_mtime:
+            integrity_manifest.record(instruction.target, target_stat, _record[2])
+        else:
+            integrity_manifest.record(instruction.target, target_stat, get_file_hash(instruction.target))
+        return True
+    source_stat = os.stat(instruction.source)
+    if instruction.source_stat is None or source_stat.st_size != instruction.source_stat.st_size or source_stat.st_mtime != instruction.source_stat.st_mtime:
+        change_tracker.add_log(f"Skipped verifying {instruction.target}, its source changed after it was copied", should_print=False)
+        return True
+    expected = hash_cache.get_hash(instruction.source, source_stat)
+    digest = get_file_hash(instruction.target)
+    if digest != expected:
+        mark_corrupt(instruction.target, expected)
+        return False
+    integrity_manifest.record(instruction.target, target_stat, digest)
+    return True
+
+def ensure_target_folder(target: str):
+    folder = os.path.dirname(target)
+    if folder in known_target_folders:
+        return
+    if not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except FileExistsError:
+            # Created by another copy worker
+            pass
+        else:
+            change_tracker.add_file_change('folder', "Created folder {0}".format(folder), should_print=False, path=folder)
+    known_target_folders.add(folder)
+
+def apply_instruction(instruction: FileChangeInstruction, callback: Callable[[int, int], None] = None):
+    """
+    Applies a single instruction and records it, raises on failure
+    """
+    _started = time.monotonic()
+    if instruction.target is not None:
+        ensure_target_folder(instruction.target)
+    if instruction.change_type in (ChangeTypes.CH_TYPE_UPDATE, ChangeTypes.CH_TYPE_UPDATE_NOTS):
+        act_filepath = get_actual_filepath(instruction.target)
+        instruction.refresh_source()
+        # Only backup files are unshared, hardlinks of a source file updated in sync mode must all see the update
+        _shared = (not instruction.dedup and instruction.change_type == ChangeTypes.CH_TYPE_UPDATE and is_in_backup_root(act_filepath)
+                   and unshare_file(act_filepath))
+        if instruction.dedup:
+            _written, _method = dedup_store.store(instruction.source, os.path.join(os.path.dirname(act_filepath), os.path.basename(instruction.source)), callback=callback)
+            change_tracker.add_copy_method(_method, instruction.sourcesize)
+        elif instruction.use_delta and not _shared:
+            instruction.bytes_written = 0
+
+            def on_write(written: int):
+                instruction.bytes_written = written
+            delta_update_file(instruction.source, act_filepath, hash_cache=block_hash_cache, callback=callback, on_write=on_write)
+            _written, _method = act_filepath, CopyMethods.CP_METHOD_DELTA
+            change_tracker.add_copy_method(_method, instruction.bytes_written)
+        else:
+            _written, _method = copy_with_callback(instruction.source, os.path.dirname(act_filepath), callback=callback)
+            change_tracker.add_copy_method(_method, instruction.sourcesize)
+        if instruction.change_type == ChangeTypes.CH_TYPE_UPDATE_NOTS:
+            modification_timestamp_db.save_timestamp(instruction.source, ModTimestampDB.get_empty_filedata_with_changes(**get_file_stat_data(instruction.source_stat)))
+        else:
+            _written_stat = os.stat(_written)
+            # Linked dedup objects keep the times of their first copy, the source times are what later scans compare against
+            modification_timestamp_db.save_timestamp(instruction.target, ModTimestampDB.get_empty_filedata_with_changes(**get_file_stat_data(instruction.source_stat if instruction.dedup else _written_stat)))
+            backup_manifest.update(instruction.target, _written_stat)
+            integrity_manifest.remove(instruction.target)
+            hash_cache.copy_hash(instruction.source, instruction.source_stat, instruction.target, StatData(_written_stat.st_size, _written_stat.st_mtime, _written_stat.st_ctime))
+        change_tracker.add_file_change(ChangeTypes.CH_TYPE_UPDATE, "Updated | {0} | {1} -> {2} | {3}".format(instruction.source,
+                                                                                     datetime.datetime.fromtimestamp(instruction.targetmtime),
+                                                                                     datetime.datetime.fromtimestamp(instruction.sourcemtime),
+                                                                                     _method if instruction.bytes_written is None else "{0} {1} of {2} rewritten".format(_method,
+                                                                                                                                                                          format_bytes(instruction.bytes_written),
+                                                                                                                                                                          format_bytes(instruction.sourcesize))),
+                                       should_print=False, path=instruction.target, size=instruction.sourcesize, duration=time.monotonic() - _started)
+        if os.path.basename(act_filepath) != os.path.basename(instruction.source):
+            os.rename(act_filepath, os.path.join(os.path.dirname(act_filepath), os.path.basename(instruction.source)))
+            change_tracker.add_file_change(ChangeTypes.CH_TYPE_RENAME, "Renamed | {0} | {1} -> {2}".format(act_filepath,
+                                                                                         os.path.basename(act_filepath),
+                                                                                         os.path.basename(instruction.source)), path=act_filepath)
+    elif instruction.change_type in (ChangeTypes.CH_TYPE_CREATE, ChangeTypes.CH_TYPE_CREATE_NOTS):
+        instruction.refresh_source()
+        if instruction.dedup:
+            _written, _method = dedup_store.store(instruction.source, instruction.target, callback=callback)
+        else:
+            _written, _method = copy_with_callback(instruction.source, os.path.dirname(instruction.target), callback=callback)
+        change_tracker.add_copy_method(_method, instruction.sourcesize)
+        if instruction.change_type == ChangeTypes.CH_TYPE_CREATE_NOTS:
+            modification_timestamp_db.save_timestamp(instruction.source, ModTimestampDB.get_empty_filedata_with_changes(**get_file_stat_data(instruction.source_stat)))
+        else:
+            _written_stat = os.stat(_written)
+            modification_timestamp_db.save_timestamp(instruction.target, ModTimestampDB.get_empty_filedata_with_changes(**get_file_stat_data(instruction.source_stat if instruction.dedup else _written_stat)))
+            backup_manifest.update(instruction.target, _written_stat)
+            integrity_manifest.remove(instruction.target)
+            hash_cache.copy_hash(instruction.source, instruction.source_stat, instruction.target, StatData(_written_stat.st_size, _written_stat.st_mtime, _written_stat.st_ctime))
+        change_tracker.add_file_change(ChangeTypes.CH_TYPE_CREATE, "Created | {0} | {1}".format(instruction.source, _method), should_print=False,
+                                       path=instruction.target, size=instruction.sourcesize, duration=time.monotonic() - _started)
+    elif instruction.change_type == ChangeTypes.CH_TYPE_LINK:
+        try:
+            os.link(instruction.source, instruction.target)
+            _method = CopyMethods.CP_METHOD_HARDLINK
+        except OSError as _e:
+            if _e.errno != errno.EMLINK:
+                raise
+            _, _method = copy_with_callback(instruction.source, instruction.target, callback=callback)
+        change_tracker.add_copy_method(_method, instruction.sourcesize)
+        backup_manifest.update(instruction.target)
+        change_tracker.add_file_change(ChangeTypes.CH_TYPE_LINK, "Linked | {0} | {1}".format(instruction.target, _method), should_print=False, path=instruction.target, size=instruction.sourcesize)
+    elif (instruction.change_type == ChangeTypes.CH_TYPE_REMOVE or instruction.change_type == ChangeTypes.CH_TYPE_REMOVEFOLDER) and instruction.archived:
+        find_archive_store(instruction.source).remove(instruction.source)
+        change_tracker.add_file_change(instruction.change_type, "Removed from archive | {0}".format(instruction.source), should_print=False, path=instruction.source)
+    elif instruction.change_type == ChangeTypes.CH_TYPE_REMOVE or instruction.change_type == ChangeTypes.CH_TYPE_REMOVEFOLDER:
+        del_file_or_dir(get_actual_filepath(instruction.source))
+        modification_timestamp_db.remove_timestamp(instruction.source)
+        if instruction.change_type == ChangeTypes.CH_TYPE_REMOVEFOLDER:
+            backup_manifest.remove_under(instruction.source)
+            integrity_manifest.remove_under(instruction.source)
+        else:
+            backup_manifest.remove(instruction.source)
+            integrity_manifest.remove(instruction.source)
+        change_tracker.add_file_change(instruction.change_type, "Removed | {0}".format(get_actual_filepath(instruction.source)), should_print=False, path=instruction.source)
+
+def get_source_inode(instruction: FileChangeInstruction) -> int:
+    """
+    Inode of the source, DirEntry.stat() reports 0 on Windows so it is stated again there
+    """
+    _ino = getattr(instruction.source_stat, 'st_ino', 0)
+    if _ino == 0:
+        try:
+            _ino = os.stat(instruction.source).st_ino
+        except OSError:
+            pass
+    return _ino
+
+def get_schedule_key(policy: str) -> Callable[[FileChangeInstruction], tuple]:
+    """
+    locality orders copies by target folder, then by source inode which roughly follows the on-disk order of the files,
+    small and large order them by size for fast progress or sustained bandwidth
+    """
+    if policy == SchedulePolicies.P_TYPE_SMALL_FIRST:
+        return lambda x: (x.sourcesize, x.target)
+    if policy == SchedulePolicies.P_TYPE_LARGE_FIRST:
+        return lambda x: (-x.sourcesize, x.target)
+    return lambda x: (os.path.dirname(x.target), get_source_inode(x), x.target)
+
+def get_execution_phases(instructions: List[FileChangeInstruction], policy: str = SchedulePolicies.P_TYPE_LOCALITY):
+    """
+    Copies run first in the order of the schedule policy, then file removals by path, then folder removals deepest first
+    Instructions within a phase do not depend on each other and can run concurrently
+    """
+    copies = sorted((x for x in instructions if x.change_type not in (ChangeTypes.CH_TYPE_REMOVE, ChangeTypes.CH_TYPE_REMOVEFOLDER)), key=get_schedule_key(policy))
+    removals = sorted((x for x in instructions if x.change_type == ChangeTypes.CH_TYPE_REMOVE), key=lambda x: x.source)
+    folder_removals = sorted((x for x in instructions if x.change_type == ChangeTypes.CH_TYPE_REMOVEFOLDER), key=lambda x: x.source.replace("\\", "/").count("/"), reverse=True)
+    return [x for x in (copies, removals, folder_removals) if len(x) > 0]
+
+def execute_instructions(storage: InstructionStorage):
+    """
+    Applies and empties the instruction storage, returns the number of instructions and the number of failed ones
+    With more than one copy worker every phase is applied on a thread pool, folder removals always run serially
+    With --verify every written file is reread on a separate pool right after it was copied, while it is likely still cached
+    The plan and its finished instructions are checkpointed until it completed, see --resume
+    """
+    workers = max(1, launch_args.args.copy_workers)
+    num_files = storage.changes_num
+    progress_lock = threading.RLock()
+    # Delta updates replace the estimated bytes of their instruction with the bytes actually written
+    progress = dict(done=0, bytes_done=0, bytes_total=storage.bytes_to_modify, errors=0)
+    # id(instruction): bytes of the file copied so far, for the copies currently running
+    in_flight: Dict[int, float] = dict()
+    verify_executor = ThreadPoolExecutor(max_workers=max(1, launch_args.args.verify_workers), thread_name_prefix="verify") if launch_args.args.verify else None
+    verifications = list()
+
+    # The file shown by the progress renderer and how much of it was copied
+    current = dict(file=None, ratio=0.0)
+    started = time.monotonic()
+
+    def print_status():
+        with progress_lock:
+            _cur_file: Optional[FileChangeInstruction] = current['file']
+            if _cur_file is None:
+                return
+            _ratio = current['ratio']
+            _done = progress['bytes_done'] + sum(in_flight.values())
             ANSIEscape.set_cursor_pos(1, 1)
-            print(f"In Progress | Ctrl+C to cancel.{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
+            print(f"In Progress | Ctrl+C to cancel.{f' | {len(in_flight)} workers busy' if workers > 1 else ''}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
             print(f"Folder: {os.path.split(_cur_file.source)[0]}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
             ANSIEscape.clear_current_line()
             ANSIEscape.set_cursor_pos(1, 4)
             print(f"File: [{_cur_file.change_type.capitalize()}] {os.path.split(_cur_file.source)[1]}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
             ANSIEscape.clear_current_line()
             ANSIEscape.set_cursor_pos(1, 6)
-            print(f"{current_file_num} / {num_files} done. DiffSize: {format_bytes(_cur_file.diffsize)}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
-            print(f"{get_progress_bar(0)}0.00% | Current File.{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
-            print(f"{get_progress_bar(round(current_file_num * 100 / num_files, 2))}{round(current_file_num * 100 / num_files, 2)}% | Total files.{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
-            print(f"{get_progress_bar(round(((abs(bytes_done) / bytes_to_modify) if bytes_to_modify != 0 else 1) * 100, 2))}{format_bytes(bytes_done)}/{format_bytes(bytes_to_modify)}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
-            print("\n\n{0} errors".format(ANSIEscape.get_colored_text(str(file_change_errors), text_color=ANSIEscape.ForegroundTextColor.red)) if file_change_errors != 0 else "")
-
-        def print_cur_status(diffsize, current, total):
-            ANSIEscape.set_cursor_pos(1, 7)
-            _ratio = current / total
+            print(f"{progress['done']} / {num_files} done. DiffSize: {format_bytes(_cur_file.diffsize)}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
             _percentage: float = round(_ratio * 100, 2)
-            print(f"{get_progress_bar(_percentage)}{_percentage:.2f}% | Current File.{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}", flush=True)
-            print(f"{get_progress_bar(round((current_file_num+_ratio) * 100 / num_files, 2))}{round((current_file_num+_ratio) * 100 / num_files, 2):.2f}% | Total files.{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
-            _done = bytes_done + diffsize * _ratio
-            print(f"{get_progress_bar(round(((abs(_done) / bytes_to_modify) if bytes_to_modify != 0 else 1) * 100, 2))}{format_bytes(_done)}/{format_bytes(bytes_to_modify)}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
-
-        if launch_args.args.nooutput:
-            print("In Progress | No Output Mode.")
-        num_files = file_instruction_list.changes_num
-        current_file_num = 0
-        while file_instruction_list.changes_num > 0:
-            _cur_file = file_instruction_list.get_file_change()
-            if _cur_file.target is not None:
-                if not os.path.exists(os.path.dirname(_cur_file.target)):
+            _files_done = progress['done'] + _ratio if workers == 1 and id(_cur_file) in in_flight else progress['done']
+            print(f"{get_progress_bar(_percentage)}{_percentage:.2f}% | Current File.{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
+            print(f"{get_progress_bar(round(_files_done * 100 / num_files, 2))}{round(_files_done * 100 / num_files, 2):.2f}% | Total files.{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
+            _elapsed = time.monotonic() - started
+            _eta = f" | ETA {datetime.timedelta(seconds=round(max(0, progress['bytes_total'] - _done) * _elapsed / _done))}" if _done > 0 and _elapsed >= 1 else ""
+            print(f"{get_progress_bar(round(((abs(_done) / progress['bytes_total']) if progress['bytes_total'] != 0 else 1) * 100, 2))}{format_bytes(_done)}/{format_bytes(progress['bytes_total'])}{_eta}{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
+            print("\n\n{0} errors".format(ANSIEscape.get_colored_text(str(progress['errors']), text_color=ANSIEscape.ForegroundTextColor.red)) if progress['errors'] != 0 else "", flush=True)
+
+    def on_copy_progress(_cur_file: FileChangeInstruction, copied, total):
+        # Runs for every copied chunk, only the counters are updated, the key was added under the lock by run_instruction
+        _ratio = copied / total if total != 0 else 1
+        in_flight[id(_cur_file)] = _cur_file.diffsize * _ratio if _cur_file.bytes_written is None else _cur_file.bytes_written
+        if current['file'] is _cur_file:
+            current['ratio'] = _ratio
+
+    def run_instruction(_cur_file: FileChangeInstruction):
+        check_copy_cancelled()
+        with progress_lock:
+            in_flight[id(_cur_file)] = 0
+            current.update(file=_cur_file, ratio=0.0)
+            if not launch_args.args.nologs:
+                change_tracker.add_log("Folder:{2}\nFile:{3}\n{0} / {1} done. DiffSize:{4}".format(progress['done'],
+                                                                                    num_files,
+                                                                                    os.path.split(_cur_file.source)[0],
+                                                                                    os.path.split(_cur_file.source)[1],
+                                                                                    format_bytes(_cur_file.diffsize)), should_print=False)
+        try:
+            apply_instruction(_cur_file, callback=partial(on_copy_progress, _cur_file))  # noqa
+            with progress_lock:
+                if _cur_file.bytes_written is not None:
+                    progress['bytes_total'] += _cur_file.bytes_written - _cur_file.diffsize
+                    progress['bytes_done'] += _cur_file.bytes_written
+                else:
+                    progress['bytes_done'] += _cur_file.diffsize
+                if verify_executor is not None and is_verifiable(_cur_file):
+                    verifications.append((_cur_file, verify_executor.submit(verify_copy, _cur_file)))
+            checkpoint.finish(_cur_file)
+        except Exception as fileupd_exception:
+            change_tracker.add_error("Failed to {3} file: {0} due to an Exception {1}. {2}".format(str(_cur_file), type(fileupd_exception).__name__, fileupd_exception.args, _cur_file.change_type), wait_time=5)
+            with progress_lock:
+                progress['errors'] += 1
+        finally:
+            with progress_lock:
+                in_flight.pop(id(_cur_file), None)
+                progress['done'] += 1
+
+    def on_archived(_cur_file: FileChangeInstruction, _exception: Optional[BaseException]):
+        with progress_lock:
+            if _exception is None:
+                archived_done.append(_cur_file)
+                progress['bytes_done'] += _cur_file.diffsize
+                change_tracker.add_file_change(_cur_file.change_type, "Archived | {0} | {1}".format(_cur_file.source, find_archive_store(_cur_file.target).get_member_compression(_cur_file.source)), should_print=False,
+                                               path=_cur_file.target, size=_cur_file.sourcesize)
+            else:
+                change_tracker.add_error("Failed to archive file: {0} due to an Exception {1}. {2}".format(str(_cur_file), type(_exception).__name__, _exception.args))
+                progress['errors'] += 1
+            progress['done'] += 1
+            current.update(file=_cur_file, ratio=1.0)
+
+    if launch_args.args.nooutput:
+        print("In Progress | No Output Mode.")
+    instructions = list()
+    archived: Dict[str, List[FileChangeInstruction]] = dict()
+    archived_done: List[FileChangeInstruction] = list()
+    while storage.changes_num > 0:
+        instruction = storage.get_file_change()
+        if instruction.archived and instruction.change_type in (ChangeTypes.CH_TYPE_CREATE, ChangeTypes.CH_TYPE_UPDATE):
+            archived.setdefault(find_archive_store(instruction.target).root, list()).append(instruction)
+        else:
+            instructions.append(instruction)
+    checkpoint.begin(instructions + [x for y in archived.values() for x in y])
+    # Folders can be removed by the previous batch of a pipelined run
+    known_target_folders.clear()
+    copy_cancelled.clear()
+    backup_manifest.mark_dirty()
+    renderer = ProgressRenderer(print_status).start()
+    try:
+        for root, archive_instructions in archived.items():
+            try:
+                archive_stores[root].append(sorted(archive_instructions, key=lambda x: x.target), on_done=on_archived)
+            except OSError as _e:
+                change_tracker.add_error("Failed to write the archive {0} due to an Exception {1}. {2}".format(root, type(_e).__name__, _e.args), wait_time=5)
+            # Archived files only count as finished once the index listing them was saved
+            archive_stores[root].save()
+            for _cur_file in archived_done:
+                checkpoint.finish(_cur_file)
+            archived_done.clear()
+        for phase in get_execution_phases(instructions, launch_args.args.schedule):
+            if workers == 1 or phase[0].change_type == ChangeTypes.CH_TYPE_REMOVEFOLDER:
+                for instruction in phase:
+                    run_instruction(instruction)
+            else:
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="copy") as executor:
+                    running = set()
                     try:
-                        os.makedirs(os.path.dirname(_cur_file.target))
-                    except FileExistsError:
-                        pass
+                        for instruction in phase:
+                            if len(running) >= workers * 2:
+                                _finished, running = wait(running, return_when=FIRST_COMPLETED)
+                                for _f in _finished:
+                                    _f.result()
+                            running.add(executor.submit(run_instruction, instruction))
+                        for _f in running:
+                            _f.result()
+                    except KeyboardInterrupt:
+                        # Ctrl+C only reaches the main thread, running copies stop after their current chunk, queued ones do not start
+                        copy_cancelled.set()
+                        raise
+    finally:
+        renderer.stop()
+        checkpoint.sync()
+    checkpoint.clear()
+    if verify_executor is not None:
+        for _cur_file, _f in verifications:
+            try:
+                if not _f.result():
+                    change_tracker.add_error("Verification failed | {0} does not match {1}, it will be copied again on the next run".format(_cur_file.target, _cur_file.source))
+                    progress['errors'] += 1
+            except OSError as _e:
+                change_tracker.add_error("Failed to verify file: {0} due to an Exception {1}. {2}".format(str(_cur_file), type(_e).__name__, _e.args))
+                progress['errors'] += 1
+        verify_executor.shutdown()
+        change_tracker.add_log(f"Verified {len(verifications)} written files", should_print=False)
+    return num_files, progress['errors']
+
+def print_execution_summary(num_files: int, file_change_errors: int):
+    clear_terminal()
+    print("Finished Copying.")
+    ANSIEscape.set_cursor_display(True)
+    print("{0} / {1}({2}%) done.\n{3}{4}".format(num_files - file_change_errors,
+                                                 num_files,
+                                                 round((num_files - file_change_errors) * 100 / num_files, 2),
+                                                 "\n\n{} errors".format(file_change_errors) if file_change_errors != 0 else "",
+                                                 change_tracker.get_errors_text()))
+    change_tracker.add_log("{0} / {1} done.\n{2}%\n{3}".format(num_files - file_change_errors,
+                                                         num_files,
+                                                         round((num_files - file_change_errors) * 100 / num_files, 2),
+                                                         "\n\n{} errors".format(ANSIEscape.get_colored_text(str(file_change_errors), text_color=ANSIEscape.ForegroundTextColor.red)) if file_change_errors != 0 else ""), should_print=False)
+
+def process_pipelined(allbkps: list):
+    """
+    Scans on a separate thread and applies the instructions of every finished backup_dirs entry
+    (or every PIPELINE_BATCH_SIZE instructions of a non-sync entry) while the scan continues
+    The change list is shown per batch unless disabled, the free space is checked per batch
+    Sync mode collisions are resolved after the scan finished
+    """
+    batches = queue.Queue(maxsize=max(1, launch_args.args.pipeline_depth))
+    scan_result = dict(collisions=set(), exception=None)
+    cancelled = threading.Event()
+
+    def push_batch():
+        if file_instruction_list.changes_num <= 0:
+            return
+        batch = file_instruction_list.take_batch()
+        while True:
+            if cancelled.is_set():
+                raise PipelineCancelledException()
+            try:
+                batches.put(batch, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def scanner():
+        try:
+            scan_result['collisions'] = scan_changes(allbkps, on_batch=push_batch, quiet=True)
+        except PipelineCancelledException:
+            pass
+        except BaseException as _e:
+            scan_result['exception'] = _e
+        finally:
+            batches.put(None)
+
+    def run_batch(_batch: InstructionStorage):
+        if not launch_args.args.nochangelist:
+            confirm_changes(_batch)
+        check_free_space(_batch)
+        return execute_instructions(_batch)
+
+    print("Scanning and copying | Pipeline Mode.")
+    num_files, file_change_errors = 0, 0
+    scan_thread = threading.Thread(target=scanner, name="scanner", daemon=True)
+    scan_thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                break
+            _num, _errors = run_batch(batch)
+            num_files += _num
+            file_change_errors += _errors
+    finally:
+        cancelled.set()
+    scan_thread.join()
+    if scan_result['exception'] is not None:
+        raise scan_result['exception']
+    resolve_collisions(scan_result['collisions'])
+    if file_instruction_list.changes_num > 0:
+        _num, _errors = run_batch(file_instruction_list)
+        num_files += _num
+        file_change_errors += _errors
+    return num_files, file_change_errors
+
+def verify_backups(allbkps: list):
+    """
+    Scrubs the backup of every backup_dirs entry against the integrity manifest, only the backup drive is read
+    Files without a record, or rewritten since they were recorded, get a new record
+    Files whose content changed while their size and mtime did not are reported as corrupt and rewritten by the next run
+    Hardlinked files of snapshots and the dedup store are read once, archive entries are not covered
+    """
+    clear_terminal()
+    print("Initializing.")
+    scan_backup_dirs(allbkps)
+    workers = max(1, launch_args.args.verify_workers)
+    counts = dict(files=0, verified=0, recorded=0, corrupt=0, missing=0, bytes=0)
+    current = dict(root="")
+
+    def print_status():
+        ANSIEscape.set_cursor_pos(1, 1)
+        print(f"Verifying {current['root']} | Ctrl+C to cancel.{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
+        print(f"{counts['files']} files, {format_bytes(counts['bytes'])} read. {counts['corrupt']} corrupt, {counts['missing']} missing.{ANSIEscape.CONTROLSYMBOL_clear_after_cursor}")
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="verify") as executor, ProgressRenderer(print_status):
+        for b in allbkps:
+            if get_store(b) == StoreTypes.S_TYPE_ARCHIVE:
+                continue
+            root = backup_manifest.normalize(get_bkp_path(b.get('path'), b))
+            current['root'] = root
+            # (st_dev, st_ino): hash future, shared by all links of a file
+            digests = dict()
+            corrupt_inodes = set()
+            pending = list()
+            seen = set()
+
+            def resolve(_path: str, _stat: os.stat_result, _future):
+                _key = (_stat.st_dev, _stat.st_ino)
+                try:
+                    digest = _future.result()
+                except OSError as _e:
+                    change_tracker.add_error("Failed to verify file: {0} due to an Exception {1}. {2}".format(_path, type(_e).__name__, _e.args))
+                    return
+                _record = integrity_manifest.get(_path)
+                if _key in corrupt_inodes or (_record is not None and _record[0] == _stat.st_size and _record[1] == _stat.st_mtime and _record[2] != digest):
+                    change_tracker.add_error("Corrupt backup file | {0} does not match its recorded hash, it will be copied again on the next run".format(_path))
+                    corrupt_inodes.add(_key)
+                    counts['corrupt'] += 1
+                    if _record is not None:
+                        mark_corrupt(_path, _record[2])
                     else:
-                        change_tracker.add_file_change('folder', "Created folder {0}".format(os.path.dirname(_cur_file.target)), should_print=False)
+                        integrity_manifest.remove(_path)
+                        mark_outdated(_path)
+                    return
+                counts['verified' if _record is not None and _record[2] == digest else 'recorded'] += 1
+                integrity_manifest.record(_path, _stat, digest)
+
+            for rec in backup_manifest.iter_under(root):
+                seen.add(rec.path)
+                try:
+                    _stat = os.stat(rec.path)
+                except OSError:
+                    change_tracker.add_error("Missing backup file | {0}, it will be copied again on the next run".format(rec.path))
+                    counts['missing'] += 1
+                    backup_manifest.remove(rec.path)
+                    modification_timestamp_db.remove_timestamp(rec.path)
+                    integrity_manifest.remove(rec.path)
+                    continue
+                _key = (_stat.st_dev, _stat.st_ino)
+                _future = digests.get(_key, None)
+                if _future is None:
+                    _future = executor.submit(get_file_hash, rec.path)
+                    counts['bytes'] += _stat.st_size
+                    if _stat.st_nlink > 1:
+                        digests[_key] = _future
+                pending.append((rec.path, _stat, _future))
+                counts['files'] += 1
+                if len(pending) >= workers * 4:
+                    resolve(*pending.pop(0))
+            for _pending in pending:
+                resolve(*_pending)
+            for path in integrity_manifest.iter_under(root):
+                if path not in seen:
+                    integrity_manifest.remove(path)
+    change_tracker.add_log("Verified {0} files ({1} read): {2} matched, {3} recorded, {4} corrupt, {5} missing".format(counts['files'],
+                                                                                                         format_bytes(counts['bytes']),
+                                                                                                         counts['verified'],
+                                                                                                         counts['recorded'],
+                                                                                                         counts['corrupt'],
+                                                                                                         counts['missing']))
+
+def benchmark_timestamp_table(entries: int):
+    """
+    Compares the memory use and lookup speed of the TimestampTable with a dict of dicts on synthetic paths
+    """
+    import random
+    import tracemalloc
+
+    def iter_paths():
+        for n in range(entries):
+            yield f"bkp/Users/Documents/project_{n // 20000}/src/module_{n // 200 % 100}/file_{n}.dat"
+
+    def build_dict():
+        return dict((x, dict(mtime=1.6e9 + n, ctime=1.6e9 + n, colresmode=0.0)) for n, x in enumerate(iter_paths()))
+
+    def build_table():
+        _table = TimestampTable()
+        for n, x in enumerate(iter_paths()):
+            _table.set(x, dict(mtime=1.6e9 + n, ctime=1.6e9 + n, colresmode=0.0))
+        return _table
+
+    lookups = random.sample(list(iter_paths()), min(entries, 200000))
+    print(f"{entries} entries, {len(lookups)} lookups")
+    for name, build in (("dict", build_dict), ("TimestampTable", build_table)):
+        tracemalloc.start()
+        _store = build()
+        _mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        _start = time.perf_counter()
+        for x in lookups:
+            _store.get(x)
+        _elapsed = time.perf_counter() - _start
+        print(f"{name}: {format_bytes(_mem)} ({_mem / max(1, entries):.0f}B per entry), {_elapsed * 1e9 / max(1, len(lookups)):.0f}ns per lookup")
+        del _store
+
+def extract_from_archive(source_path: str, dest: str):
+    """
+    Extracts an archived file, or every archived file under a folder, from the archive of its backup_dirs entry
+    """
+    source_path = source_path.replace("\\", "/").rstrip("/")
+    for b in config['backup_dirs']:
+        sd = b.get('path').replace("\\", "/").rstrip("/")
+        if get_store(b) != StoreTypes.S_TYPE_ARCHIVE or not (source_path == sd or source_path.startswith(sd + "/")):
+            continue
+        archive = get_archive_store(b)
+        target = get_bkp_path(source_path, b)
+        records = [x for x in archive.iter_records() if x.path == target or x.path.startswith(target + "/")]
+        for rec in records:
+            _dst = dest if rec.path == target else os.path.join(dest, rec.path[len(target) + 1:])
+            os.makedirs(os.path.dirname(os.path.abspath(_dst)), exist_ok=True)
+            archive.extract(rec.path, _dst)
+        print(f"Extracted {len(records)} file{'s' if len(records) != 1 else ''} to {dest}")
+        return
+    print(f"{source_path} is not part of a backup_dirs entry using the archive store.")
+
+def is_resumable(instruction: FileChangeInstruction) -> bool:
+    """
+    Cheap check that an instruction of an interrupted run still applies, copied sources have to be unchanged since planning
+    Instructions that already took effect before the last checkpoint commit are not resumable either
+    """
+    if instruction.change_type in (ChangeTypes.CH_TYPE_REMOVE, ChangeTypes.CH_TYPE_REMOVEFOLDER):
+        return instruction.archived or os.path.lexists(instruction.source)
+    try:
+        _stat = os.stat(instruction.source)
+    except OSError:
+        return False
+    planned = instruction.source_stat
+    if planned is None or _stat.st_size != planned.st_size or abs(_stat.st_mtime - planned.st_mtime) > 1e-6:
+        return False
+    if instruction.change_type == ChangeTypes.CH_TYPE_LINK and os.path.exists(instruction.target):
+        return not os.path.samefile(instruction.source, instruction.target)
+    return True
+
+def open_archive_stores(allbkps: list):
+    """
+    Opens the archive stores of the archive backup_dirs entries for instructions that were not planned by a scan of this run
+    """
+    for b in allbkps:
+        if get_store(b) == StoreTypes.S_TYPE_ARCHIVE:
+            get_archive_store(b)
+
+def resume_checkpoint(allbkps: list, storage: InstructionStorage):
+    """
+    Fills storage with the unfinished instructions of the interrupted run that are still valid
+    """
+    if not backup_manifest.is_clean:
+        # The interrupted run did not save the manifest, only the backup side is rescanned
+        scan_backup_dirs(allbkps)
+    open_archive_stores(allbkps)
+    pending = checkpoint.load()
+    resumed = [x for x in pending if is_resumable(x)]
+    for instruction in resumed:
+        storage.add_instruction(instruction)
+    change_tracker.add_log("Resuming {0} unfinished changes of an interrupted run{1}".format(len(resumed),
+                                                                                        f", {len(pending) - len(resumed)} changed since and are left to the next scan" if len(pending) != len(resumed) else ""), wait_time=2)
+    if len(resumed) == 0:
+        checkpoint.clear()
+
+def export_plan(storage: InstructionStorage, path: str):
+    """
+    Writes the instructions of storage to a gzip compressed JSON lines plan, a header line followed by one entry per instruction
+    Entries are sorted by change type and source so plans of different days can be compared with zcat and diff
+    """
+    with gzip.open(f"{path}.tmp", "wt", encoding="utf-8") as f:
+        f.write(json.dumps(dict(format=PLAN_FORMAT_NAME, version=PLAN_FORMAT_VERSION, timestamp=time.time(), host=socket.gethostname(),
+                                instructions=storage.changes_num, space_requirement=storage.space_requirement, bytes_to_modify=storage.bytes_to_modify),
+                           separators=(',', ':')) + "\n")
+        for instruction in sorted(storage, key=lambda x: (x.change_type, x.source)):
+            f.write(json.dumps(ExecutionCheckpoint.get_plan_entry(instruction), ensure_ascii=False, separators=(',', ':')) + "\n")
+    os.replace(f"{path}.tmp", path)
+
+def is_plan_entry_valid(instruction: FileChangeInstruction) -> bool:
+    """
+    is_resumable plus a check that the target is still what the plan saw, entries applied since are not applied again
+    """
+    if not is_resumable(instruction):
+        return False
+    if instruction.target is None or instruction.archived or instruction.change_type == ChangeTypes.CH_TYPE_LINK:
+        return True
+    planned = instruction.target_record.stat() if instruction.target_record is not None else None
+    try:
+        _stat = os.stat(instruction.target)
+    except OSError:
+        return planned is None
+    return planned is not None and _stat.st_size == planned.st_size and abs(_stat.st_mtime - planned.st_mtime) <= 1e-6
+
+def load_plan(path: str, allbkps: list, storage: InstructionStorage):
+    """
+    Fills storage with the entries of an exported plan whose source and target did not change since it was made
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline() or "{}")
+        if header.get('format') != PLAN_FORMAT_NAME or header.get('version') != PLAN_FORMAT_VERSION:
+            raise IOError(f"{path} is not a plan of this version of the script")
+        if not backup_manifest.is_clean:
+            scan_backup_dirs(allbkps)
+        open_archive_stores(allbkps)
+        valid, outdated = 0, 0
+        for line in f:
+            instruction = ExecutionCheckpoint.get_instruction(json.loads(line))
+            if is_plan_entry_valid(instruction):
+                storage.add_instruction(instruction)
+                valid += 1
+            else:
+                outdated += 1
+    change_tracker.add_log("Applying {0} changes planned on {1} @{2}{3}".format(valid, header.get('host'),
+                                                                          notzformat.format(datetime.datetime.fromtimestamp(header.get('timestamp', 0), tz=shift_tz)),
+                                                                          f", {outdated} changed since and are left to the next scan" if outdated > 0 else ""), wait_time=2)
+
+def process():
+    clear_terminal()
+    print("Initializing.")
+    time.sleep(1)
+    if not os.path.exists(bkp_root):
+        os.mkdir(bkp_root)
+    allbkps: list = config['backup_dirs']
+    restored, outdated = block_hash_cache.recover()
+    for interrupted in restored:
+        change_tracker.add_log(f"Delta update of {interrupted} was interrupted, the previous version was restored", wait_time=1)
+    for interrupted in outdated:
+        change_tracker.add_log(f"Delta update of {interrupted} was interrupted, it will be rewritten", wait_time=1)
+    if launch_args.args.resume and not checkpoint.exists:
+        change_tracker.add_log("No interrupted run to resume, scanning for changes", wait_time=2)
+    elif not launch_args.args.resume and checkpoint.exists and launch_args.args.command != "plan":
+        change_tracker.add_log("The unfinished plan of an interrupted run is replaced by this run, --resume continues it instead", wait_time=2)
+    if launch_args.args.command == "plan":
+        scan_changes(allbkps)
+        export_plan(file_instruction_list, launch_args.args.out)
+        print("{0}/{0}. {1} Required Changes Indexed.".format(len(allbkps), file_instruction_list.changes_num))
+        change_tracker.add_log("Plan with {0} changes written to {1}. Space required: {2}, to copy: {3}".format(file_instruction_list.changes_num, launch_args.args.out,
+                                                                                                      format_bytes(file_instruction_list.space_requirement),
+                                                                                                      format_bytes(file_instruction_list.bytes_to_modify)))
+        return
+    if launch_args.args.command == "apply":
+        num_files, file_change_errors = 0, 0
+        load_plan(launch_args.args.plan_file, allbkps, file_instruction_list)
+        if file_instruction_list.changes_num > 0:
+            confirm_changes(file_instruction_list)
+            check_free_space(file_instruction_list)
+            num_files, file_change_errors = execute_instructions(file_instruction_list)
+    elif launch_args.args.resume and checkpoint.exists:
+        num_files, file_change_errors = 0, 0
+        resume_checkpoint(allbkps, file_instruction_list)
+        if file_instruction_list.changes_num > 0:
+            confirm_changes(file_instruction_list)
+            check_free_space(file_instruction_list)
+            num_files, file_change_errors = execute_instructions(file_instruction_list)
+    elif launch_args.args.pipeline:
+        num_files, file_change_errors = process_pipelined(allbkps)
+    else:
+        num_files, file_change_errors = 0, 0
+        scan_changes(allbkps)
+        if file_instruction_list.changes_num > 0:
+            confirm_changes(file_instruction_list)
+            check_free_space(file_instruction_list)
+            num_files, file_change_errors = execute_instructions(file_instruction_list)
+    if num_files > 0 and file_change_errors == 0:
+        for b in allbkps:
+            if b.get("mode", ManageModes.M_MODE_DEFAULT) == ManageModes.M_MODE_VERSIONED:
+                prune_snapshots(b)
+    if num_files > 0 and any(get_store(b) == StoreTypes.S_TYPE_DEDUP for b in allbkps):
+        removed, freed = dedup_store.collect_garbage()
+        if removed > 0:
+            change_tracker.add_log(f"Removed {removed} unreferenced dedup objects, freed {format_bytes(freed)}", should_print=False)
+    if num_files > 0:
+        for archive in archive_stores.values():
             try:
-                if not launch_args.args.nooutput:
-                    print_status()
-                if not launch_args.args.nologs:
-                    change_tracker.add_log("Folder:{2}\nFile:{3}\n{0} / {1} done. DiffSize:{4}".format(current_file_num,
-                                                                                        num_files,
-                                                                                        os.path.split(_cur_file.source)[0],
-                                                                                        os.path.split(_cur_file.source)[1],
-                                                                                        format_bytes(_cur_file.diffsize)), should_print=False)
-                if _cur_file.change_type in (ChangeTypes.CH_TYPE_UPDATE, ChangeTypes.CH_TYPE_UPDATE_NOTS):
-                    act_filepath = get_actual_filepath(_cur_file.target)
-                    copy_with_callback(_cur_file.source, os.path.dirname(act_filepath), callback=partial(print_cur_status, _cur_file.diffsize))  # noqa
-                    modification_timestamp_db.save_timestamp(_cur_file.source if _cur_file.change_type is ChangeTypes.CH_TYPE_UPDATE_NOTS else _cur_file.target)
-                    bytes_done += _cur_file.diffsize
-                    change_tracker.add_file_change(ChangeTypes.CH_TYPE_UPDATE, "Updated | {0} | {1} -> {2}".format(_cur_file.source,
-                                                                                                 get_modification_dt_from_file(_cur_file.source),
-                                                                                                 get_modification_dt_from_file(_cur_file.target)),
-                                                   should_print=False)
-                    if os.path.basename(act_filepath) != os.path.basename(_cur_file.source):
-                        os.rename(act_filepath, os.path.join(os.path.dirname(act_filepath), os.path.basename(_cur_file.source)))
-                        change_tracker.add_file_change(ChangeTypes.CH_TYPE_RENAME, "Renamed | {0} | {1} -> {2}".format(act_filepath,
-                                                                                                     os.path.basename(act_filepath),
-                                                                                                     os.path.basename(_cur_file.source)))
-                elif _cur_file.change_type in (ChangeTypes.CH_TYPE_CREATE, ChangeTypes.CH_TYPE_CREATE_NOTS):
-                    copy_with_callback(_cur_file.source, os.path.dirname(_cur_file.target), callback=partial(print_cur_status, _cur_file.diffsize))  # noqa
-                    modification_timestamp_db.save_timestamp(_cur_file.source if _cur_file.change_type is ChangeTypes.CH_TYPE_CREATE_NOTS else _cur_file.target)
-                    bytes_done += _cur_file.diffsize
-                    change_tracker.add_file_change(ChangeTypes.CH_TYPE_CREATE, "Created | {0}".format(_cur_file.source), should_print=False)
-                elif _cur_file.change_type == ChangeTypes.CH_TYPE_REMOVE or _cur_file.change_type == ChangeTypes.CH_TYPE_REMOVEFOLDER:
-                    bytes_done += _cur_file.diffsize
-                    del_file_or_dir(get_actual_filepath(_cur_file.source))
-                    modification_timestamp_db.remove_timestamp(_cur_file.source)
-                    change_tracker.add_file_change(_cur_file.change_type, "Removed | {0}".format(get_actual_filepath(_cur_file.source)), should_print=False)
-            except Exception as fileupd_exception:
-                change_tracker.add_error("Failed to {3} file: {0} due to an Exception {1}. {2}".format(str(_cur_file), type(fileupd_exception).__name__, fileupd_exception.args, _cur_file.change_type), wait_time=5)
-                file_change_errors += 1
-            finally:
-                current_file_num += 1
-        file_instruction_list.invalidate_cache()
-        clear_terminal()
-        print("Finished Copying.")
-        ANSIEscape.set_cursor_display(True)
-        print("{0} / {1}({2}%) done.\n{3}{4}".format(num_files - file_change_errors,
-                                                     num_files,
-                                                     round((num_files - file_change_errors) * 100 / num_files, 2),
-                                                     "\n\n{} errors".format(file_change_errors) if file_change_errors != 0 else "",
-                                                     "\n".join([x[1:] if x.startswith("\n") else x for x in change_tracker.errors])))
-        change_tracker.add_log("{0} / {1} done.\n{2}%\n{3}".format(num_files - file_change_errors,
-                                                             num_files,
-                                                             round((num_files - file_change_errors) * 100 / num_files, 2),
-                                                             "\n\n{} errors".format(ANSIEscape.get_colored_text(str(file_change_errors), text_color=ANSIEscape.ForegroundTextColor.red)) if file_change_errors != 0 else ""), should_print=False)
+                repacked, freed = archive.repack()
+            except (OSError, tarfile.TarError) as _e:
+                change_tracker.add_error("Failed to repack the archive {0} due to an Exception {1}. {2}".format(archive.root, type(_e).__name__, _e.args), wait_time=5)
+                continue
+            if repacked > 0:
+                change_tracker.add_log(f"Repacked {repacked} volumes of the archive {archive.root}, freed {format_bytes(freed)}", should_print=False)
+    if num_files > 0:
+        print_execution_summary(num_files, file_change_errors)
     else:
         print("{0}/{0}. 0 Required Changes Indexed.".format(len(allbkps)))
         print("No Changes Found. Exiting")
@@ -1581,7 +4858,7 @@ def start_menu():
                 modes += "\n"
             modes += "{0} mode enabled".format(a)
     print("Automated Backup Script.{2}\nVersion:{0}/{1}".format(version.get('version', "Unavailable"), version.get('coderev', "Unavailable"), "\n{}".format(modes) if len(modes) > 0 else ""))
-    print(f"Timestamp DB entries: {len(modification_timestamp_db.data)}, @{notzformat.format(datetime.datetime.fromtimestamp(modification_timestamp_db.snapshot_ts, tz=shift_tz))}")
+    print(f"Timestamp DB entries: {modification_timestamp_db.num_entries}, @{notzformat.format(datetime.datetime.fromtimestamp(modification_timestamp_db.snapshot_ts, tz=shift_tz))}")
     print(f"{ANSIEscape.get_colored_text('Press any key to proceed', text_color=ANSIEscape.ForegroundTextColor.bright_yellow)}\n{ANSIEscape.get_colored_text('Close the app to cancel', text_color=ANSIEscape.ForegroundTextColor.bright_red)}.")
     if launch_args.args.nologs and launch_args.args.profile:
         print(ANSIEscape.get_colored_text("Profile Mode will output results to terminal due to NoLogs Mode being active!", text_color=ANSIEscape.ForegroundTextColor.red))
@@ -1614,12 +4891,15 @@ def start_menu():
             print(f"{ANSIEscape.get_colored_text('Running in OFFLINE Mode', text_color=ANSIEscape.ForegroundTextColor.yellow)}\nBuild time: {datetime.datetime.fromtimestamp(_buildstamp, tz=shift_tz)} ({ANSIEscape.get_colored_text(str(_days), text_color=ANSIEscape.ForegroundTextColor.red if _days > 100 else ANSIEscape.ForegroundTextColor.yellow)} days old).\nMay be outdated.")
     if not launch_args.args.nopause:
         os.system("pause >nul")
-    change_tracker.add_log("Starting backup process")
+    change_tracker.add_log({"verify": "Starting verification", "plan": "Starting planning"}.get(launch_args.args.command, "Starting backup process"))
     time.sleep(2)
     start_dt = datetime.datetime.now(shift_tz)
     finished_init = True
     try:
-        process()
+        if launch_args.args.command == "verify":
+            verify_backups(config['backup_dirs'])
+        else:
+            process()
     except IOError as ioexc:
         print("{0}: {1}".format(type(ioexc).__name__, ",".join(list(map(lambda x: str(x), ioexc.args)))), flush=True)
         os.system("pause")
@@ -1636,49 +4916,45 @@ def start_menu():
                                                                                                     str(datetime.datetime.now(shift_tz) - start_dt),
                                                                                                     "\n{0} file{1} renamed due to filename case changes".format(change_tracker.num_changes(ChangeTypes.CH_TYPE_RENAME),
                                                                                                                                                                 "s" if change_tracker.num_changes(ChangeTypes.CH_TYPE_RENAME) != 1 else "") if change_tracker.has_changes(ChangeTypes.CH_TYPE_RENAME) else ""))
-    if not launch_args.args.nologs and (sum(x.num_changes for x in change_tracker.typetrackers.values()) + change_tracker.num_errors) > 0:
+    if change_tracker.has_changes(ChangeTypes.CH_TYPE_LINK):
+        change_tracker.add_log("{0} unchanged files linked into new snapshots.".format(change_tracker.num_changes(ChangeTypes.CH_TYPE_LINK)))
+    if len(change_tracker.copy_methods) > 0:
+        change_tracker.add_log("Copy methods: {0}".format(change_tracker.copy_methods_summary), should_print=False)
+    if scan_cache is not None and scan_cache.hits + scan_cache.misses > 0:
+        change_tracker.add_log("Scan cache: {0} folders reused, {1} read".format(scan_cache.hits, scan_cache.misses), should_print=False)
+    if hash_cache.hits + hash_cache.misses > 0:
+        change_tracker.add_log("Hash cache: {0} hashes reused, {1} files hashed".format(hash_cache.hits, hash_cache.misses), should_print=False)
+    if not launch_args.args.nologs and (change_tracker.total_changes + change_tracker.num_errors) > 0:
         change_tracker.add_log("Writing Logs")
-        if not os.path.exists("bkpLogs"):
-            os.mkdir("bkpLogs")
-        ulp = os.path.join("bkpLogs", str(start_dt.date()))
-        if not os.path.exists(ulp):
-            os.mkdir(ulp)
-        if len(change_tracker.log) > 0:
-            with open(os.path.join(ulp, "full.log"), "a", encoding="utf-8") as ul:
-                ul.writelines(change_tracker.log)
-        if change_tracker.has_changes(ChangeTypes.CH_TYPE_UPDATE):
-            with open(os.path.join(ulp, "updates.log"), "a", encoding="utf-8") as ul:
-                ul.writelines(f"{str(x)}\n" for x in change_tracker.typetrackers[ChangeTypes.CH_TYPE_UPDATE].changes)
-        if change_tracker.has_changes(ChangeTypes.CH_TYPE_RENAME):
-            with open(os.path.join(ulp, "renames.log"), "a", encoding="utf-8") as ul:
-                ul.writelines(f"{str(x)}\n" for x in change_tracker.typetrackers[ChangeTypes.CH_TYPE_RENAME].changes)
-        if change_tracker.has_changes(ChangeTypes.CH_TYPE_CREATE):
-            with open(os.path.join(ulp, "additions.log"), "a", encoding="utf-8") as ul:
-                ul.writelines(f"{str(x)}\n" for x in change_tracker.typetrackers[ChangeTypes.CH_TYPE_CREATE].changes)
-        if change_tracker.has_changes(ChangeTypes.CH_TYPE_REMOVE):
-            with open(os.path.join(ulp, "removals.log"), "a", encoding="utf-8") as ul:
-                ul.writelines(f"{str(x)}\n" for x in change_tracker.typetrackers[ChangeTypes.CH_TYPE_REMOVE].changes)
-        if change_tracker.has_changes(ChangeTypes.CH_TYPE_REMOVEFOLDER):
-            with open(os.path.join(ulp, "folderremovals.log"), "a", encoding="utf-8") as ul:
-                ul.writelines(f"{str(x)}\n" for x in change_tracker.typetrackers[ChangeTypes.CH_TYPE_REMOVEFOLDER].changes)
-        if change_tracker.has_changes(ChangeTypes.CH_TYPE_FOLDER):
-            with open(os.path.join(ulp, "folders.log"), "a", encoding="utf-8") as ul:
-                ul.writelines(f"{str(x)}\n" for x in change_tracker.typetrackers[ChangeTypes.CH_TYPE_FOLDER].changes)
-        if change_tracker.num_errors > 0:
-            with open(os.path.join(ulp, "errors.log"), "a", encoding="utf-8") as ul:
-                ul.writelines(change_tracker.errors)
+        change_tracker.write_text_logs()
+    change_tracker.close()
     print("Done.")
     if modification_timestamp_db.unsaved_changes > 0:
         print(ANSIEscape.get_colored_text(f"ModTimestamp DB changes: {modification_timestamp_db.unsaved_changes}", text_color=ANSIEscape.ForegroundTextColor.cyan))
-        modification_timestamp_db.save()
+        if launch_args.args.command == "plan":
+            # Nothing was synced yet, the snapshot timestamp stays where the last applied run left it
+            modification_timestamp_db.flush()
+        else:
+            modification_timestamp_db.save()
+    modification_timestamp_db.close()
+    if backup_manifest.unsaved_changes > 0 or backup_manifest.is_dirty or not backup_manifest.is_clean:
+        backup_manifest.save()
+    if block_hash_cache.unsaved_changes > 0:
+        block_hash_cache.save()
+    if hash_cache.unsaved_changes > 0:
+        hash_cache.save()
+    for archive in archive_stores.values():
+        if archive.unsaved_changes > 0:
+            archive.save()
+    if integrity_manifest.unsaved_changes > 0:
+        integrity_manifest.save()
     if change_tracker.num_errors > 0:
         print(f"{ANSIEscape.get_colored_text(f'Encountered {change_tracker.num_errors} errors.', text_color=ANSIEscape.ForegroundTextColor.yellow)}")
         time.sleep(2)
         if launch_args.args.nologs:
-            print("\n".join(change_tracker.errors))
+            print(change_tracker.get_errors_text())
         else:
-            ulp = os.path.join("bkpLogs", str(start_dt.date()))
-            os.system("start " + os.path.join(ulp, 'errors.log').replace('\\', '/'))
+            os.system("start " + os.path.join(change_tracker.sink.folder, 'errors.log').replace('\\', '/'))
     if not launch_args.args.nopause:
         os.system("pause")
 
@@ -1695,13 +4971,51 @@ if __name__ == "__main__":
     ap.add_argument("-ncl", "--nochangelist", help="disable showing a list of changes before copying", action="store_true")
     ap.add_argument("-ve", "--verboseerrors", help="show more info on error", action="store_true")
     ap.add_argument("-prof", "--profile", help="run with a profiler active, display the results in the end", action="store_true")
+    ap.add_argument("-rb", "--rescan-backup", help="rebuild the backup manifest by scanning the backup folder", action="store_true")
+    ap.add_argument("-sc", "--scan-cache", help="reuse cached listings of source folders whose modification time did not change", action="store_true")
+    ap.add_argument("-tdm", "--trust-dir-mtime", help="scan cache mode that also reuses cached file stats of unchanged folders, misses files modified in place", action="store_true")
+    ap.add_argument("-pl", "--pipeline", help="start applying changes of scanned folders while the scan continues, the change list is shown per batch", action="store_true")
+    ap.add_argument("-pld", "--pipeline-depth", help="number of scanned batches allowed to wait for copying in pipeline mode", type=int, default=4)
+    ap.add_argument("-cw", "--copy-workers", help="number of threads used to apply changes", type=int, default=1)
+    ap.add_argument("-ccs", "--copy-chunk-size", help="amount copied per copy_file_range/sendfile call (e.g. 16MiB), progress is reported and Ctrl+C is handled between chunks", type=parse_size, default=None)
+    ap.add_argument("-ds", "--delta-size", help="update files of at least this size (e.g. 256MiB) by rewriting only their changed blocks", type=parse_size, default=None)
+    ap.add_argument("-x", "--extract", help="extract a file or folder from the archive of its backup_dirs entry to DEST and exit", nargs=2, metavar=("SOURCE_PATH", "DEST"), default=None)
+    ap.add_argument("-sch", "--schedule", help="order of copies: locality groups them by target folder and source inode, small or large copies by size", choices=SchedulePolicies.all_types(), default=SchedulePolicies.P_TYPE_LOCALITY)
+    ap.add_argument("-rs", "--resume", help="continue the unfinished changes of an interrupted run without scanning the sources", action="store_true")
+    ap.add_argument("-bts", "--benchmark-timestamps", help="compare memory use and lookup speed of the timestamp table with a plain dict on N synthetic entries and exit", type=int, default=None, metavar="N")
+    ap.add_argument("-hw", "--hash-workers", help="number of threads hashing files of backup_dirs entries using checksum compare", type=int, default=4)
+    ap.add_argument("-vc", "--verify", help="reread every written file after copying and compare its hash with the source, matches are recorded in the integrity manifest", action="store_true")
+    ap.add_argument("-vw", "--verify-workers", help="number of threads reading files for --verify and the verify command", type=int, default=4)
+    ap.add_argument("command", help="backup (default), verify to check the backup against its integrity manifest, plan to only write the scanned changes to --out or apply to carry out a written plan",
+                    nargs="?", choices=("backup", "verify", "plan", "apply"), default="backup")
+    ap.add_argument("plan_file", help="plan written by the plan command, for apply", nargs="?", default=None)
+    ap.add_argument("-o", "--out", help="file the plan command writes to", default="plan.bin")
+    ap.add_argument("-sw", "--scan-workers", help="number of threads used to read directories while scanning, can be overridden per backup_dirs entry with scan_workers", type=int, default=1)
     args = ap.parse_args()
+    if args.command == "apply" and args.plan_file is None:
+        ap.error("apply requires the plan file, e.g. backup.py apply plan.bin")
     launch_args.update_args(args)
     try:
-        change_tracker = ChangeTracker()
+        change_tracker = ChangeTracker(LogSink(os.path.join("bkpLogs", str(get_cur_dt().date()))) if not launch_args.args.nologs else None)
         file_instruction_list = InstructionStorage()
         modification_timestamp_db = ModTimestampDB()
-        if launch_args.args.profile:
+        backup_manifest = BackupManifest()
+        block_hash_cache = BlockHashCache()
+        hash_cache = HashCache()
+        dedup_store = DedupStore(os.path.join(bkp_root, DEDUP_STORE_FOLDER))
+        archive_stores: Dict[str, ArchiveStore] = dict()
+        checkpoint = ExecutionCheckpoint()
+        # Target folders known to exist during the current execution
+        known_target_folders: Set[str] = set()
+        # Set after Ctrl+C to stop the copies running on worker threads
+        copy_cancelled = threading.Event()
+        integrity_manifest = IntegrityManifest(os.path.join(bkp_root, INTEGRITY_MANIFEST_NAME))
+        scan_cache = ScanCache(trust_dir_mtime=launch_args.args.trust_dir_mtime) if launch_args.args.scan_cache or launch_args.args.trust_dir_mtime else None
+        if launch_args.args.extract is not None:
+            extract_from_archive(*launch_args.args.extract)
+        elif launch_args.args.benchmark_timestamps is not None:
+            benchmark_timestamp_table(launch_args.args.benchmark_timestamps)
+        elif launch_args.args.profile:
             import cProfile
             with cProfile.Profile() as profiler:
                 start_menu()